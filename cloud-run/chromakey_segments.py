@@ -0,0 +1,143 @@
+"""
+Segment-parallel chromakey rendering.
+
+Shared by the Cloud Run worker and scripts/process_videos.py: the video stream is
+split at keyframes (stream copy, no re-encode), every part is keyed + encoded in its
+own ffmpeg process and the result is an ffconcat list that the caller concatenates
+with -c:v copy, muxing the audio from the original file in the same pass (so there
+are no audio gaps at the part boundaries).
+
+The callers pass their own filter graph and encoder arguments; this module only owns
+the splitting, the parallel encodes and how many CPUs they may use. CPU sizing uses
+the container's allowance (affinity mask and cgroup quota) instead of os.cpu_count(),
+which reports the host's CPUs on Cloud Run.
+"""
+
+import math
+import os
+import subprocess
+
+
+def available_cpus():
+    """CPUs this process may actually use: affinity mask, capped by the cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            value, period = f.read().split()[:2]
+            if value != 'max':
+                quota = int(value) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: quota is -1 when unlimited
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                value = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if value > 0 and period > 0:
+                quota = value / period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+
+def probe_duration(path):
+    """Container duration in seconds via ffprobe (0 if unknown)."""
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+        '-of', 'default=nokey=1:noprint_wrappers=1', str(path)
+    ], capture_output=True, text=True)
+    try:
+        return float(result.stdout.strip())
+    except (ValueError, TypeError):
+        return 0
+
+
+def split_at_keyframes(input_video, segments, work_dir, timeout=None):
+    """
+    Split the video stream (stream copy, no re-encode) into about `segments` parts.
+    The segment muxer cuts at the first keyframe at/after each split time, so every
+    part starts with a keyframe and the parts cover all frames exactly once.
+    """
+    duration = probe_duration(input_video)
+    if duration <= 0:
+        raise RuntimeError("Segment split: unknown duration")
+    split_times = ','.join(f'{duration * i / segments:.3f}' for i in range(1, segments))
+    result = subprocess.run([
+        'ffmpeg', '-y',
+        '-i', str(input_video),
+        '-map', '0:v:0', '-an',
+        '-c', 'copy',
+        '-f', 'segment',
+        '-segment_times', split_times,
+        '-reset_timestamps', '1',
+        os.path.join(work_dir, 'part_%03d.mp4')
+    ], capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"Segment split failed: {result.stderr[-500:]}")
+    return sorted(
+        os.path.join(work_dir, name) for name in os.listdir(work_dir)
+        if name.startswith('part_')
+    )
+
+
+def render_keyed_segments(input_video, bg_path, work_dir, segments, filter_complex, encode_args,
+                          input_args=(), concurrent_jobs=1, timeout=None):
+    """
+    Key + encode the video stream of `input_video` in parallel parts.
+
+    `segments` is capped at this job's share of the CPUs (available_cpus() divided by
+    `concurrent_jobs`, the encodes running next to it); the CPUs are split between the
+    parts via -threads. `filter_complex` must read [0:v] (part) and [1:v] (background)
+    and produce [out]. Raises RuntimeError (or subprocess.TimeoutExpired) on failure.
+
+    Returns (path of the ffconcat list, number of parts, threads per part).
+    """
+    cpus = max(1, available_cpus() // max(1, concurrent_jobs))
+    segments = max(2, min(segments, cpus))
+    parts = split_at_keyframes(input_video, segments, work_dir, timeout=timeout)
+    threads = max(1, cpus // len(parts))
+    keyed_parts = [os.path.join(work_dir, f'keyed_{i:03d}.mp4') for i in range(len(parts))]
+
+    procs = []
+    try:
+        for part, keyed in zip(parts, keyed_parts):
+            procs.append(subprocess.Popen([
+                'ffmpeg', '-y',
+                *input_args,
+                '-i', part,
+                '-loop', '1',
+                '-i', str(bg_path),
+                '-filter_complex', filter_complex,
+                '-map', '[out]', '-an',
+                *encode_args,
+                '-threads', str(threads),
+                keyed
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE))
+        errors = []
+        for proc in procs:
+            _, stderr = proc.communicate(timeout=timeout)
+            if proc.returncode != 0:
+                errors.append(stderr.decode(errors='replace')[-500:])
+    finally:
+        # On a timeout (or any other error) don't leave encodes running
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+    if errors:
+        raise RuntimeError(f"Segment encode failed: {errors[0]}")
+
+    concat_list = os.path.join(work_dir, 'concat.txt')
+    with open(concat_list, 'w') as f:
+        for keyed in keyed_parts:
+            f.write(f"file '{keyed}'\n")
+    return concat_list, len(parts), threads
@@ -0,0 +1,213 @@
+"""
+Token-aware batched OpenAI embedding client.
+
+Used by the corpus scripts (generate_embeddings.py, generate_techniek_embeddings.py,
+sync_ssot_to_rag.py, backfill_rag_embeddings.py, import_rag_corpus.py) instead of one
+embeddings.create() request per document:
+
+- inputs are packed greedily (in order) into requests of at most MAX_INPUTS_PER_REQUEST
+  inputs and MAX_TOKENS_PER_REQUEST tokens; a single input is truncated to
+  MAX_TOKENS_PER_INPUT tokens
+- up to `concurrency` requests run in parallel (thread pool, default EMBEDDING_CONCURRENCY=4)
+- a failed request is retried with backoff on rate limits / server errors; a request
+  rejected as invalid input (400) is split in half, so one bad input cannot fail the
+  whole batch; any other error (auth, quota, retries exhausted) fails the whole batch
+  at once instead of being retried once per split
+- results come back in the original order; inputs that still fail are None and listed
+  in batcher.errors
+- texts already in the local embedding cache (embedding_cache.py) are not sent at all
+
+    batcher = EmbeddingBatcher(openai_client)
+    embeddings = batcher.embed(texts)
+
+Token counts use tiktoken when it is installed, otherwise a conservative estimate
+(3 characters per token).
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_cache import get_default_cache
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+DEFAULT_MODEL = 'text-embedding-3-small'
+MAX_INPUTS_PER_REQUEST = 2048    # OpenAI limit per embeddings request
+MAX_TOKENS_PER_REQUEST = 250000  # OpenAI limit is 300k; keep headroom for estimate errors
+MAX_TOKENS_PER_INPUT = 8191
+CHARS_PER_TOKEN_ESTIMATE = 3
+DEFAULT_CONCURRENCY = int(os.environ.get('EMBEDDING_CONCURRENCY', '4'))
+DEFAULT_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+BAD_INPUT_STATUS_CODES = {400, 422}
+
+
+def _is_transient(error):
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRY_STATUS_CODES
+    # Connection errors / timeouts have no status code
+    return 'timeout' in type(error).__name__.lower() or 'connection' in type(error).__name__.lower()
+
+
+def _is_bad_input(error):
+    """Request rejected because of its inputs (BadRequestError): splitting can isolate the bad one."""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in BAD_INPUT_STATUS_CODES
+    return type(error).__name__ == 'BadRequestError'
+
+
+class EmbeddingBatcher:
+    """Batched, concurrent embeddings with split-on-failure and order preservation."""
+
+    def __init__(self, client, model=DEFAULT_MODEL, dimensions=None, concurrency=DEFAULT_CONCURRENCY,
+                 max_inputs=MAX_INPUTS_PER_REQUEST, max_tokens=MAX_TOKENS_PER_REQUEST,
+                 retries=DEFAULT_RETRIES, cache=None):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.concurrency = max(1, concurrency)
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.retries = retries
+        self.cache = cache if cache is not None else get_default_cache()
+        self.errors = {}
+        self.requests = 0
+        self.splits = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+        self._encoding = None
+        if TIKTOKEN_AVAILABLE:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding('cl100k_base')
+
+    def _truncate(self, text):
+        """Clip one input to MAX_TOKENS_PER_INPUT; returns (text, token count)."""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text)
+            if len(tokens) > MAX_TOKENS_PER_INPUT:
+                tokens = tokens[:MAX_TOKENS_PER_INPUT]
+                text = self._encoding.decode(tokens)
+            return text, len(tokens)
+        max_chars = MAX_TOKENS_PER_INPUT * CHARS_PER_TOKEN_ESTIMATE
+        text = text[:max_chars]
+        return text, len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+    def _pack(self, items):
+        """Greedy in-order packing of (index, text, tokens) into request-sized batches."""
+        batches = []
+        current, current_tokens = [], 0
+        for item in items:
+            tokens = item[2]
+            if current and (len(current) >= self.max_inputs or current_tokens + tokens > self.max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(item)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _request(self, texts):
+        kwargs = {'model': self.model, 'input': texts}
+        if self.dimensions:
+            kwargs['dimensions'] = self.dimensions
+        with self._lock:
+            self.requests += 1
+        response = self.client.embeddings.create(**kwargs)
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    def _embed_batch(self, batch, results):
+        """Embed one batch into results; retry transient errors, split on invalid input, fail on the rest."""
+        texts = [text for _, text, _ in batch]
+        attempt = 0
+        while True:
+            try:
+                for (index, _, _), embedding in zip(batch, self._request(texts)):
+                    results[index] = embedding
+                return
+            except Exception as e:
+                if _is_transient(e) and attempt < self.retries:
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(BACKOFF_SECONDS * (2 ** attempt))
+                    attempt += 1
+                    continue
+                if len(batch) > 1 and _is_bad_input(e):
+                    with self._lock:
+                        self.splits += 1
+                    middle = len(batch) // 2
+                    self._embed_batch(batch[:middle], results)
+                    self._embed_batch(batch[middle:], results)
+                    return
+                # Auth / quota / exhausted retries: every half would fail (and back off) the same way
+                message = str(e)[:300]
+                with self._lock:
+                    for index, _, _ in batch:
+                        self.errors[index] = message
+                return
+
+    def _embed_uncached(self, texts):
+        results = [None] * len(texts)
+        items = []
+        for index, text in enumerate(texts):
+            text, tokens = self._truncate(text)
+            items.append((index, text, tokens))
+        batches = self._pack(items)
+        if len(batches) == 1 or self.concurrency == 1:
+            for batch in batches:
+                self._embed_batch(batch, results)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                for future in [executor.submit(self._embed_batch, batch, results) for batch in batches]:
+                    future.result()
+        return results
+
+    def embed(self, texts):
+        """
+        Embeddings for texts, in the same order. Empty texts and inputs that failed
+        after retries/splitting are None (see self.errors, keyed by input index).
+        """
+        self.errors = {}
+        results = [None] * len(texts)
+        non_empty = [(i, text.strip()) for i, text in enumerate(texts) if text and text.strip()]
+        if not non_empty:
+            return results
+
+        failed = {}
+
+        def create_many(batch_texts):
+            embeddings = self._embed_uncached(batch_texts)
+            # Failures are reported per cache-miss position; map back after the cache call
+            failed.update({batch_texts[i]: error for i, error in self.errors.items()})
+            self.errors = {}
+            return embeddings
+
+        embedded = self.cache.get_or_create_many(
+            self.model, [text for _, text in non_empty], create_many, dimensions=self.dimensions
+        )
+        for (index, text), embedding in zip(non_empty, embedded):
+            results[index] = embedding
+            if embedding is None and text in failed:
+                self.errors[index] = failed[text]
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'splits': self.splits,
+                'retries': self.retried,
+                'failed_inputs': len(self.errors),
+            }
@@ -0,0 +1,256 @@
+"""
+Content-addressed embedding cache on local disk (SQLite).
+
+Shared by the Cloud Run worker and the embedding scripts (process_videos.py,
+generate_embeddings.py, generate_techniek_embeddings.py, sync_ssot_to_rag.py,
+backfill_*.py, import_rag_corpus.py) so a retried job or a rebuilt corpus does not
+pay for embedding text that did not change.
+
+Key: sha256(model + dimensions + normalized text), normalized = whitespace collapsed.
+Value: the embedding as float32 blob (pgvector stores float32 anyway).
+Eviction: least recently used rows are deleted once the cache exceeds max_bytes.
+The size is tracked as a running total (summed once at open); because other processes
+may write the same file, it is re-summed before evicting.
+
+    cache = get_default_cache()
+    embedding = cache.get_or_create(EMBEDDING_MODEL, text, lambda: call_openai(text))
+
+Config (env):
+    EMBEDDING_CACHE_PATH    SQLite file (default ~/.cache/hugoherbots/embeddings.sqlite,
+                            empty string disables the cache)
+    EMBEDDING_CACHE_MAX_MB  size limit before LRU eviction (default 512)
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'hugoherbots', 'embeddings.sqlite')
+DEFAULT_MAX_MB = 512
+EVICT_TO_FRACTION = 0.9  # evict down to 90% of max_bytes so not every put evicts
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    dimensions INTEGER,
+    embedding BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used);
+"""
+
+
+def normalize_text(text):
+    return ' '.join((text or '').split())
+
+
+def cache_key(model, text, dimensions=None):
+    payload = f"{model}\x00{dimensions or ''}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite-backed embedding cache with LRU eviction and hit/miss counters."""
+
+    COUNTERS = ('hits', 'misses', 'writes', 'evictions', 'errors')
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        self._total_bytes = self._sum_size(conn)
+
+    def _connection(self):
+        # One connection per thread and per process (sqlite connections are not fork-safe)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get(self, model, text, dimensions=None):
+        """Cached embedding (list of floats) or None."""
+        key = cache_key(model, text, dimensions)
+        try:
+            conn = self._connection()
+            row = conn.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._count('misses')
+                return None
+            conn.execute('UPDATE embeddings SET last_used = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"[Embedding cache] Read failed: {e}")
+            self._count('errors')
+            self._count('misses')
+            return None
+        self._count('hits')
+        return array('f', row[0]).tolist()
+
+    def put(self, model, text, embedding, dimensions=None):
+        if not embedding:
+            return
+        blob = array('f', embedding).tobytes()
+        key = cache_key(model, text, dimensions)
+        now = time.time()
+        try:
+            conn = self._connection()
+            # A replaced row frees its old size (primary key lookup)
+            old = conn.execute('SELECT size FROM embeddings WHERE key = ?', (key,)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO embeddings (key, model, dimensions, embedding, size, created_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, model, dimensions, blob, len(blob), now, now)
+            )
+            with self._lock:
+                self._total_bytes += len(blob) - (old[0] if old else 0)
+                over_limit = self._total_bytes > self.max_bytes
+            self._count('writes')
+            if over_limit:
+                self._evict()
+        except sqlite3.Error as e:
+            print(f"[Embedding cache] Write failed: {e}")
+            self._count('errors')
+
+    @staticmethod
+    def _sum_size(conn):
+        return conn.execute('SELECT COALESCE(SUM(size), 0) FROM embeddings').fetchone()[0]
+
+    def _evict(self):
+        conn = self._connection()
+        # Re-sum (rare): other processes sharing the file change the real total
+        total = self._sum_size(conn)
+        if total <= self.max_bytes:
+            with self._lock:
+                self._total_bytes = total
+            return
+        target = int(self.max_bytes * EVICT_TO_FRACTION)
+        freed = 0
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM embeddings ORDER BY last_used'):
+            keys.append((key,))
+            freed += size
+            if total - freed <= target:
+                break
+        conn.executemany('DELETE FROM embeddings WHERE key = ?', keys)
+        with self._lock:
+            self._total_bytes = total - freed
+        self._count('evictions', len(keys))
+
+    def get_or_create(self, model, text, create, dimensions=None):
+        """Cached embedding for text, or create() (the API call) stored in the cache."""
+        embedding = self.get(model, text, dimensions)
+        if embedding is None:
+            embedding = create()
+            self.put(model, text, embedding, dimensions)
+        return embedding
+
+    def get_or_create_many(self, model, texts, create_many, dimensions=None):
+        """
+        Batch variant: only the texts that miss are passed to create_many(texts),
+        which must return their embeddings in the same order.
+        """
+        results = [self.get(model, text, dimensions) for text in texts]
+        missing = [i for i, embedding in enumerate(results) if embedding is None]
+        if missing:
+            created = create_many([texts[i] for i in missing])
+            for i, embedding in zip(missing, created):
+                results[i] = embedding
+                self.put(model, texts[i], embedding, dimensions)
+        return results
+
+    def drain_counters(self):
+        """Return and reset the counters (worker pool slots report them to the parent)."""
+        with self._lock:
+            counters = {name: getattr(self, name) for name in self.COUNTERS}
+            for name in self.COUNTERS:
+                setattr(self, name, 0)
+        return counters
+
+    def add_counters(self, counters):
+        with self._lock:
+            for name in self.COUNTERS:
+                setattr(self, name, getattr(self, name) + (counters or {}).get(name, 0))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'errors': self.errors,
+            }
+
+
+class NullEmbeddingCache:
+    """Drop-in replacement when the cache is disabled (EMBEDDING_CACHE_PATH='')."""
+
+    def get(self, model, text, dimensions=None):
+        return None
+
+    def put(self, model, text, embedding, dimensions=None):
+        pass
+
+    def get_or_create(self, model, text, create, dimensions=None):
+        return create()
+
+    def get_or_create_many(self, model, texts, create_many, dimensions=None):
+        return create_many(list(texts)) if texts else []
+
+    def drain_counters(self):
+        return {}
+
+    def add_counters(self, counters):
+        pass
+
+    def stats(self):
+        return {'disabled': True}
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache():
+    """Process-wide cache configured from EMBEDDING_CACHE_PATH / EMBEDDING_CACHE_MAX_MB."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                path = os.environ.get('EMBEDDING_CACHE_PATH', DEFAULT_PATH)
+                max_mb = float(os.environ.get('EMBEDDING_CACHE_MAX_MB', str(DEFAULT_MAX_MB)))
+                if not path:
+                    _default_cache = NullEmbeddingCache()
+                else:
+                    try:
+                        _default_cache = EmbeddingCache(path, max_bytes=int(max_mb * 1024 * 1024))
+                    except (OSError, sqlite3.Error) as e:
+                        print(f"[Embedding cache] Disabled, cannot open {path}: {e}")
+                        _default_cache = NullEmbeddingCache()
+    return _default_cache
@@ -0,0 +1,232 @@
+"""
+In-process vector search over an exported RAG corpus (no pgvector round trip).
+
+Loads the corpus embeddings into one contiguous, L2-normalized float32 matrix and
+answers top-k cosine queries with optional metadata filters (doc_type, fase,
+techniek_id). Used by scripts/search_rag_corpus.py (CLI) and
+scripts/benchmark_rag_search.py, and importable by batch jobs / evaluations:
+
+    index = RagIndex.load('exports/rag_corpus_with_embeddings.jsonl')
+    hits = index.search(query_embedding, top_k=5, doc_type='hugo_training', fase='2')
+
+Accepted corpus files:
+- the binary export (export_rag_corpus.py --with-embeddings): <name>.jsonl metadata
+  (a header line with the sidecar's shape and dtype, then one document per line,
+  'row' = row in the sidecar) + <name>.npy with the L2-normalized vectors. The float32 sidecar is memory-mapped (zero-copy: no JSON
+  float parsing, pages are loaded on demand and shared between processes); a
+  float16 sidecar is half the size and converted to float32 on load.
+- the legacy JSON export ({'documents': [...]} with inline embeddings), a plain
+  JSON array or JSONL with inline embeddings. Documents without an embedding are skipped.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from technique_matching import normalize, parse_embedding
+
+FILTER_FIELDS = ('doc_type', 'fase', 'techniek_id')
+SIDECAR_HEADER = '_sidecar'
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value if value and value.lower() not in ('none', 'null') else None
+
+
+def document_metadata(doc):
+    """Normalized metadata for export rows and the older rag/corpus format (type/source/techniek)."""
+    extra = doc.get('metadata') or {}
+    techniek_id = _clean(doc.get('techniek_id') or doc.get('techniek') or extra.get('techniek_id'))
+    fase = _clean(doc.get('fase') or extra.get('fase'))
+    if fase is None and techniek_id:
+        fase = techniek_id.split('.')[0]
+    return {
+        'id': doc.get('id'),
+        'doc_type': _clean(doc.get('doc_type') or doc.get('type')),
+        'source_id': doc.get('source_id') or doc.get('source'),
+        'title': doc.get('title'),
+        'fase': fase,
+        'techniek_id': techniek_id,
+        'content': doc.get('content'),
+    }
+
+
+def sidecar_path(path):
+    """<name>.npy next to <name>.jsonl."""
+    return os.path.splitext(str(path))[0] + '.npy'
+
+
+def write_sidecar(path, documents, embeddings, dtype='float32'):
+    """
+    Write <name>.jsonl (metadata, 'row' offset into the sidecar or None) and
+    <name>.npy (normalized vectors as float32 or float16). Returns the sidecar path.
+    """
+    rows = []
+    vectors = []
+    for doc, embedding in zip(documents, embeddings):
+        embedding = parse_embedding(embedding)
+        if embedding and (not vectors or len(embedding) == len(vectors[0])):
+            rows.append(len(vectors))
+            vectors.append(embedding)
+        else:
+            rows.append(None)
+
+    matrix = normalize(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    npy_path = sidecar_path(path)
+    # Each file is written next to its target and renamed, so a reader (or one that has
+    # the old sidecar memory-mapped) never sees a truncated file. The two renames are
+    # separate steps: a reader in between gets the new .npy with the old .jsonl, which
+    # read_sidecar_rows() detects through the shape/dtype header (not a same-shape rewrite)
+    with open(npy_path + '.tmp', 'wb') as f:
+        np.save(f, matrix.astype(dtype))
+    with open(str(path) + '.tmp', 'w', encoding='utf-8') as f:
+        header = {'rows': int(matrix.shape[0]), 'dimensions': int(matrix.shape[1]), 'dtype': dtype}
+        f.write(json.dumps({SIDECAR_HEADER: header}) + '\n')
+        for doc, row in zip(documents, rows):
+            f.write(json.dumps({**doc, 'row': row}, ensure_ascii=False) + '\n')
+    os.replace(npy_path + '.tmp', npy_path)
+    os.replace(str(path) + '.tmp', path)
+    return npy_path
+
+
+def read_sidecar_rows(path):
+    """
+    (export rows as written, memory-mapped sidecar matrix). Raises ValueError when the
+    .jsonl header does not match the .npy (the pair is being rewritten: retry).
+    Exports written before the header was added are read without the check.
+    """
+    matrix = np.load(sidecar_path(path), mmap_mode='r')
+    docs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if SIDECAR_HEADER in doc:
+                header = doc[SIDECAR_HEADER]
+                expected = (header.get('rows'), header.get('dimensions'), header.get('dtype'))
+                if expected != (matrix.shape[0], matrix.shape[1], str(matrix.dtype)):
+                    raise ValueError(
+                        f"{path}: sidecar {matrix.shape} {matrix.dtype} does not match the metadata "
+                        f"header {expected} (export being rewritten? retry)"
+                    )
+                continue
+            docs.append(doc)
+    return docs, matrix
+
+
+def read_sidecar(path):
+    """(documents with a row, matrix) from a binary export; the float32 matrix is a read-only memmap."""
+    docs, matrix = read_sidecar_rows(path)
+    if matrix.dtype != np.float32:
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    documents = [None] * len(matrix)
+    for doc in docs:
+        if doc.get('row') is not None:
+            documents[doc['row']] = document_metadata(doc)
+    return documents, matrix
+
+
+def read_corpus(path):
+    """Documents from an export JSON, JSON array or JSONL file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if str(path).endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        data = json.load(f)
+    return data['documents'] if isinstance(data, dict) else data
+
+
+class RagIndex:
+    """Normalized embedding matrix (one row per document) plus per-row metadata."""
+
+    def __init__(self, documents, matrix):
+        self.documents = documents
+        self.matrix = matrix
+        # Column arrays so filters are one vectorized comparison each
+        self._columns = {
+            field: np.array([doc.get(field) for doc in documents], dtype=object)
+            for field in FILTER_FIELDS
+        }
+
+    @classmethod
+    def from_documents(cls, docs):
+        documents = []
+        vectors = []
+        for doc in docs:
+            embedding = parse_embedding(doc.get('embedding'))
+            if not embedding or (vectors and len(embedding) != len(vectors[0])):
+                continue
+            documents.append(document_metadata(doc))
+            vectors.append(embedding)
+        matrix = normalize(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        return cls(documents, np.ascontiguousarray(matrix))
+
+    @classmethod
+    def load(cls, path):
+        """Binary export (<name>.jsonl + <name>.npy) when the sidecar exists, else inline JSON."""
+        if str(path).endswith('.npy'):
+            path = os.path.splitext(str(path))[0] + '.jsonl'
+        if str(path).endswith('.jsonl') and os.path.exists(sidecar_path(path)):
+            documents, matrix = read_sidecar(path)
+            return cls(documents, matrix)
+        return cls.from_documents(read_corpus(path))
+
+    def __len__(self):
+        return len(self.documents)
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1] if len(self) else 0
+
+    def _mask(self, filters):
+        mask = None
+        for field, value in filters.items():
+            if value is None:
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            field_mask = np.isin(self._columns[field], [str(v) for v in values])
+            mask = field_mask if mask is None else mask & field_mask
+        return mask
+
+    def search(self, query_embedding, top_k=5, threshold=None, doc_type=None, fase=None, techniek_id=None):
+        """
+        Top-k documents by cosine similarity, highest first:
+        [{'score', 'id', 'doc_type', 'source_id', 'title', 'fase', 'techniek_id', 'content'}]
+        Filters accept a value or a list of values.
+        """
+        return self.search_many([query_embedding], top_k, threshold, doc_type=doc_type, fase=fase, techniek_id=techniek_id)[0]
+
+    def search_many(self, query_embeddings, top_k=5, threshold=None, doc_type=None, fase=None, techniek_id=None):
+        """search() for a batch of queries in one matrix product."""
+        if not len(self) or not len(query_embeddings):
+            return [[] for _ in query_embeddings]
+        queries = normalize([parse_embedding(q) or q for q in query_embeddings])
+        if queries.shape[1] != self.dimensions:
+            raise ValueError(f"Query dimension {queries.shape[1]} != corpus dimension {self.dimensions}")
+
+        mask = self._mask({'doc_type': doc_type, 'fase': fase, 'techniek_id': techniek_id})
+        candidates = np.flatnonzero(mask) if mask is not None else None
+        matrix = self.matrix[candidates] if candidates is not None else self.matrix
+        if not len(matrix):
+            return [[] for _ in query_embeddings]
+
+        scores = queries @ matrix.T
+        k = min(top_k, scores.shape[1])
+        results = []
+        for row in scores:
+            # argpartition is O(n); only the k winners are sorted
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            hits = []
+            for position in top:
+                score = float(row[position])
+                if threshold is not None and score < threshold:
+                    break
+                index = candidates[position] if candidates is not None else position
+                hits.append({'score': score, **self.documents[index]})
+            results.append(hits)
+        return results
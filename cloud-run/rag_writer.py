@@ -0,0 +1,62 @@
+"""
+Bulk writer for rag_documents: one upsert request per batch instead of a
+select + insert/update (and a re-select on 409) per document.
+
+Rows are upserted on the unique source_id (scripts/sql/add_rag_documents_source_id_unique.sql):
+    'video_<job id>'       worker / process_videos transcripts (replaces metadata->>job_id)
+    'techniek_<nummer>'    technique embeddings
+    corpus source / id     generate_embeddings.py
+
+    ids = upsert_rag_documents(client, rows)   # client: SupabaseREST
+
+Returns the document ids in the order of the input rows.
+"""
+
+from datetime import datetime, timezone
+
+BATCH_SIZE = 200
+
+
+def upsert_rag_documents(client, rows, on_conflict='source_id', batch_size=BATCH_SIZE):
+    """
+    Upsert rows into rag_documents in batches of batch_size (one request each).
+    Every row must carry the on_conflict key; duplicates within a call keep the last row.
+    Rows are grouped by their set of columns, so a missing key is never written as NULL.
+    Returns the ids in input order (None where the database returned no row).
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    latest = {}
+    for row in rows:
+        if row.get(on_conflict) is None:
+            raise ValueError(f"rag_documents row without {on_conflict}: {str(row.get('title'))[:60]}")
+        # updated_at feeds the technique cache version and the incremental export watermark.
+        # It is stamped here, before the batches commit: the export re-reads an overlap window
+        latest[row[on_conflict]] = {'updated_at': now, **row}
+
+    groups = {}
+    for key, row in latest.items():
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    ids = {}
+    for group in groups.values():
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            written = client.request(
+                'POST', 'rag_documents',
+                params={'on_conflict': on_conflict, 'select': f'id,{on_conflict}'},
+                json=batch,
+                prefer='resolution=merge-duplicates,return=representation',
+                timeout=60,
+                retry=True
+            ).json()
+            for row in written:
+                ids[row[on_conflict]] = row['id']
+    return [ids.get(row[on_conflict]) for row in rows]
+
+
+def delete_rag_documents(client, ids):
+    """Delete rag_documents by id in one request per BATCH_SIZE ids."""
+    ids = list(ids)
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        client.request('DELETE', 'rag_documents', params={'id': f"in.({','.join(str(i) for i in batch)})"})
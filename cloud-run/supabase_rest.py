@@ -0,0 +1,206 @@
+"""
+Pooled Supabase (PostgREST) client for the Cloud Run worker.
+
+One client object per process instead of a bare requests.get/patch per call:
+- keep-alive connection pooling (one requests.Session, reused TLS connections)
+- auth headers built once
+- default timeout on every request
+- bounded retries with exponential backoff on connection errors and 429/5xx
+  (only for idempotent calls unless retry=True is passed)
+
+Filters use the PostgREST syntax as params, e.g.
+    db.select('video_ingest_jobs', {'status': 'eq.pending', 'select': 'id', 'limit': 5})
+A list of (key, value) tuples can be passed when the same column is filtered twice.
+
+Large reads page through the table with keyset pagination (id > last id) so
+memory stays flat and nothing is cut off at the server's max-rows limit:
+    for row in db.iter_rows('video_ingest_jobs', {'select': 'status'}):
+        ...
+
+Errors (non-2xx after retries) raise SupabaseError; network errors are raised as-is.
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+POOL_MAXSIZE = 16
+PAGE_SIZE = 1000
+
+# PATCH is idempotent for our updates (set fields to fixed values); conditional
+# claims pass retry=False so a lost response is never replayed as "already claimed".
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PATCH', 'DELETE'}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class SupabaseError(Exception):
+    """Non-2xx response from PostgREST."""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text or ''
+        super().__init__(f"{status_code} - {self.text[:200]}")
+
+
+class SupabaseREST:
+    """Thread-safe PostgREST client with a per-process pooled session."""
+
+    def __init__(self, url, key, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, pool_maxsize=POOL_MAXSIZE):
+        self.base_url = f"{url.rstrip('/')}/rest/v1" if url else None
+        self.key = key
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_maxsize = pool_maxsize
+        self.headers = {
+            'apikey': key or '',
+            'Authorization': f'Bearer {key}',
+        }
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.base_url and self.key)
+
+    def _get_session(self):
+        # Sessions are not shared across processes (pool slots, prefetch children)
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._session_pid = pid
+        return self._session
+
+    def request(self, method, path, params=None, json=None, prefer=None, timeout=None, retry=None):
+        """
+        Send a request to /rest/v1/<path> and return the Response (2xx only).
+        Retries connection errors and 429/5xx with backoff; non-idempotent methods
+        only retry when retry=True (a connect timeout is always safe to retry).
+        """
+        if not self.enabled:
+            raise SupabaseError(0, 'Supabase credentials missing')
+
+        method = method.upper()
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        headers = dict(self.headers)
+        if json is not None:
+            headers['Content-Type'] = 'application/json'
+        if prefer:
+            headers['Prefer'] = prefer
+
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        attempt = 0
+        while True:
+            try:
+                resp = self._get_session().request(
+                    method, url,
+                    params=params,
+                    json=json,
+                    headers=headers,
+                    timeout=timeout or self.timeout
+                )
+            except requests.exceptions.ConnectTimeout:
+                if attempt >= self.retries:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not retry or attempt >= self.retries:
+                    raise
+            else:
+                if resp.status_code < 300:
+                    return resp
+                if not retry or resp.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    raise SupabaseError(resp.status_code, resp.text)
+
+            time.sleep(BACKOFF_SECONDS * (2 ** attempt))
+            attempt += 1
+
+    def select(self, table, params=None, timeout=None):
+        """GET rows; returns a list of dicts."""
+        return self.request('GET', table, params=params, timeout=timeout).json()
+
+    def iter_pages(self, table, params=None, page_size=PAGE_SIZE, key='id', timeout=None):
+        """
+        Yield lists of rows ordered by key, one request per page (keyset pagination:
+        key > last key of the previous page). The key column is added to select when
+        missing; order/limit/offset in params are replaced. Stops at the first empty
+        page, so a server max-rows below page_size never truncates the result.
+        """
+        if isinstance(params, dict):
+            params = list(params.items())
+        base = [(k, v) for k, v in (params or []) if k not in ('order', 'limit', 'offset')]
+        select = next((v for k, v in base if k == 'select'), '*')
+        columns = [c.strip() for c in select.split(',')]
+        if '*' not in columns and key not in columns:
+            base = [(k, v) for k, v in base if k != 'select'] + [('select', f'{select},{key}')]
+
+        last = None
+        while True:
+            page_params = base + [('order', f'{key}.asc'), ('limit', page_size)]
+            if last is not None:
+                page_params.append((key, f'gt.{last}'))
+            rows = self.select(table, page_params, timeout=timeout)
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][key]
+
+    def iter_rows(self, table, params=None, page_size=PAGE_SIZE, key='id', timeout=None):
+        """iter_pages(), one row at a time."""
+        for rows in self.iter_pages(table, params, page_size, key, timeout):
+            yield from rows
+
+    def select_with_count(self, table, params=None, timeout=None):
+        """GET rows plus the exact total for the filters: returns (rows, total)."""
+        resp = self.request('GET', table, params=params, prefer='count=exact', timeout=timeout)
+        total = resp.headers.get('content-range', '').split('/')[-1]
+        rows = resp.json()
+        return rows, int(total) if total and total != '*' else len(rows)
+
+    def count(self, table, params=None, timeout=None):
+        """Exact row count for the filters (HEAD + Content-Range, no rows transferred)."""
+        resp = self.request('HEAD', table, params=params, prefer='count=exact', timeout=timeout)
+        total = resp.headers.get('content-range', '').split('/')[-1]
+        return int(total) if total and total != '*' else 0
+
+    def insert(self, table, data, returning=True, timeout=None, retry=None):
+        """POST new row(s); returns the inserted rows when returning=True."""
+        resp = self.request(
+            'POST', table, json=data,
+            prefer='return=representation' if returning else 'return=minimal',
+            timeout=timeout, retry=retry
+        )
+        return resp.json() if returning else None
+
+    def upsert(self, table, data, on_conflict=None, returning=False, timeout=None):
+        """POST with merge-duplicates (idempotent, so retried)."""
+        prefer = 'resolution=merge-duplicates,' + ('return=representation' if returning else 'return=minimal')
+        params = {'on_conflict': on_conflict} if on_conflict else None
+        resp = self.request('POST', table, params=params, json=data, prefer=prefer, timeout=timeout, retry=True)
+        return resp.json() if returning else None
+
+    def patch(self, table, params, data, returning=False, timeout=None, retry=None):
+        """PATCH rows matching params; returns the updated rows when returning=True."""
+        resp = self.request(
+            'PATCH', table, params=params, json=data,
+            prefer='return=representation' if returning else 'return=minimal',
+            timeout=timeout, retry=retry
+        )
+        return resp.json() if returning else None
+
+    def rpc(self, function, args=None, timeout=None, retry=None):
+        """Call a Postgres function (POST /rpc/<function>); returns the decoded JSON."""
+        resp = self.request('POST', f'rpc/{function}', json=args or {}, timeout=timeout, retry=retry)
+        return resp.json() if resp.content else None
@@ -0,0 +1,171 @@
+"""
+AI technique matching against the 'techniek' embeddings in rag_documents.
+
+Shared by the Cloud Run worker, scripts/process_videos.py and
+scripts/backfill_ai_techniek_matching.py so all three give the same results:
+batched input, top-k output, best-vs-second-best margin and a configurable
+confidence threshold.
+
+The technique embeddings (~50 x 1536 floats, stored as JSON strings) are loaded once
+into an L2-normalized float32 matrix and cached in-process, so matching a transcript
+is a single matrix-vector product instead of a multi-MB download + json.loads +
+pure-Python cosine loop per job.
+
+The cache is revalidated with a cheap version query (row count + max updated_at,
+one row transferred) at most every VERSION_CHECK_SECONDS; the matrix is only
+reloaded when that version changes.
+"""
+
+import json
+import threading
+import time
+
+import numpy as np
+
+MIN_CONFIDENCE = 0.30  # Minimum 30% similarity for a valid match
+VERSION_CHECK_SECONDS = 60
+
+
+def parse_embedding(value):
+    """Embedding column value (pgvector JSON string or list) → list of floats, or None."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    return value if isinstance(value, list) and value else None
+
+
+def normalize(vectors):
+    """L2-normalize a vector or the rows of a matrix (float32); zero rows stay zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TechniqueMatrix:
+    """Normalized technique embeddings (one row per technique) plus their metadata."""
+
+    def __init__(self, rows, version=None):
+        techniques = []
+        vectors = []
+        for row in rows:
+            embedding = parse_embedding(row.get('embedding'))
+            if not embedding:
+                continue
+            if vectors and len(embedding) != len(vectors[0]):
+                continue
+            techniques.append({
+                'id': row.get('id'),
+                # Older rows only carry the number in source_id ('techniek_<nummer>')
+                'techniek_id': row.get('techniek_id') or (row.get('source_id') or '').replace('techniek_', '', 1) or None,
+                'title': row.get('title') or 'Onbekend'
+            })
+            vectors.append(embedding)
+        self.techniques = techniques
+        self.matrix = normalize(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        self.version = version
+
+    def __len__(self):
+        return len(self.techniques)
+
+    def scores(self, embeddings):
+        """
+        Cosine similarities: a single embedding gives shape (techniques,), a batch
+        (list of embeddings / 2-D array) gives shape (batch, techniques).
+        """
+        queries = normalize(embeddings)
+        if queries.shape[-1] != self.matrix.shape[1]:
+            raise ValueError(f"Embedding dimension {queries.shape[-1]} != {self.matrix.shape[1]}")
+        return queries @ self.matrix.T
+
+    def match_many(self, embeddings, top_k=3, threshold=MIN_CONFIDENCE):
+        """
+        Match a batch of embeddings in one matrix product. Per embedding returns
+            {'best': technique dict or None (below threshold),
+             'score': best score, 'margin': best - second best score,
+             'top': [{'techniek_id', 'title', 'score'}, ...] (top_k, descending)}
+        """
+        if not len(self) or not len(embeddings):
+            return [{'best': None, 'score': 0.0, 'margin': 0.0, 'top': []} for _ in embeddings]
+        scores = np.atleast_2d(self.scores(embeddings))
+        order = np.argsort(-scores, axis=1)
+        results = []
+        for row_scores, row_order in zip(scores, order):
+            best_score = float(row_scores[row_order[0]])
+            second = float(row_scores[row_order[1]]) if len(row_order) > 1 else 0.0
+            best = self.techniques[row_order[0]]
+            results.append({
+                'best': best if best_score >= threshold else None,
+                'score': best_score,
+                'margin': best_score - second,
+                'top': [
+                    {'techniek_id': self.techniques[i]['techniek_id'],
+                     'title': self.techniques[i]['title'],
+                     'score': float(row_scores[i])}
+                    for i in row_order[:max(1, top_k)]
+                ]
+            })
+        return results
+
+    def match(self, embedding, top_k=3, threshold=MIN_CONFIDENCE):
+        """match_many() for a single embedding."""
+        return self.match_many([embedding], top_k=top_k, threshold=threshold)[0]
+
+
+class TechniqueMatrixCache:
+    """
+    Process-wide cache of the TechniqueMatrix, revalidated by version.
+    `client` is a SupabaseREST instance.
+    """
+
+    def __init__(self, client, version_check_seconds=VERSION_CHECK_SECONDS):
+        self.client = client
+        self.version_check_seconds = version_check_seconds
+        self._matrix = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch_version(self):
+        rows, total = self.client.select_with_count('rag_documents', {
+            'doc_type': 'eq.techniek',
+            'select': 'updated_at',
+            'order': 'updated_at.desc.nullslast',
+            'limit': 1
+        })
+        return total, rows[0].get('updated_at') if rows else None
+
+    def _load(self, version):
+        rows = self.client.select('rag_documents', {
+            'doc_type': 'eq.techniek',
+            'select': 'id,techniek_id,source_id,title,embedding'
+        }, timeout=30)
+        matrix = TechniqueMatrix(rows, version=version)
+        print(f"[Techniek cache] Loaded {len(matrix)} technique embeddings (version: {version})")
+        return matrix
+
+    def get(self):
+        """Current TechniqueMatrix; reloads only when the version changed."""
+        with self._lock:
+            now = time.time()
+            if self._matrix is not None and now - self._checked_at < self.version_check_seconds:
+                return self._matrix
+            try:
+                version = self._fetch_version()
+            except Exception as e:
+                if self._matrix is None:
+                    raise
+                # Keep matching with the cached matrix, try again next interval
+                print(f"[Techniek cache] Version check failed, using cached matrix: {e}")
+                self._checked_at = now
+                return self._matrix
+            if self._matrix is None or self._matrix.version != version:
+                self._matrix = self._load(version)
+            self._checked_at = now
+            return self._matrix
+
+    def invalidate(self):
+        with self._lock:
+            self._matrix = None
+            self._checked_at = 0.0
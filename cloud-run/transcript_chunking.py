@@ -0,0 +1,185 @@
+"""
+Overlapping, token-bounded chunks of long transcripts for RAG.
+
+Used by the Cloud Run worker and scripts/process_videos.py instead of embedding one
+truncated string per video (the worker cut transcripts at 8000 characters, the
+script sent the full text and failed on long webinars):
+
+- sentences are packed into chunks of at most max_tokens tokens; a sentence longer
+  than that is split on word boundaries
+- consecutive chunks overlap by up to overlap_tokens tokens of whole sentences
+- with word timestamps (ElevenLabs 'words'), every chunk gets the start/end seconds
+  of its first and last word (transcript words are matched to the timestamp entries)
+- pool_embeddings() turns the chunk embeddings into one document-level vector
+  (token-weighted mean, L2-normalized) for the parent rag_documents row, so
+  technique matching keeps working on a single vector per video
+
+Chunks are stored in rag_document_chunks (scripts/sql/add_rag_document_chunks.sql).
+"""
+
+import os
+import re
+
+import numpy as np
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _ENCODING = None
+
+CHUNK_MAX_TOKENS = int(os.environ.get('RAG_CHUNK_TOKENS', '400'))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('RAG_CHUNK_OVERLAP_TOKENS', '60'))
+CHARS_PER_TOKEN_ESTIMATE = 3
+
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+NON_WORD = re.compile(r'[^\w]+')
+ALIGN_WINDOW = 8
+
+
+def count_tokens(text):
+    """Token count (tiktoken when installed, otherwise a conservative estimate)."""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+
+def _split_sentences(text, max_tokens):
+    """[(sentence, first word index, word count, tokens)] with long sentences split on words."""
+    sentences = []
+    word_index = 0
+    for sentence in SENTENCE_END.split(text.strip()):
+        words = sentence.split()
+        if not words:
+            continue
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            sentences.append((' '.join(words), word_index, len(words), tokens))
+        else:
+            # Run-on sentence (no punctuation in the transcript): cut on word boundaries
+            per_part = max(1, len(words) * max_tokens // tokens)
+            for start in range(0, len(words), per_part):
+                part = ' '.join(words[start:start + per_part])
+                sentences.append((part, word_index + start, len(words[start:start + per_part]), count_tokens(part)))
+        word_index += len(words)
+    return sentences, word_index
+
+
+def _clean_words(words):
+    """ElevenLabs word entries → [(start, end, normalized text)] for spoken words only."""
+    timed = []
+    for w in words or []:
+        if w.get('type', 'word') != 'word':
+            continue
+        start = w.get('start', w.get('start_time'))
+        end = w.get('end', w.get('end_time'))
+        if start is not None and end is not None:
+            timed.append((float(start), float(end), _normalize(w.get('text') or w.get('word') or '')))
+    return timed
+
+
+def _normalize(word):
+    return NON_WORD.sub('', word.lower())
+
+
+def _align_words(text_words, timed):
+    """
+    Index into `timed` for every transcript word. Words are matched on their text,
+    looking at most ALIGN_WINDOW timestamp entries ahead, so a missing or extra word
+    on either side does not shift the rest; an unmatched word gets the position of
+    the next timestamp. Without texts in the timestamp list, positions are scaled.
+    """
+    if not any(entry[2] for entry in timed):
+        scale = len(timed) / len(text_words)
+        return [min(int(i * scale), len(timed) - 1) for i in range(len(text_words))]
+
+    positions = []
+    cursor = 0
+    for word in text_words:
+        key = _normalize(word)
+        match = None
+        if key:
+            for i in range(cursor, min(cursor + ALIGN_WINDOW, len(timed))):
+                if timed[i][2] == key:
+                    match = i
+                    break
+        if match is not None:
+            positions.append(match)
+            cursor = match + 1
+        else:
+            positions.append(min(cursor, len(timed) - 1))
+    return positions
+
+
+def chunk_transcript(text, words=None, max_tokens=None, overlap_tokens=None):
+    """
+    Split a transcript into chunks. Returns a list of
+        {'chunk_index', 'content', 'token_count', 'start_seconds', 'end_seconds'}
+    (start/end are None without word timestamps). A short transcript gives one chunk.
+    """
+    max_tokens = max_tokens or CHUNK_MAX_TOKENS
+    overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    if not text or not text.strip():
+        return []
+
+    sentences, total_words = _split_sentences(text, max_tokens)
+    timed = _clean_words(words)
+    # Transcript words and timestamp entries rarely line up 1:1 (punctuation, events),
+    # so every transcript word is aligned to its own timestamp entry
+    positions = _align_words(text.split(), timed) if timed and total_words else None
+
+    def seconds(first_word, last_word):
+        if not positions:
+            return None, None
+        start = timed[positions[first_word]][0]
+        end = timed[positions[last_word]][1]
+        return round(start, 2), round(max(start, end), 2)
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def emit():
+        first_word = current[0][1]
+        last_word = current[-1][1] + current[-1][2] - 1
+        start, end = seconds(first_word, last_word)
+        chunks.append({
+            'chunk_index': len(chunks),
+            'content': ' '.join(s[0] for s in current),
+            'token_count': sum(s[3] for s in current),
+            'start_seconds': start,
+            'end_seconds': end,
+        })
+
+    for sentence in sentences:
+        if current and current_tokens + sentence[3] > max_tokens:
+            emit()
+            # Carry whole trailing sentences into the next chunk as overlap
+            overlap = []
+            overlap_total = 0
+            for previous in reversed(current):
+                if overlap_total + previous[3] > overlap_tokens or overlap_total + previous[3] + sentence[3] > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_total += previous[3]
+            current = overlap
+            current_tokens = overlap_total
+        current.append(sentence)
+        current_tokens += sentence[3]
+    if current:
+        emit()
+    return chunks
+
+
+def pool_embeddings(embeddings, weights=None):
+    """Weighted mean of chunk embeddings, L2-normalized (list of floats, or None)."""
+    pairs = [(e, w) for e, w in zip(embeddings, weights or [1] * len(embeddings)) if e]
+    if not pairs:
+        return None
+    matrix = np.asarray([e for e, _ in pairs], dtype=np.float32)
+    weight = np.asarray([max(w, 1) for _, w in pairs], dtype=np.float32)
+    pooled = (matrix * weight[:, None]).sum(axis=0)
+    norm = np.linalg.norm(pooled)
+    if norm == 0:
+        return None
+    return (pooled / norm).tolist()
@@ -1,8 +1,138 @@
 """
-Google Cloud Run Worker for Video Processing v8.5 (DURATION FILTER)
+Google Cloud Run Worker for Video Processing v10.3 (PRIORITY SCHEDULING)
 Full pipeline: chromakey → audio → transcript → RAG → AI Technique Match → Mux
 Now with Cloud Tasks-based batch processing for 300+ videos
 
+v10.3 Changes (Priority scheduling):
+- Jobs have a priority (higher is claimed first) and an estimated cost job_cost()
+  (probed duration, else Drive file size; scripts/sql/add_job_priority.sql)
+- Per-batch scheduling policy, stored in video_batch_state and applied by dispatch_jobs:
+  fifo (oldest first), sjf (shortest estimated job first, so one 4 GB file no longer
+  blocks dozens of short clips) or fair (weighted round robin over drive_folder_id)
+- POST /batch/start accepts {"policy", "folder_weights", "priorities"}; the default
+  policy comes from BATCH_SCHEDULING_POLICY (fifo)
+
+v10.2 Changes (Retry backoff and dead-letter):
+- Every claim increments attempt_count (scripts/sql/add_job_retry_backoff.sql). A failed
+  job is no longer picked up again by the very next task: fail_job() classifies the
+  error, transient failures wait JOB_RETRY_BASE_SECONDS * 2^(attempt - 1) (capped at
+  JOB_RETRY_MAX_SECONDS) via next_attempt_at, which dispatch respects
+- Permanent failures (missing/inaccessible Drive file, unreadable video) and jobs that
+  used up JOB_MAX_ATTEMPTS (default 5) go to 'dead_letter' and are never claimed again;
+  watchdog resets count as a failed attempt
+- When every remaining job is backing off, the next task is scheduled for the first
+  retry instead of every BATCH_INTERVAL_SECONDS; /batch/status reports dead_letter/backoff
+
+v10.1 Changes (Job leases):
+- Claimed jobs carry a lease (lease_owner, lease_expires_at; scripts/sql/add_job_leases.sql)
+  that a LeaseKeeper thread extends every JOB_LEASE_SECONDS / 3 for all jobs this
+  instance holds (one PATCH), also during long ffmpeg runs without status updates
+- The watchdog recovers jobs by lease expiry: a slow encode is never reset and run
+  twice, a dead instance's jobs are free again after JOB_LEASE_SECONDS (default 90).
+  Jobs without a lease keep the STALE_JOB_THRESHOLD_MINUTES rule
+- Terminal statuses clear the lease; without the lease columns nothing changes
+
+v10.0 Changes (Bulk watchdog):
+- cleanup_stale_jobs() resets all stale jobs in one conditional PATCH (transitional
+  status AND updated_at < cutoff AND not archief) returning the affected ids, instead
+  of a GET plus one PATCH per job
+- The watchdog no longer runs before every job: schedule POST /batch/watchdog (Cloud
+  Scheduler); dispatches only recover stale jobs in-process once per
+  WATCHDOG_INTERVAL_SECONDS (default 60, 0 = only via /batch/watchdog)
+
+v9.9 Changes (Single-RPC dispatch):
+- dispatch_jobs() replaces watchdog + batch state + next-job lookup + claim + counter
+  update + pending counts with one dispatch_jobs RPC (scripts/sql/add_dispatch_jobs.sql):
+  stale jobs are recovered, finished-job counters added and the next job(s) claimed
+  with FOR UPDATE SKIP LOCKED in one transaction, returning the remaining count
+- /batch/process-next: one round trip to get a job, one to record its result and
+  decide on the next task; slots and the prefetcher claim through the same function
+- Without the RPC (404) the worker uses the previous REST sequence
+
+v9.8 Changes (Batch status snapshot):
+- /batch/status counts come from one grouped query (job_status_counts RPC,
+  scripts/sql/add_job_status_counts.sql) instead of downloading the status of every
+  job plus two count queries; without the RPC: parallel HEAD count=exact requests
+- The counts are cached in-process for BATCH_STATUS_TTL_SECONDS (default 5), so
+  admin UI polling costs at most one query per interval regardless of table size
+
+v9.7 Changes (RAG writer):
+- save_to_rag() is one upsert on source_id 'video_<job_id>' (rag_writer.py) instead of
+  GET + POST (+ GET again on 409); requires scripts/sql/add_rag_documents_source_id_unique.sql
+
+v9.6 Changes (Chunked transcript embeddings):
+- Transcripts are no longer cut at 8000 characters: transcript_chunking.py splits them
+  into overlapping token-bounded chunks on sentence / word-timestamp boundaries
+- All chunks are embedded through embedding_batcher.EmbeddingBatcher and stored in
+  rag_document_chunks (scripts/sql/add_rag_document_chunks.sql) with start/end seconds
+- The parent rag_documents row keeps a pooled (token-weighted mean) vector, which is
+  also what technique matching uses; RAG_CHUNKING=0 restores the single embedding
+
+v9.5 Changes (Embedding cache):
+- generate_embedding() goes through a content-addressed SQLite cache on local disk
+  (embedding_cache.py, shared with the scripts): sha256(model + dimensions + text)
+- Retried jobs reuse the embedding of an unchanged transcript instead of calling OpenAI
+- LRU eviction above EMBEDDING_CACHE_MAX_MB; hit/miss counters in GET /metrics
+
+v9.4 Changes (Shared technique matcher):
+- Worker, scripts/process_videos.py and the backfill script use the same matcher
+  (technique_matching.TechniqueMatrix.match/match_many): batched input, top-k
+  candidates and the best-vs-second-best margin are logged per match
+- Confidence threshold configurable via TECHNIEK_MIN_CONFIDENCE (default 0.30)
+
+v9.3 Changes (Technique matching):
+- Technique embeddings are loaded once into a normalized float32 numpy matrix and
+  cached per process (technique_matching.py); matching is one matrix-vector product
+- The cache is revalidated with a one-row version query (count + max updated_at)
+  at most once a minute instead of downloading all embeddings for every job
+
+v9.2 Changes (Progress writer):
+- update_progress() and pipeline step statuses are buffered per job by a background
+  ProgressWriter and merged into one PATCH per PROGRESS_FLUSH_SECONDS (default 5s)
+- Terminal/conditional statuses (completed, failed, pending, prefetched, ...) are
+  written immediately together with the buffered fields for that job
+- Failed/dropped writes are counted instead of silently swallowed: GET /metrics
+
+v9.1 Changes (Pooled Supabase client):
+- All Supabase REST calls go through one SupabaseREST client (supabase_rest.py):
+  keep-alive connection pool, auth headers built once, default timeouts and
+  bounded retries with backoff instead of a fresh requests.get/patch per call
+- Job/archief counts use HEAD + count=exact (no rows transferred)
+- Conditional claims are never retried (a replayed claim would look "already claimed")
+
+v9.0 Changes (Segment-parallel chromakey):
+- CHROMAKEY_SEGMENTS=N: split input.mp4 at keyframes into N parts, key + encode them
+  in N parallel ffmpeg processes and concat them without re-encoding
+- Audio is muxed from the original file in the concat pass (no gaps at part boundaries)
+- Any failure in the segmented path falls back to the single full encode
+
+v8.9 Changes (Single decode):
+- The chromakey ffmpeg run also writes audio.mp3 as a second output, so input.mp4
+  is decoded once instead of twice (also in streaming mode)
+- Step 3 only runs a separate audio extraction if the chromakey pass produced no audio
+
+v8.8 Changes (Streaming chromakey):
+- STREAMING_CHROMAKEY=1: the Drive byte stream is teed into ffmpeg (pipe:0) so the
+  chromakey encode runs while the download is still in progress
+- The full file is still written to input.mp4 for the duration check, audio step and
+  as fallback: non-faststart files (moov at end) or a failed stream re-encode from disk
+- Chromakey command/background selection factored into build_chromakey_cmd(),
+  apply_chromakey() and select_background()
+
+v8.7 Changes (Download prefetch):
+- PREFETCH_QUEUE_SIZE env var: claim and download the next job(s) while the current
+  job is in chromakey/Mux, so network and CPU time overlap
+- Staged downloads live in PREFETCH_DIR and are bounded by PREFETCH_DISK_BUDGET_MB
+- New transitional status 'cloud_prefetched' (downloaded, waiting for a free slot)
+- Unused prefetched jobs are released back to 'pending' when the batch task ends
+
+v8.6 Changes (Multi-slot execution):
+- WORKER_SLOTS env var: run up to N pipelines concurrently per /batch/process-next
+- Jobs are claimed in one conditional PATCH (only rows still pending are claimed)
+- Each job runs in its own process with its own temp dir
+- A slot is refilled as soon as a job finishes (until SLOT_REFILL_BUDGET_SECONDS)
+- WORKER_SLOTS=1 (default) keeps the original one-job-per-task behaviour
+
 v8.5 Changes (Duration Filter):
 - Added minimum 30-second duration filter after download
 - Videos < 30 seconds are marked 'skipped_too_short' and not processed
@@ -44,15 +174,30 @@ v8.0 Changes:
 import os
 import json
 import tempfile
+import shutil
 import subprocess
+import queue
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import time
 import threading
 import ssl
-from datetime import datetime, timedelta
+import socket
+import uuid
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request, jsonify
+from supabase_rest import SupabaseREST, SupabaseError
+from technique_matching import MIN_CONFIDENCE, TechniqueMatrixCache
+from embedding_cache import get_default_cache
+from embedding_batcher import EmbeddingBatcher
+from transcript_chunking import chunk_transcript, pool_embeddings
+from rag_writer import upsert_rag_documents
+from chromakey_segments import probe_duration, render_keyed_segments
 import mux_python
 
 try:
@@ -68,9 +213,24 @@ app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # SEC-011: 10MB max (JSON p
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
+# Pooled PostgREST client (keep-alive, default timeouts, retries) for all Supabase calls
+db = SupabaseREST(SUPABASE_URL, SUPABASE_KEY)
+# Technique embeddings as a cached, normalized numpy matrix (reloaded on version change)
+technique_cache = TechniqueMatrixCache(db)
+TECHNIEK_MIN_CONFIDENCE = float(os.environ.get('TECHNIEK_MIN_CONFIDENCE', str(MIN_CONFIDENCE)))
 MUX_TOKEN_ID = os.environ.get('MUX_TOKEN_ID')
 MUX_TOKEN_SECRET = os.environ.get('MUX_TOKEN_SECRET')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+EMBEDDING_MODEL = 'text-embedding-3-small'
+# Content-addressed embedding cache on local disk (retried jobs don't re-embed). Cloud Run's
+# filesystem is in memory and not shared between instances, so the worker defaults to a small
+# cache in /tmp that doesn't compete with the video files for RAM (inherited by slot processes)
+os.environ.setdefault('EMBEDDING_CACHE_PATH', '/tmp/embedding_cache.sqlite')
+os.environ.setdefault('EMBEDDING_CACHE_MAX_MB', '32')
+embedding_cache = get_default_cache()
+# RAG_CHUNKING=1: embed transcripts as overlapping token-bounded chunks (rag_document_chunks)
+# with a pooled parent vector; 0 = one embedding of the first 8000 characters
+RAG_CHUNKING = os.environ.get('RAG_CHUNKING', '1') == '1'
 ELEVENLABS_API_KEY = os.environ.get('ELEVENLABS_API_KEY')
 WORKER_SECRET = os.environ.get('WORKER_SECRET')
 
@@ -92,10 +252,64 @@ def get_cloud_run_url():
 
 BATCH_INTERVAL_SECONDS = 30  # Changed from 3 min to 30s - schedule AFTER job completion
 STALE_JOB_THRESHOLD_MINUTES = 15  # Jobs stuck in transitional states for >15 min are considered stale
+# The watchdog runs on its own schedule (POST /batch/watchdog); dispatches only reset stale
+# jobs themselves if this instance has not run it for this many seconds (0 = never)
+WATCHDOG_INTERVAL_SECONDS = float(os.environ.get('WATCHDOG_INTERVAL_SECONDS', '60'))
+# Claimed jobs are leased to this instance and the lease is extended every third of it;
+# an expired lease means the instance died (jobs without a lease use the threshold above)
+JOB_LEASE_SECONDS = max(15, int(os.environ.get('JOB_LEASE_SECONDS', '90')))
+# Inherited by spawned slot processes, so every process of this instance uses the same owner
+LEASE_OWNER = os.environ.setdefault('WORKER_LEASE_OWNER', f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}")
+# Retry backoff: a transiently failed job waits BASE * 2^(attempt - 1) seconds (capped at MAX)
+# before it can be claimed again; permanent failures and the last attempt go to 'dead_letter'
+JOB_MAX_ATTEMPTS = max(1, int(os.environ.get('JOB_MAX_ATTEMPTS', '5')))
+JOB_RETRY_BASE_SECONDS = max(0, int(os.environ.get('JOB_RETRY_BASE_SECONDS', '300')))
+JOB_RETRY_MAX_SECONDS = max(JOB_RETRY_BASE_SECONDS, int(os.environ.get('JOB_RETRY_MAX_SECONDS', '21600')))
+# Order in which waiting jobs are claimed (higher priority always first):
+#   fifo = oldest first, sjf = shortest estimated job first (duration / Drive file size),
+#   fair = weighted round robin over drive_folder_id. POST /batch/start {"policy": ...} overrides it
+SCHEDULING_POLICIES = ('fifo', 'sjf', 'fair')
+BATCH_SCHEDULING_POLICY = os.environ.get('BATCH_SCHEDULING_POLICY', 'fifo').lower()
+if BATCH_SCHEDULING_POLICY not in SCHEDULING_POLICIES:
+    print(f"WARNING: unknown BATCH_SCHEDULING_POLICY '{BATCH_SCHEDULING_POLICY}', using fifo")
+    BATCH_SCHEDULING_POLICY = 'fifo'
+# Drive 403 reasons (error.errors[].reason): only missing permissions are permanent;
+# rate limits are retried in the download, quota errors (downloadQuotaExceeded) fail
+# the attempt as transient so the job backs off
+DRIVE_PERMISSION_REASONS = {
+    'forbidden', 'insufficientFilePermissions', 'insufficientPermissions',
+    'appNotAuthorizedToFile', 'cannotDownloadAbusiveFile', 'domainPolicy',
+}
+DRIVE_RATE_LIMIT_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded'}
+# Lower-cased error fragments that retrying cannot fix (broken/unreadable source, no access)
+PERMANENT_FAILURE_PATTERNS = (
+    'missing drive_file_id',
+    'access denied to file',
+    '404 client error',
+    'file not found',
+    'invalid data found when processing input',
+    'moov atom not found',
+    'does not contain any stream',
+)
+
+# Multi-slot execution: number of pipelines that run concurrently per batch task.
+# Each slot is a separate process (libx264 already uses several threads per encode),
+# so 2-3 slots is a good fit for a 4-8 vCPU instance.
+WORKER_SLOTS = max(1, int(os.environ.get('WORKER_SLOTS', '1')))
+# Stop claiming new jobs after this many seconds so running jobs finish within the
+# Cloud Run request timeout (3600s); the next Cloud Task picks up where we left off.
+SLOT_REFILL_BUDGET_SECONDS = int(os.environ.get('SLOT_REFILL_BUDGET_SECONDS', '2400'))
+
+# Prefetch: number of upcoming jobs that may be claimed + downloaded ahead of time
+# (0 = disabled). Staged files are limited by a disk budget on the /tmp volume.
+PREFETCH_QUEUE_SIZE = max(0, int(os.environ.get('PREFETCH_QUEUE_SIZE', '0')))
+PREFETCH_DISK_BUDGET_MB = int(os.environ.get('PREFETCH_DISK_BUDGET_MB', '8192'))
+PREFETCH_DIR = os.environ.get('PREFETCH_DIR', '/tmp/prefetch')
 
 # Transitional states that indicate a job is actively being processed
 TRANSITIONAL_STATES = [
     'cloud_downloading',
+    'cloud_prefetched',
     'cloud_chromakey', 
     'cloud_uploading',
     'external_processing',
@@ -109,6 +323,24 @@ TRANSITIONAL_STATES = [
 ]
 BATCH_STATE_FILE = '/tmp/batch_state.json'
 
+# /batch/status job counts are served from an in-process snapshot this many seconds old at most
+BATCH_STATUS_TTL_SECONDS = float(os.environ.get('BATCH_STATUS_TTL_SECONDS', '5'))
+
+# Pipeline step statuses + progress messages are buffered per job and written in one
+# PATCH per flush interval (0 = write every update synchronously, the old behaviour).
+# Any other status (claims, completed, failed, released...) is written immediately.
+PROGRESS_FLUSH_SECONDS = float(os.environ.get('PROGRESS_FLUSH_SECONDS', '5'))
+BUFFERED_STATUSES = set(TRANSITIONAL_STATES) - {'external_processing', 'cloud_prefetched'}
+
+# Streaming chromakey: tee the Drive download into ffmpeg so keying starts while the
+# file is still arriving (only for faststart MP4s, others fall back to download-then-encode)
+STREAMING_CHROMAKEY = os.environ.get('STREAMING_CHROMAKEY', '0') == '1'
+
+# Segment-parallel chromakey: split input.mp4 at keyframes into N parts, key + encode
+# each part in its own ffmpeg process and concat losslessly (0/1 = single encode).
+# Needs the whole file on disk, so it takes precedence over STREAMING_CHROMAKEY.
+CHROMAKEY_SEGMENTS = max(0, int(os.environ.get('CHROMAKEY_SEGMENTS', '0')))
+
 CHROMAKEY_SIMILARITY = 0.29
 CHROMAKEY_BLEND = 0.10
 
@@ -151,25 +383,18 @@ def get_batch_state():
     """Get batch_active state from Supabase or fallback to file"""
     if SUPABASE_URL and SUPABASE_KEY:
         try:
-            resp = requests.get(
-                f'{SUPABASE_URL}/rest/v1/video_batch_state?select=*&limit=1',
-                headers={
-                    'apikey': SUPABASE_KEY,
-                    'Authorization': f'Bearer {SUPABASE_KEY}'
-                },
-                timeout=10
-            )
-            if resp.status_code == 200:
-                data = resp.json()
-                if data:
-                    state = data[0]
-                    return {
-                        'batch_active': state.get('batch_active', False),
-                        'started_at': state.get('started_at'),
-                        'total_jobs': state.get('total_jobs', 0),
-                        'processed_jobs': state.get('processed_jobs', 0),
-                        'failed_jobs': state.get('failed_jobs', 0)
-                    }
+            data = db.select('video_batch_state', {'select': '*', 'limit': 1})
+            if data:
+                state = data[0]
+                return {
+                    'batch_active': state.get('batch_active', False),
+                    'started_at': state.get('started_at'),
+                    'total_jobs': state.get('total_jobs', 0),
+                    'processed_jobs': state.get('processed_jobs', 0),
+                    'failed_jobs': state.get('failed_jobs', 0),
+                    'scheduling_policy': state.get('scheduling_policy') or 'fifo',
+                    'folder_weights': state.get('folder_weights') or {}
+                }
         except Exception as e:
             print(f"Supabase batch state error: {e}")
     
@@ -198,19 +423,8 @@ def set_batch_state(batch_active, **kwargs):
             }
             data.update(kwargs)
             
-            resp = requests.post(
-                f'{SUPABASE_URL}/rest/v1/video_batch_state',
-                json=data,
-                headers={
-                    'apikey': SUPABASE_KEY,
-                    'Authorization': f'Bearer {SUPABASE_KEY}',
-                    'Content-Type': 'application/json',
-                    'Prefer': 'resolution=merge-duplicates'
-                },
-                timeout=10
-            )
-            if resp.status_code in [200, 201]:
-                print(f"Batch state updated in Supabase: batch_active={batch_active}")
+            db.upsert('video_batch_state', data)
+            print(f"Batch state updated in Supabase: batch_active={batch_active}")
         except Exception as e:
             print(f"Supabase batch state update error: {e}")
     
@@ -234,50 +448,105 @@ def get_pending_jobs_count():
     
     # Count regular pending/failed jobs
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs?select=id&status=in.(pending,failed,chromakey_failed)&drive_folder_id=neq.{ARCHIEF_FOLDER_ID}",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Prefer': 'count=exact'
-            },
-            timeout=10
-        )
-        if resp.status_code == 200:
-            header_count = resp.headers.get('content-range', '').split('/')[-1]
-            count = int(header_count) if header_count and header_count != '*' else len(resp.json())
+        count = db.count('video_ingest_jobs', {
+            'select': 'id',
+            'status': 'in.(pending,failed,chromakey_failed)',
+            'drive_folder_id': f'neq.{ARCHIEF_FOLDER_ID}'
+        })
     except Exception as e:
         print(f"Error getting pending jobs count: {e}")
     
     # Also count stuck jobs that will be recovered by watchdog
     try:
-        states_param = ','.join(TRANSITIONAL_STATES)
-        cutoff_time = (datetime.utcnow() - timedelta(minutes=STALE_JOB_THRESHOLD_MINUTES)).isoformat()
-        
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs?select=id&status=in.({states_param})&updated_at=lt.{cutoff_time}&drive_folder_id=neq.{ARCHIEF_FOLDER_ID}",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Prefer': 'count=exact'
-            },
-            timeout=10
-        )
-        if resp.status_code == 200:
-            header_count = resp.headers.get('content-range', '').split('/')[-1]
-            stuck_count = int(header_count) if header_count and header_count != '*' else len(resp.json())
-            if stuck_count > 0:
-                print(f"[Watchdog] Found {stuck_count} stuck jobs that will be recovered")
-            count += stuck_count
+        stuck_count = db.count('video_ingest_jobs', {'select': 'id', **stale_job_filter()})
+        if stuck_count > 0:
+            print(f"[Watchdog] Found {stuck_count} stuck jobs that will be recovered")
+        count += stuck_count
     except Exception as e:
         print(f"Error getting stuck jobs count: {e}")
     
     return count
 
 
+def fetch_job_status_counts():
+    """
+    All /batch/status counters in one grouped query (job_status_counts RPC).
+    Falls back to parallel HEAD count=exact requests when the RPC is not installed.
+    Returns {'completed', 'failed', 'dead_letter', 'processing', 'pending', 'backoff', 'stuck'}.
+    """
+    cutoff_time = (datetime.utcnow() - timedelta(minutes=STALE_JOB_THRESHOLD_MINUTES)).isoformat()
+    try:
+        return db.rpc('job_status_counts', {
+            'archief_folder_id': ARCHIEF_FOLDER_ID,
+            'transitional_states': TRANSITIONAL_STATES,
+            'stale_before': cutoff_time
+        })
+    except SupabaseError as e:
+        if e.status_code != 404:
+            raise
+    
+    not_archief = f'neq.{ARCHIEF_FOLDER_ID}'
+    queries = {
+        'completed': {'status': 'eq.completed'},
+        'failed': {'status': 'in.(cloud_failed,failed,chromakey_failed)'},
+        'processing': {'status': 'eq.external_processing'},
+        'pending': {'status': 'in.(pending,failed,chromakey_failed)', 'drive_folder_id': not_archief},
+        'stuck': stale_job_filter(),
+    }
+    if retry_supported():
+        queries['dead_letter'] = {'status': 'eq.dead_letter'}
+        queries['backoff'] = {**queries['pending'], 'next_attempt_at': f'gt.{datetime.utcnow().isoformat()}'}
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        futures = {
+            name: pool.submit(db.count, 'video_ingest_jobs', {'select': 'id', **params})
+            for name, params in queries.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+class StatusSnapshot:
+    """
+    Job counts for /batch/status, refreshed at most once per `ttl` seconds.
+    One request refreshes while concurrent pollers wait for it; a failed refresh
+    keeps serving the previous counts (with their real fetch time) and is retried
+    after RETRY_SECONDS instead of on every poll.
+    """
+    
+    RETRY_SECONDS = 5
+    
+    def __init__(self, fetch, ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self._counts = None
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self):
+        """(counts, unix time they were fetched); counts is None if never fetched"""
+        with self._lock:
+            now = time.time()
+            if self._counts is not None and (now - self._fetched_at < self.ttl or now < self._retry_at):
+                return self._counts, self._fetched_at
+            try:
+                self._counts = self.fetch()
+            except Exception as e:
+                print(f"Error getting job counts: {e}")
+                self._retry_at = now + min(self.RETRY_SECONDS, self.ttl)
+                if self._counts is None:
+                    return None, 0.0
+                return self._counts, self._fetched_at
+            self._fetched_at = now
+            return self._counts, self._fetched_at
+
+
+status_snapshot = StatusSnapshot(fetch_job_status_counts, BATCH_STATUS_TTL_SECONDS)
+
+
 def cleanup_stale_jobs():
     """
-    Watchdog function: Find and reset jobs stuck in transitional states for >15 minutes.
+    Watchdog function: reset jobs in transitional states whose lease expired (or, without
+    a lease, that were not updated for >15 minutes) back to pending.
     This enables self-healing batch processing - crashed jobs are automatically recovered.
     
     Returns: count of reset jobs
@@ -287,117 +556,106 @@ def cleanup_stale_jobs():
         return 0
     
     print("\n[Watchdog] Checking for stale jobs stuck in transitional states...")
+    mark_watchdog_run()
     
-    # Calculate cutoff time (15 minutes ago)
-    cutoff_time = (datetime.utcnow() - timedelta(minutes=STALE_JOB_THRESHOLD_MINUTES)).isoformat()
-    states_param = ','.join(TRANSITIONAL_STATES)
-    
-    reset_count = 0
+    now = datetime.utcnow().isoformat()
+    data = {
+        'status': 'pending',
+        'error_message': f"[Watchdog Reset] Job lease expired / no update for >{STALE_JOB_THRESHOLD_MINUTES} min. Auto-reset at {now}",
+        'updated_at': now
+    }
+    if leases_supported():
+        data.update({'lease_owner': None, 'lease_expires_at': None})
+    if retry_supported():
+        # One value for all rows: the first backoff step (jobs out of attempts are
+        # dead-lettered when they are next claimed)
+        data.update({
+            'failure_kind': 'transient',
+            'next_attempt_at': (datetime.utcnow() + timedelta(seconds=JOB_RETRY_BASE_SECONDS)).isoformat()
+        })
     
     try:
-        # Find jobs in transitional states with updated_at older than cutoff
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs"
-            f"?status=in.({states_param})"
-            f"&updated_at=lt.{cutoff_time}"
-            f"&drive_folder_id=neq.{ARCHIEF_FOLDER_ID}"
-            f"&select=id,status,drive_file_name,updated_at",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}'
-            },
-            timeout=15
+        # One conditional bulk update; the filter is re-evaluated per row, so a job that
+        # extended its lease in the meantime is not reset (and a retried PATCH is harmless)
+        reset_jobs = db.patch(
+            'video_ingest_jobs',
+            {**stale_job_filter(), 'select': 'id,drive_file_name'},
+            data,
+            returning=True,
+            timeout=30
         )
-        
-        if resp.status_code != 200:
-            print(f"[Watchdog] Error fetching stale jobs: {resp.status_code} - {resp.text[:200]}")
-            return 0
-        
-        stale_jobs = resp.json()
-        
-        if not stale_jobs:
-            print("[Watchdog] No stale jobs found - all clear!")
-            return 0
-        
-        print(f"[Watchdog] Found {len(stale_jobs)} stale jobs to reset:")
-        
-        for job in stale_jobs:
-            job_id = job['id']
-            old_status = job.get('status', 'unknown')
-            file_name = job.get('drive_file_name', 'unknown')
-            updated_at = job.get('updated_at', 'unknown')
-            
-            print(f"[Watchdog]   - {job_id}: {file_name} (was: {old_status}, stuck since: {updated_at})")
-            
-            # Reset job to pending with error message
-            error_msg = f"[Watchdog Reset] Job was stuck in '{old_status}' state for >{STALE_JOB_THRESHOLD_MINUTES} min. Auto-reset at {datetime.utcnow().isoformat()}"
-            
-            patch_resp = requests.patch(
-                f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}',
-                json={
-                    'status': 'pending',
-                    'error_message': error_msg,
-                    'updated_at': datetime.utcnow().isoformat()
-                },
-                headers={
-                    'apikey': SUPABASE_KEY,
-                    'Authorization': f'Bearer {SUPABASE_KEY}',
-                    'Content-Type': 'application/json',
-                    'Prefer': 'return=minimal'
-                },
-                timeout=10
-            )
-            
-            if patch_resp.status_code in [200, 204]:
-                reset_count += 1
-                print(f"[Watchdog]     ✅ Reset to pending")
-            else:
-                print(f"[Watchdog]     ❌ Failed to reset: {patch_resp.status_code}")
-        
-        print(f"[Watchdog] ✅ Reset {reset_count}/{len(stale_jobs)} stale jobs to pending")
-        
     except Exception as e:
         print(f"[Watchdog] Error during cleanup: {e}")
-        import traceback
-        traceback.print_exc()
+        return 0
     
-    return reset_count
+    if not reset_jobs:
+        print("[Watchdog] No stale jobs found - all clear!")
+        return 0
+    
+    for job in reset_jobs:
+        print(f"[Watchdog]   - {job['id']}: {job.get('drive_file_name', 'unknown')}")
+    print(f"[Watchdog] ✅ Reset {len(reset_jobs)} stale jobs to pending")
+    return len(reset_jobs)
+
+
+_watchdog_lock = threading.Lock()
+_watchdog_last_run = 0.0
+
+
+def mark_watchdog_run():
+    global _watchdog_last_run
+    with _watchdog_lock:
+        _watchdog_last_run = time.time()
+
+
+def watchdog_due():
+    """True (and marked as run) if this instance should reset stale jobs inline now"""
+    global _watchdog_last_run
+    if WATCHDOG_INTERVAL_SECONDS <= 0:
+        return False
+    with _watchdog_lock:
+        if time.time() - _watchdog_last_run < WATCHDOG_INTERVAL_SECONDS:
+            return False
+        _watchdog_last_run = time.time()
+        return True
 
 
-def get_next_pending_job():
-    """Get the oldest pending job that needs processing (excludes archief folder)"""
+def get_next_pending_jobs(limit=1, policy='fifo'):
+    """Get the next pending jobs that need processing (excludes archief folder): highest
+    priority first, then oldest first, or shortest first for policy 'sjf'. 'fair' needs the
+    dispatch_jobs RPC; this REST lookup treats it as 'fifo'."""
     if not SUPABASE_URL or not SUPABASE_KEY:
         print("No Supabase credentials for job lookup")
-        return None
+        return []
+    
+    params = {
+        'status': 'in.(pending,failed,chromakey_failed)',
+        'drive_folder_id': f'neq.{ARCHIEF_FOLDER_ID}',
+        'order': 'created_at.asc',
+        'limit': limit,
+        'select': 'id,drive_file_id,status,drive_file_name,created_at'
+    }
+    if scheduling_supported():
+        # job_cost is a computed column (scripts/sql/add_job_priority.sql)
+        params['order'] = 'priority.desc,job_cost.asc.nullslast,created_at.asc' if policy == 'sjf' else 'priority.desc,created_at.asc'
+    if retry_supported():
+        # Skip jobs that are still backing off after a failed attempt
+        params['or'] = f'(next_attempt_at.is.null,next_attempt_at.lte."{datetime.utcnow().isoformat()}")'
+        params['select'] += ',attempt_count,error_message'
     
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs"
-            f"?status=in.(pending,failed,chromakey_failed)"
-            f"&drive_folder_id=neq.{ARCHIEF_FOLDER_ID}"
-            f"&order=created_at.asc"
-            f"&limit=1"
-            f"&select=id,drive_file_id,status,drive_file_name,created_at",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}'
-            },
-            timeout=15
-        )
-        if resp.status_code == 200:
-            jobs = resp.json()
-            if jobs:
-                job = jobs[0]
+        jobs = db.select('video_ingest_jobs', params, timeout=15)
+        if jobs:
+            for job in jobs:
                 print(f"Found pending job: {job['id']} ({job.get('drive_file_name', 'unknown')}) - status: {job['status']}")
-                return job
-            else:
-                print("No pending jobs found (archief excluded)")
-                return None
         else:
-            print(f"Error fetching pending jobs: {resp.status_code} - {resp.text[:200]}")
+            print("No pending jobs found (archief excluded)")
+        return jobs
+    except SupabaseError as e:
+        print(f"Error fetching pending jobs: {e}")
     except Exception as e:
         print(f"Error getting next pending job: {e}")
-    return None
+    return []
 
 
 def get_pending_archief_jobs_count():
@@ -406,23 +664,12 @@ def get_pending_archief_jobs_count():
         return 0
     
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs"
-            f"?select=id"
-            f"&drive_folder_id=eq.{ARCHIEF_FOLDER_ID}"
-            f"&transcript=is.null"
-            f"&status=neq.archived_transcribed",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Prefer': 'count=exact'
-            },
-            timeout=10
-        )
-        if resp.status_code == 200:
-            header_count = resp.headers.get('content-range', '').split('/')[-1]
-            count = int(header_count) if header_count and header_count != '*' else len(resp.json())
-            return count
+        return db.count('video_ingest_jobs', {
+            'select': 'id',
+            'drive_folder_id': f'eq.{ARCHIEF_FOLDER_ID}',
+            'transcript': 'is.null',
+            'status': 'neq.archived_transcribed'
+        })
     except Exception as e:
         print(f"Error getting pending archief jobs count: {e}")
     return 0
@@ -435,72 +682,221 @@ def get_next_pending_archief_job():
         return None
     
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/video_ingest_jobs"
-            f"?drive_folder_id=eq.{ARCHIEF_FOLDER_ID}"
-            f"&transcript=is.null"
-            f"&status=neq.archived_transcribed"
-            f"&order=created_at.asc"
-            f"&limit=1"
-            f"&select=id,drive_file_id,status,drive_file_name,created_at",
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}'
-            },
-            timeout=15
-        )
-        if resp.status_code == 200:
-            jobs = resp.json()
-            if jobs:
-                job = jobs[0]
-                print(f"[Archief] Found pending job: {job['id']} ({job.get('drive_file_name', 'unknown')})")
-                return job
-            else:
-                print("[Archief] No pending archief jobs found")
-                return None
+        jobs = db.select('video_ingest_jobs', {
+            'drive_folder_id': f'eq.{ARCHIEF_FOLDER_ID}',
+            'transcript': 'is.null',
+            'status': 'neq.archived_transcribed',
+            'order': 'created_at.asc',
+            'limit': 1,
+            'select': 'id,drive_file_id,status,drive_file_name,created_at'
+        }, timeout=15)
+        if jobs:
+            job = jobs[0]
+            print(f"[Archief] Found pending job: {job['id']} ({job.get('drive_file_name', 'unknown')})")
+            return job
         else:
-            print(f"[Archief] Error fetching jobs: {resp.status_code} - {resp.text[:200]}")
+            print("[Archief] No pending archief jobs found")
+            return None
+    except SupabaseError as e:
+        print(f"[Archief] Error fetching jobs: {e}")
     except Exception as e:
         print(f"[Archief] Error getting next job: {e}")
     return None
 
 
-def claim_job(job_id):
+def claim_job(job_id, from_statuses='pending,failed,chromakey_failed'):
     """Atomically claim a job by updating status to external_processing"""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return False
     
     try:
-        resp = requests.patch(
-            f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}&status=in.(pending,failed,chromakey_failed)',
-            json={
+        # Conditional PATCH: never retried, a replay would look like "already claimed"
+        updated = db.patch(
+            'video_ingest_jobs',
+            {'id': f'eq.{job_id}', 'status': f'in.({from_statuses})'},
+            {
                 'status': 'external_processing',
-                'error_message': f'Claimed at {datetime.utcnow().isoformat()}'
-            },
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=representation'
+                'error_message': f'Claimed at {datetime.utcnow().isoformat()}',
+                **lease_fields()
             },
-            timeout=10
+            returning=True,
+            retry=False
         )
-        if resp.status_code == 200:
-            updated = resp.json()
-            if updated:
-                print(f"[{job_id}] ✅ Job claimed (status → external_processing)")
-                return True
-            else:
-                print(f"[{job_id}] ❌ Job already claimed by another worker")
-                return False
+        if updated:
+            print(f"[{job_id}] ✅ Job claimed (status → external_processing)")
+            lease_keeper.hold([job_id])
+            return True
         else:
-            print(f"[{job_id}] ❌ Claim failed: {resp.status_code}")
+            print(f"[{job_id}] ❌ Job already claimed by another worker")
             return False
+    except SupabaseError as e:
+        print(f"[{job_id}] ❌ Claim failed: {e.status_code}")
+        return False
     except Exception as e:
         print(f"[{job_id}] ❌ Claim error: {e}")
         return False
 
 
+def claim_jobs(job_ids):
+    """Atomically claim several jobs in one conditional PATCH.
+    Only rows that are still pending/failed are updated, so jobs grabbed by another
+    worker in the meantime are simply not returned. Returns the list of claimed ids."""
+    if not SUPABASE_URL or not SUPABASE_KEY or not job_ids:
+        return []
+    
+    ids_param = ','.join(job_ids)
+    data = {
+        'status': 'external_processing',
+        'error_message': f'Claimed at {datetime.utcnow().isoformat()}',
+        'updated_at': datetime.utcnow().isoformat(),
+        **lease_fields()
+    }
+    if scheduling_supported():
+        data['claimed_at'] = data['updated_at']
+    try:
+        rows = db.patch(
+            'video_ingest_jobs',
+            {'id': f'in.({ids_param})', 'status': 'in.(pending,failed,chromakey_failed)', 'select': 'id'},
+            data,
+            returning=True,
+            retry=False
+        )
+        claimed = [row['id'] for row in rows]
+        lease_keeper.hold(claimed)
+        print(f"✅ Claimed {len(claimed)}/{len(job_ids)} jobs (status → external_processing)")
+        return claimed
+    except SupabaseError as e:
+        print(f"❌ Bulk claim failed: {e}")
+    except Exception as e:
+        print(f"❌ Bulk claim error: {e}")
+    return []
+
+
+def claim_next_jobs(count):
+    """Find and claim up to `count` pending jobs. Returns the claimed job rows."""
+    if count <= 0:
+        return []
+    return dispatch_jobs(max_jobs=count)['jobs']
+
+
+def _claim_next_jobs_rest(count, policy='fifo'):
+    """claim_next_jobs() without the dispatch RPC: lookup + conditional PATCH."""
+    if count <= 0:
+        return []
+    candidates = get_next_pending_jobs(limit=count, policy=policy)
+    claimable = []
+    for job in candidates:
+        if not job.get('drive_file_id'):
+            print(f"[{job['id']}] No drive_file_id, marking as failed")
+            fail_job(job['id'], 'Missing drive_file_id', job.get('attempt_count'))
+        elif (job.get('attempt_count') or 0) >= JOB_MAX_ATTEMPTS:
+            print(f"[{job['id']}] Out of attempts ({job['attempt_count']}), dead-lettering")
+            update_status(job['id'], 'dead_letter', error=f"Gave up after {job['attempt_count']} attempts: {job.get('error_message') or ''}")
+        else:
+            claimable.append(job)
+    if not claimable:
+        return []
+    claimed_ids = set(claim_jobs([job['id'] for job in claimable]))
+    claimed = [job for job in claimable if job['id'] in claimed_ids]
+    if retry_supported():
+        # PostgREST cannot increment in a bulk PATCH: one small PATCH per claimed job
+        for job in claimed:
+            job['attempt_count'] = (job.get('attempt_count') or 0) + 1
+            try:
+                db.patch('video_ingest_jobs', {'id': f"eq.{job['id']}"}, {'attempt_count': job['attempt_count'], 'next_attempt_at': None})
+            except Exception as e:
+                print(f"[{job['id']}] Could not record attempt: {e}")
+    return claimed
+
+
+_dispatch_rpc_available = True
+
+
+def dispatch_jobs(max_jobs=1, processed=0, failed=0):
+    """
+    One database round trip per dispatch (dispatch_jobs RPC), in one transaction:
+    recover stale jobs (only when watchdog_due()), add processed/failed to the batch
+    counters, claim up to max_jobs jobs if the batch is active, and count the jobs
+    still waiting.
+    Returns {'batch_active', 'recovered', 'jobs', 'pending', 'ready', 'next_attempt_at'}
+    ('ready': pending jobs not backing off; None when unknown); falls back to the
+    REST sequence when the RPC is not installed or fails.
+    """
+    global _dispatch_rpc_available
+    
+    recover = max_jobs > 0 and watchdog_due()
+    if _dispatch_rpc_available and SUPABASE_URL and SUPABASE_KEY:
+        cutoff_time = None
+        if recover:
+            cutoff_time = (datetime.utcnow() - timedelta(minutes=STALE_JOB_THRESHOLD_MINUTES)).isoformat()
+        try:
+            # Never retried: a replayed dispatch would claim or count twice
+            result = db.rpc('dispatch_jobs', {
+                'max_jobs': max_jobs,
+                'archief_folder_id': ARCHIEF_FOLDER_ID,
+                'transitional_states': TRANSITIONAL_STATES,
+                'stale_before': cutoff_time,
+                'processed_delta': processed,
+                'failed_delta': failed,
+                'lease_owner': LEASE_OWNER,
+                'lease_seconds': JOB_LEASE_SECONDS,
+                'max_attempts': JOB_MAX_ATTEMPTS,
+                'retry_base_seconds': JOB_RETRY_BASE_SECONDS,
+                'retry_max_seconds': JOB_RETRY_MAX_SECONDS
+            }, timeout=30, retry=False)
+            
+            for job in result.get('recovered') or []:
+                print(f"[Watchdog] Reset stale job {job['id']} ({job.get('drive_file_name', 'unknown')}) to {job.get('status', 'pending')}")
+            for job in result.get('dead_lettered') or []:
+                print(f"[{job['id']}] ☠️ Dead-lettered: {job.get('reason')}")
+            for job in result.get('jobs') or []:
+                print(f"[{job['id']}] ✅ Job claimed ({job.get('drive_file_name', 'unknown')}, status → external_processing)")
+            lease_keeper.hold([job['id'] for job in result.get('jobs') or []])
+            
+            return {
+                'batch_active': bool(result.get('batch_active')),
+                'recovered': len(result.get('recovered') or []),
+                'jobs': result.get('jobs') or [],
+                'pending': result.get('pending') or 0,
+                'ready': result.get('ready'),
+                'next_attempt_at': result.get('next_attempt_at')
+            }
+        except SupabaseError as e:
+            if e.status_code == 404:
+                print("[Dispatch] dispatch_jobs RPC not installed, using REST sequence")
+                _dispatch_rpc_available = False
+            else:
+                print(f"[Dispatch] RPC failed, using REST sequence: {e}")
+        except Exception as e:
+            print(f"[Dispatch] RPC error, using REST sequence: {e}")
+    
+    return _dispatch_jobs_rest(max_jobs, processed, failed, recover)
+
+
+def _dispatch_jobs_rest(max_jobs, processed, failed, recover):
+    """dispatch_jobs() as separate REST calls."""
+    recovered = cleanup_stale_jobs() if recover else 0
+    
+    state = get_batch_state()
+    active = state.get('batch_active', False)
+    if active and (processed or failed):
+        set_batch_state(
+            batch_active=True,
+            processed_jobs=state.get('processed_jobs', 0) + processed,
+            failed_jobs=state.get('failed_jobs', 0) + failed
+        )
+    
+    jobs = _claim_next_jobs_rest(max_jobs, state.get('scheduling_policy', 'fifo')) if active else []
+    return {
+        'batch_active': active,
+        'recovered': recovered,
+        'jobs': jobs,
+        'pending': get_pending_jobs_count(),
+        'ready': None,
+        'next_attempt_at': None
+    }
+
+
 GOOGLE_CLOUD_SECRET = os.environ.get('GOOGLE_CLOUD_SECRET')
 SECRET_MANAGER_SECRET_NAME = 'google-drive-service-account'
 
@@ -641,46 +1037,349 @@ def cancel_pending_tasks():
     return cancelled
 
 
+class ProgressWriter:
+    """
+    Coalescing background writer for job status/progress updates.
+    
+    queue() merges fields per job (newest value wins) and a daemon thread sends one
+    PATCH per job every flush interval. write_now() merges whatever is still buffered
+    for the job with the given fields and PATCHes synchronously - used for terminal
+    and conditional statuses, so they are never reordered behind a buffered write.
+    
+    A failed flush is re-queued (up to max_attempts) if it carries a status change;
+    progress-only writes are dropped. Counters are exposed via /metrics.
+    """
+    COUNTERS = ('queued', 'coalesced', 'immediate', 'patches', 'failed', 'dropped')
+    
+    def __init__(self, flush_interval=PROGRESS_FLUSH_SECONDS, max_attempts=3):
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.metrics = dict.fromkeys(self.COUNTERS, 0)
+        self.last_error = None
+    
+    def _ensure_thread(self):
+        # Pool slots run in spawned processes: every process gets its own flush thread
+        pid = os.getpid()
+        if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name='progress-writer')
+            self._thread_pid = pid
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    
+    def queue(self, job_id, fields):
+        with self._lock:
+            self.metrics['queued'] += 1
+            if job_id in self._pending:
+                self._pending[job_id].update(fields)
+                self.metrics['coalesced'] += 1
+            else:
+                self._pending[job_id] = dict(fields)
+        self._ensure_thread()
+    
+    def write_now(self, job_id, fields):
+        """PATCH buffered + given fields immediately. Returns True on success."""
+        with self._send_lock:
+            with self._lock:
+                data = self._pending.pop(job_id, {})
+                self._attempts.pop(job_id, None)
+                self.metrics['immediate'] += 1
+            data.update(fields)
+            return self._send(job_id, data)
+    
+    def _send(self, job_id, data):
+        try:
+            db.patch('video_ingest_jobs', {'id': f'eq.{job_id}'}, data, timeout=30)
+            with self._lock:
+                self.metrics['patches'] += 1
+            return True
+        except Exception as e:
+            with self._lock:
+                self.metrics['failed'] += 1
+                self.last_error = f"{job_id}: {str(e)[:200]}"
+            print(f"[{job_id}] ❌ Failed to write job update: {e}")
+            return False
+    
+    def flush(self):
+        """Send all buffered updates (one PATCH per job)."""
+        with self._send_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            for job_id, data in batch.items():
+                if self._send(job_id, data):
+                    with self._lock:
+                        self._attempts.pop(job_id, None)
+                    continue
+                with self._lock:
+                    attempts = self._attempts.get(job_id, 0) + 1
+                    if 'status' not in data or attempts >= self.max_attempts:
+                        self._attempts.pop(job_id, None)
+                        self.metrics['dropped'] += 1
+                    else:
+                        # Retry next flush; anything queued in the meantime is newer
+                        self._attempts[job_id] = attempts
+                        self._pending[job_id] = {**data, **self._pending.get(job_id, {})}
+    
+    def drain_metrics(self):
+        """Return and reset the counters (slot processes report them to the parent)."""
+        with self._lock:
+            counters, self.metrics = self.metrics, dict.fromkeys(self.COUNTERS, 0)
+        return counters
+    
+    def add_metrics(self, counters):
+        with self._lock:
+            for key in self.COUNTERS:
+                self.metrics[key] += (counters or {}).get(key, 0)
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.metrics,
+                'pending_jobs': len(self._pending),
+                'retrying_jobs': len(self._attempts),
+                'flush_interval_seconds': self.flush_interval,
+                'last_error': self.last_error
+            }
+
+
+progress_writer = ProgressWriter()
+atexit.register(progress_writer.flush)
+
+
+_column_support = {}
+
+
+def has_column(column, missing_message, table='video_ingest_jobs'):
+    """True if `table` has `column` (added by a migration); probed once per process"""
+    key = (table, column)
+    if key not in _column_support:
+        if not SUPABASE_URL or not SUPABASE_KEY:
+            return False
+        try:
+            db.select(table, {'select': column, 'limit': 0})
+            _column_support[key] = True
+        except SupabaseError as e:
+            if e.status_code != 400:
+                return False
+            print(missing_message)
+            _column_support[key] = False
+        except Exception:
+            return False
+    return _column_support[key]
+
+
+def leases_supported():
+    """True once the lease columns exist (scripts/sql/add_job_leases.sql)"""
+    return has_column('lease_expires_at', "[Lease] lease columns missing, falling back to the updated_at threshold")
+
+
+def retry_supported():
+    """True once the retry columns exist (scripts/sql/add_job_retry_backoff.sql)"""
+    return has_column('next_attempt_at', "[Retry] retry columns missing, failed jobs are not retried automatically")
+
+
+def scheduling_supported():
+    """True once the priority / policy columns exist (scripts/sql/add_job_priority.sql)"""
+    return (
+        has_column('priority', "[Scheduling] priority column missing, jobs are dispatched oldest first")
+        and has_column('scheduling_policy', "[Scheduling] scheduling_policy column missing on video_batch_state", table='video_batch_state')
+    )
+
+
+def lease_fields():
+    """Columns that lease a job to this instance for JOB_LEASE_SECONDS (empty without lease support)"""
+    if not leases_supported():
+        return {}
+    return {
+        'lease_owner': LEASE_OWNER,
+        'lease_expires_at': (datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+    }
+
+
+def stale_job_filter():
+    """PostgREST filter for jobs the watchdog may reset: transitional status, not archief and
+    an expired lease (or no lease and no update for STALE_JOB_THRESHOLD_MINUTES)"""
+    cutoff_time = (datetime.utcnow() - timedelta(minutes=STALE_JOB_THRESHOLD_MINUTES)).isoformat()
+    params = {
+        'status': f"in.({','.join(TRANSITIONAL_STATES)})",
+        'drive_folder_id': f'neq.{ARCHIEF_FOLDER_ID}'
+    }
+    if leases_supported():
+        now = datetime.utcnow().isoformat()
+        params['or'] = f'(lease_expires_at.lt."{now}",and(lease_expires_at.is.null,updated_at.lt."{cutoff_time}"))'
+    else:
+        params['updated_at'] = f'lt.{cutoff_time}'
+    return params
+
+
+class LeaseKeeper:
+    """
+    Keeps the leases of all jobs this process holds alive.
+    
+    A daemon thread extends every held lease in one conditional PATCH (only rows still
+    leased to LEASE_OWNER) every JOB_LEASE_SECONDS / 3. Jobs whose lease was taken over
+    in the meantime are dropped and reported as lost. Slot processes do not heartbeat:
+    the parent holds the leases of the jobs running in its pool.
+    """
+    
+    def __init__(self, lease_seconds=JOB_LEASE_SECONDS):
+        self.interval = lease_seconds / 3
+        self._held = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.metrics = {'heartbeats': 0, 'failed': 0, 'lost': 0}
+    
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name='lease-keeper')
+            self._thread_pid = pid
+            self._thread.start()
+    
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.heartbeat()
+    
+    def hold(self, job_ids):
+        if not job_ids or not leases_supported():
+            return
+        with self._lock:
+            self._held.update(job_ids)
+        self._ensure_thread()
+    
+    def release(self, job_id):
+        with self._lock:
+            self._held.discard(job_id)
+    
+    def heartbeat(self):
+        """Extend all held leases (one PATCH)."""
+        with self._lock:
+            held = set(self._held)
+        if not held:
+            return
+        try:
+            rows = db.patch(
+                'video_ingest_jobs',
+                {'id': f"in.({','.join(held)})", 'lease_owner': f'eq.{LEASE_OWNER}', 'select': 'id'},
+                {'lease_expires_at': (datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()},
+                returning=True,
+                timeout=15
+            )
+        except Exception as e:
+            with self._lock:
+                self.metrics['failed'] += 1
+            print(f"[Lease] Heartbeat failed for {len(held)} jobs: {e}")
+            return
+        lost = held - {row['id'] for row in rows}
+        with self._lock:
+            self.metrics['heartbeats'] += 1
+            self.metrics['lost'] += len(lost)
+            self._held -= lost
+        for job_id in lost:
+            print(f"[Lease] [{job_id}] Lease no longer ours (reset or taken over), stopped extending it")
+    
+    def snapshot(self):
+        with self._lock:
+            return {**self.metrics, 'held_jobs': len(self._held), 'owner': LEASE_OWNER, 'lease_seconds': JOB_LEASE_SECONDS}
+
+
+lease_keeper = LeaseKeeper()
+
+
 def update_status(job_id, status, error=None, **kwargs):
-    """Update job status in Supabase. Always sets updated_at for watchdog tracking."""
+    """Update job status in Supabase. Always sets updated_at for watchdog tracking.
+    Pipeline step statuses are buffered by the progress writer; all others are
+    written immediately (together with anything still buffered for the job)."""
     if not SUPABASE_URL or not SUPABASE_KEY:
         print(f"[{job_id}] ❌ Status: {status} - NO SUPABASE CREDENTIALS!")
         print(f"[{job_id}]    SUPABASE_URL: {'set' if SUPABASE_URL else 'MISSING'}")
         print(f"[{job_id}]    SUPABASE_KEY: {'set' if SUPABASE_KEY else 'MISSING'}")
         return False
-    try:
-        data = {
-            'status': status,
-            'updated_at': datetime.utcnow().isoformat()  # Always update timestamp for watchdog
-        }
-        if error:
-            data['error_message'] = error
-        data.update(kwargs)
-        resp = requests.patch(
-            f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}',
-            json=data,
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=minimal'
-            },
-            timeout=30
-        )
-        if resp.status_code in [200, 204]:
-            print(f"[{job_id}] ✅ Status updated: {status} (updated_at refreshed)")
-            return True
-        else:
-            print(f"[{job_id}] ❌ Supabase error {resp.status_code}: {resp.text[:200]}")
-            return False
-    except Exception as e:
-        print(f"[{job_id}] ❌ Failed to update status: {e}")
-        return False
+    data = {
+        'status': status,
+        'updated_at': datetime.utcnow().isoformat()  # Always update timestamp for watchdog
+    }
+    if error:
+        data['error_message'] = error
+    data.update(kwargs)
+    
+    if status not in TRANSITIONAL_STATES:
+        # Finished / handed back: the job is no longer ours to keep alive
+        lease_keeper.release(job_id)
+        if leases_supported():
+            data.update({'lease_owner': None, 'lease_expires_at': None})
+    
+    if PROGRESS_FLUSH_SECONDS > 0 and status in BUFFERED_STATUSES:
+        progress_writer.queue(job_id, data)
+        print(f"[{job_id}] Status queued: {status}")
+        return True
+    
+    if progress_writer.write_now(job_id, data):
+        print(f"[{job_id}] ✅ Status updated: {status} (updated_at refreshed)")
+        return True
+    return False
+
+
+def classify_failure(error):
+    """'permanent' if retrying cannot help (see PERMANENT_FAILURE_PATTERNS), else 'transient'"""
+    message = (error or '').lower()
+    return 'permanent' if any(pattern in message for pattern in PERMANENT_FAILURE_PATTERNS) else 'transient'
+
+
+def retry_delay_seconds(attempt_count):
+    """Backoff before the next attempt after `attempt_count` failed attempts"""
+    return min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** max(attempt_count - 1, 0))
+
+
+def fail_job(job_id, error, attempt_count=None):
+    """
+    Record a failed batch attempt. Transient failures go back to 'failed' with a
+    next_attempt_at backoff; permanent failures and the JOB_MAX_ATTEMPTS-th failure
+    go to 'dead_letter'. Without the retry columns: 'cloud_failed' as before.
+    Returns the status written.
+    """
+    if not retry_supported():
+        update_status(job_id, 'cloud_failed', error=error)
+        return 'cloud_failed'
+    
+    if attempt_count is None:
+        try:
+            rows = db.select('video_ingest_jobs', {'id': f'eq.{job_id}', 'select': 'attempt_count'}, timeout=15)
+            attempt_count = (rows[0].get('attempt_count') or 0) if rows else 0
+        except Exception as e:
+            print(f"[{job_id}] Could not read attempt_count: {e}")
+            attempt_count = 0
+    
+    kind = classify_failure(error)
+    if kind == 'permanent' or attempt_count >= JOB_MAX_ATTEMPTS:
+        print(f"[{job_id}] ☠️ Dead-lettered after {attempt_count} attempt(s) ({kind}): {error}")
+        update_status(job_id, 'dead_letter', error=error, failure_kind=kind, next_attempt_at=None)
+        return 'dead_letter'
+    
+    delay = retry_delay_seconds(attempt_count)
+    print(f"[{job_id}] Attempt {attempt_count}/{JOB_MAX_ATTEMPTS} failed, retry in {delay}s: {error}")
+    update_status(
+        job_id, 'failed', error=error, failure_kind=kind,
+        next_attempt_at=(datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+    )
+    return 'failed'
 
-def transcribe_audio(audio_path):
+def transcribe_audio(audio_path, with_words=False):
+    """Transcript text, or {'text', 'words'} (word timestamps) when with_words=True."""
     if not ELEVENLABS_API_KEY:
         print("No ElevenLabs API key")
-        return ""
+        return {'text': '', 'words': []} if with_words else ""
     
     print(f"Transcribing {audio_path}...")
     with open(audio_path, 'rb') as f:
@@ -692,17 +1391,23 @@ def transcribe_audio(audio_path):
         )
     
     if resp.status_code == 200:
-        text = resp.json().get('text', '')
+        result = resp.json()
+        text = result.get('text', '')
         print(f"Transcript: {len(text)} characters")
-        return text
+        return {'text': text, 'words': result.get('words') or []} if with_words else text
     else:
         print(f"ElevenLabs error: {resp.status_code} - {resp.text[:200]}")
-        return ""
+        return {'text': '', 'words': []} if with_words else ""
 
 def generate_embedding(text):
     if not OPENAI_API_KEY or not text:
         return None
     
+    text = text[:8000]
+    cached = embedding_cache.get(EMBEDDING_MODEL, text)
+    if cached is not None:
+        return cached
+    
     try:
         resp = requests.post(
             'https://api.openai.com/v1/embeddings',
@@ -710,92 +1415,110 @@ def generate_embedding(text):
                 'Authorization': f'Bearer {OPENAI_API_KEY}',
                 'Content-Type': 'application/json'
             },
-            json={'input': text[:8000], 'model': 'text-embedding-3-small'}
+            json={'input': text, 'model': EMBEDDING_MODEL}
         )
         if resp.status_code == 200:
-            return resp.json()['data'][0]['embedding']
+            embedding = resp.json()['data'][0]['embedding']
+            embedding_cache.put(EMBEDDING_MODEL, text, embedding)
+            return embedding
         else:
             print(f"OpenAI error: {resp.status_code}")
     except Exception as e:
         print(f"Embedding error: {e}")
     return None
 
-def save_to_rag(job_id, transcript, embedding):
-    """Save transcript and embedding to RAG documents. Returns document ID or None."""
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        print(f"[{job_id}] RAG save skipped: missing SUPABASE credentials")
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """Shared OpenAI client (thread-safe, keeps its connection pool across jobs)."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            from openai import OpenAI
+            _openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=120)
+        return _openai_client
+
+def generate_embeddings(texts):
+    """
+    Embeddings for several texts through the shared EmbeddingBatcher (token-aware
+    request packing, retries with backoff, cache misses only). None if any text failed.
+    """
+    if not OPENAI_API_KEY or not texts:
         return None
     
-    headers = {
-        'apikey': SUPABASE_KEY,
-        'Authorization': f'Bearer {SUPABASE_KEY}',
-        'Content-Type': 'application/json',
-        'Prefer': 'return=representation'
-    }
-    
+    # One batcher per call: its error bookkeeping is per embed() and slots run in parallel
+    batcher = EmbeddingBatcher(get_openai_client(), model=EMBEDDING_MODEL, cache=embedding_cache)
     try:
-        # First check if a RAG document already exists for this job
-        check_resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/rag_documents?metadata->>job_id=eq.{job_id}&select=id',
-            headers=headers
-        )
-        if check_resp.status_code == 200:
-            existing = check_resp.json()
-            if existing and len(existing) > 0:
-                doc_id = existing[0].get('id')
-                print(f"[{job_id}] RAG document already exists: {doc_id}")
-                return doc_id
-        
-        # Insert new RAG document
-        resp = requests.post(
-            f'{SUPABASE_URL}/rest/v1/rag_documents',
-            json={
-                'content': transcript,
-                'embedding': embedding,
-                'metadata': {'source': 'video_pipeline', 'job_id': job_id}
-            },
-            headers=headers
-        )
-        
-        if resp.status_code in [200, 201]:
-            doc_id = resp.json()[0].get('id')
-            print(f"[{job_id}] Saved to RAG: {doc_id}")
-            return doc_id
-        elif resp.status_code == 409:
-            # Conflict - document already exists, try to fetch it
-            print(f"[{job_id}] RAG conflict (409), fetching existing document...")
-            check_resp = requests.get(
-                f'{SUPABASE_URL}/rest/v1/rag_documents?metadata->>job_id=eq.{job_id}&select=id',
-                headers=headers
-            )
-            if check_resp.status_code == 200:
-                existing = check_resp.json()
-                if existing and len(existing) > 0:
-                    doc_id = existing[0].get('id')
-                    print(f"[{job_id}] Found existing RAG document: {doc_id}")
-                    return doc_id
-            print(f"[{job_id}] RAG 409 but couldn't find existing document")
-        else:
-            print(f"[{job_id}] RAG save failed: {resp.status_code} - {resp.text[:200]}")
+        embeddings = batcher.embed(texts)
     except Exception as e:
-        print(f"[{job_id}] RAG save error: {e}")
-    
-    return None
+        print(f"Embedding error: {e}")
+        return None
+    if batcher.errors or any(embedding is None for embedding in embeddings):
+        print(f"Embedding error: {len(batcher.errors)} of {len(texts)} inputs failed: "
+              f"{next(iter(batcher.errors.values()), 'empty input')}")
+        return None
+    return embeddings
 
+def embed_transcript(transcript, words=None):
+    """
+    Chunk a transcript and embed all chunks in one batched call.
+    Returns (pooled document embedding, chunks with 'embedding') or (None, []).
+    """
+    chunks = chunk_transcript(transcript, words)
+    if not chunks:
+        return None, []
+    embeddings = generate_embeddings([chunk['content'] for chunk in chunks])
+    if not embeddings:
+        return None, []
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk['embedding'] = embedding
+    pooled = pool_embeddings(embeddings, [chunk['token_count'] for chunk in chunks])
+    return pooled, chunks
+
+def save_rag_chunks(job_id, doc_id, chunks):
+    """
+    Replace the chunk rows of a RAG document (rag_document_chunks): upsert on the
+    unique (document_id, chunk_index) key, then drop the rows past the new chunk count.
+    A retried request or a failure halfway never leaves duplicates or an empty document.
+    """
+    try:
+        db.upsert('rag_document_chunks', [
+            {**chunk, 'document_id': doc_id} for chunk in chunks
+        ], on_conflict='document_id,chunk_index', timeout=60)
+        db.request('DELETE', 'rag_document_chunks', params={
+            'document_id': f'eq.{doc_id}',
+            'chunk_index': f'gte.{len(chunks)}',
+        })
+        print(f"[{job_id}] Saved {len(chunks)} RAG chunks")
+    except Exception as e:
+        print(f"[{job_id}] RAG chunk save failed: {e}")
 
-def cosine_similarity(vec1, vec2):
-    """Calculate cosine similarity between two vectors."""
-    if not vec1 or not vec2 or len(vec1) != len(vec2):
-        return 0.0
-    
-    dot_product = sum(a * b for a, b in zip(vec1, vec2))
-    magnitude1 = sum(a * a for a in vec1) ** 0.5
-    magnitude2 = sum(b * b for b in vec2) ** 0.5
+def save_to_rag(job_id, transcript, embedding, chunks=None):
+    """
+    Save transcript and embedding to RAG documents (plus its chunk rows when chunked).
+    One upsert on source_id 'video_<job_id>' (rag_writer.py); a retried job updates
+    its existing document. Returns document ID or None.
+    """
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        print(f"[{job_id}] RAG save skipped: missing SUPABASE credentials")
+        return None
     
-    if magnitude1 == 0 or magnitude2 == 0:
-        return 0.0
+    try:
+        doc_id = upsert_rag_documents(db, [{
+            'source_id': f'video_{job_id}',
+            'content': transcript,
+            'embedding': embedding,
+            'metadata': {'source': 'video_pipeline', 'job_id': job_id}
+        }])[0]
+    except Exception as e:
+        print(f"[{job_id}] RAG save failed: {e}")
+        return None
     
-    return dot_product / (magnitude1 * magnitude2)
+    print(f"[{job_id}] Saved to RAG: {doc_id}")
+    if doc_id and chunks:
+        save_rag_chunks(job_id, doc_id, chunks)
+    return doc_id
 
 
 def match_technique_from_embedding(transcript_embedding, job_id):
@@ -803,74 +1526,58 @@ def match_technique_from_embedding(transcript_embedding, job_id):
     Match transcript embedding against technique embeddings in database.
     Returns (techniek_id, confidence_score) or (None, None) if no match found.
     
-    Only techniques with doc_type='techniek' are considered.
-    Minimum confidence threshold: 0.30 (30%)
+    Only techniques with doc_type='techniek' are considered; they come from the
+    in-process TechniqueMatrixCache (one matrix-vector product per job).
+    Minimum confidence threshold: TECHNIEK_MIN_CONFIDENCE (default 0.30)
     """
     if not transcript_embedding or not SUPABASE_URL or not SUPABASE_KEY:
         return None, None
     
-    MIN_CONFIDENCE = 0.30  # Minimum 30% similarity for a valid match
-    
     try:
-        # Fetch all technique embeddings from rag_documents
-        resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/rag_documents?doc_type=eq.techniek&select=id,techniek_id,title,embedding',
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-            }
-        )
-        
-        if resp.status_code != 200:
-            print(f"[{job_id}] Failed to fetch technique embeddings: {resp.status_code}")
+        try:
+            techniques = technique_cache.get()
+        except SupabaseError as e:
+            print(f"[{job_id}] Failed to fetch technique embeddings: {e.status_code}")
             return None, None
         
-        techniques = resp.json()
-        if not techniques:
+        if not len(techniques):
             print(f"[{job_id}] No technique embeddings found in database")
             return None, None
         
         print(f"[{job_id}] Matching against {len(techniques)} techniques...")
+        match = techniques.match(transcript_embedding, threshold=TECHNIEK_MIN_CONFIDENCE)
+        runner_up = ', '.join(f"{t['title']} {t['score']:.1%}" for t in match['top'][1:])
         
-        best_match = None
-        best_score = 0.0
-        
-        for tech in techniques:
-            tech_embedding = tech.get('embedding')
-            if not tech_embedding:
-                continue
-            
-            # Parse embedding if it's a string
-            if isinstance(tech_embedding, str):
-                try:
-                    tech_embedding = json.loads(tech_embedding)
-                except:
-                    continue
-            
-            similarity = cosine_similarity(transcript_embedding, tech_embedding)
-            
-            if similarity > best_score:
-                best_score = similarity
-                best_match = tech
-        
-        if best_match and best_score >= MIN_CONFIDENCE:
-            techniek_id = best_match.get('techniek_id')
-            title = best_match.get('title', 'Onbekend')
-            print(f"[{job_id}] AI Techniek Match: {title} (confidence: {best_score:.1%})")
-            return techniek_id, round(best_score, 4)
+        if match['best']:
+            techniek_id = match['best'].get('techniek_id')
+            title = match['best'].get('title', 'Onbekend')
+            print(f"[{job_id}] AI Techniek Match: {title} (confidence: {match['score']:.1%}, margin: {match['margin']:.1%}; next: {runner_up})")
+            return techniek_id, round(match['score'], 4)
         else:
-            print(f"[{job_id}] No confident technique match (best: {best_score:.1%}, min: {MIN_CONFIDENCE:.0%})")
+            print(f"[{job_id}] No confident technique match (best: {match['score']:.1%}, min: {TECHNIEK_MIN_CONFIDENCE:.0%})")
             return None, None
             
     except Exception as e:
         print(f"[{job_id}] Technique matching error: {e}")
         return None, None
 
-def download_from_drive_resumable(drive_file_id, access_token, output_path, job_id, max_retries=10, max_time=1800):
+def drive_error_reasons(resp):
+    """The error.errors[].reason values of a Drive API error response (empty set if unparsable)"""
+    try:
+        errors = resp.json().get('error', {}).get('errors', [])
+        return {e['reason'] for e in errors if e.get('reason')}
+    except (ValueError, AttributeError, TypeError, KeyError):
+        return set()
+
+
+def download_from_drive_resumable(drive_file_id, access_token, output_path, job_id, max_retries=10, max_time=1800, on_chunk=None):
     """
     Resumable download from Google Drive with Range headers.
     Handles SSL errors and connection drops by resuming from last byte.
     Uses longer backoff times and more retries for large files.
+    
+    on_chunk(chunk, offset) is called for every chunk written to disk, with the file
+    offset the chunk starts at (used to tee the stream into ffmpeg).
     """
     url = f"https://www.googleapis.com/drive/v3/files/{drive_file_id}?alt=media"
     headers = {'Authorization': f'Bearer {access_token}'}
@@ -908,8 +1615,19 @@ def download_from_drive_resumable(drive_file_id, access_token, output_path, job_
                 
                 if resp.status_code == 401:
                     raise Exception("Access token expired or invalid")
-                elif resp.status_code == 403:
-                    raise Exception("Access denied to file")
+                elif resp.status_code in (403, 429):
+                    reasons = drive_error_reasons(resp)
+                    if reasons & DRIVE_PERMISSION_REASONS:
+                        raise Exception(f"Access denied to file ({', '.join(sorted(reasons))})")
+                    # Rate limits clear within seconds: back off here. Quota (downloadQuotaExceeded)
+                    # and unknown 403s fail the attempt as transient, so the job backs off instead
+                    if (resp.status_code == 429 or reasons & DRIVE_RATE_LIMIT_REASONS) and retry_count < max_retries:
+                        retry_count += 1
+                        wait_time = min(60, 10 * (2 ** (retry_count - 1)))
+                        print(f"[{job_id}] Drive rate limit (retry {retry_count}/{max_retries}), waiting {wait_time}s...")
+                        time.sleep(wait_time)
+                        continue
+                    raise Exception(f"Drive download refused ({resp.status_code}: {', '.join(sorted(reasons)) or 'no reason'})")
                 
                 if resp.status_code == 206:
                     content_range = resp.headers.get('Content-Range', '')
@@ -933,6 +1651,8 @@ def download_from_drive_resumable(drive_file_id, access_token, output_path, job_
                 for chunk in resp.iter_content(chunk_size=65536):
                     if chunk:
                         f.write(chunk)
+                        if on_chunk:
+                            on_chunk(chunk, downloaded)
                         downloaded += len(chunk)
                         
                         if time.time() - last_log > 30:
@@ -979,24 +1699,41 @@ def download_from_drive_resumable(drive_file_id, access_token, output_path, job_
     return file_size
 
 
+def get_drive_file_size(drive_file_id, access_token):
+    """Get file size in bytes from Drive metadata (0 if unknown)"""
+    try:
+        resp = requests.get(
+            f'https://www.googleapis.com/drive/v3/files/{drive_file_id}',
+            params={'fields': 'size'},
+            headers={'Authorization': f'Bearer {access_token}'},
+            timeout=10
+        )
+        if resp.status_code == 200:
+            return int(resp.json().get('size', 0))
+    except Exception as e:
+        print(f"Drive metadata error for {drive_file_id}: {e}")
+    return 0
+
+
 def update_progress(job_id, message):
-    """Update job with progress message for visibility"""
+    """Update job with progress message for visibility (buffered, newest message wins)"""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return
-    try:
-        requests.patch(
-            f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}',
-            json={'error_message': f'[Progress] {message}'},
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=minimal'
-            },
-            timeout=5
-        )
-    except:
-        pass
+    fields = {'error_message': f'[Progress] {message}'}
+    if PROGRESS_FLUSH_SECONDS > 0:
+        progress_writer.queue(job_id, fields)
+    else:
+        progress_writer.write_now(job_id, fields)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Worker metrics: progress writer, embedding cache (including finished pool slots) and lease counters"""
+    return jsonify({
+        'progress_writer': progress_writer.snapshot(),
+        'embedding_cache': embedding_cache.stats(),
+        'leases': lease_keeper.snapshot()
+    })
 
 
 @app.route('/health', methods=['GET'])
@@ -1062,9 +1799,61 @@ def debug_drive_test():
     return jsonify(result)
 
 
+def parse_scheduling_options(body):
+    """
+    (policy, folder_weights, priorities) from a /batch/start body:
+      policy:         'fifo' | 'sjf' | 'fair' (default BATCH_SCHEDULING_POLICY)
+      folder_weights: {drive_folder_id: weight > 0} for 'fair' (missing folders weigh 1)
+      priorities:     {job_id (UUID): integer priority} to fast-track (higher first, default 0)
+    Raises ValueError on invalid input.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('request body must be a JSON object')
+    policy = str(body.get('policy') or BATCH_SCHEDULING_POLICY).lower()
+    if policy not in SCHEDULING_POLICIES:
+        raise ValueError(f"policy must be one of {', '.join(SCHEDULING_POLICIES)}")
+    
+    folder_weights = body.get('folder_weights') or {}
+    priorities = body.get('priorities') or {}
+    if not isinstance(folder_weights, dict) or not isinstance(priorities, dict):
+        raise ValueError('folder_weights and priorities must be objects')
+    try:
+        folder_weights = {str(folder): float(weight) for folder, weight in folder_weights.items()}
+        priorities = {str(job_id): int(priority) for job_id, priority in priorities.items()}
+    except (TypeError, ValueError):
+        raise ValueError('folder_weights must map to numbers and priorities to integers')
+    # Job ids end up in a PostgREST in.(...) filter: only accept canonical UUIDs
+    try:
+        priorities = {str(uuid.UUID(job_id)): priority for job_id, priority in priorities.items()}
+    except ValueError:
+        raise ValueError('priorities keys must be job ids (UUIDs)')
+    if any(weight <= 0 for weight in folder_weights.values()):
+        raise ValueError('folder_weights must be positive')
+    return policy, folder_weights, priorities
+
+
+def set_job_priorities(priorities):
+    """Write job priorities: one PATCH per distinct priority value. Returns the number of jobs updated."""
+    by_priority = {}
+    for job_id, priority in priorities.items():
+        by_priority.setdefault(priority, []).append(job_id)
+    updated = 0
+    for priority, job_ids in by_priority.items():
+        rows = db.patch(
+            'video_ingest_jobs',
+            {'id': f"in.({','.join(job_ids)})", 'select': 'id'},
+            {'priority': priority},
+            returning=True
+        )
+        updated += len(rows)
+        print(f"Priority {priority} set on {len(rows)}/{len(job_ids)} jobs")
+    return updated
+
+
 @app.route('/batch/start', methods=['POST'])
 def batch_start():
-    """Start batch processing: get pending jobs and schedule first Cloud Task"""
+    """Start batch processing: get pending jobs and schedule first Cloud Task.
+    Optional JSON body: {"policy", "folder_weights", "priorities"} (see parse_scheduling_options)."""
     auth = request.headers.get('Authorization', '')
     if not WORKER_SECRET or auth != f'Bearer {WORKER_SECRET}':
         return jsonify({'error': 'Unauthorized'}), 401
@@ -1080,6 +1869,25 @@ def batch_start():
             'state': state
         }), 400
     
+    try:
+        policy, folder_weights, priorities = parse_scheduling_options(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    scheduling = {}
+    if scheduling_supported():
+        scheduling = {'scheduling_policy': policy, 'folder_weights': folder_weights}
+        if priorities:
+            try:
+                set_job_priorities(priorities)
+            except SupabaseError as e:
+                return jsonify({'error': f'Failed to set priorities: {e}'}), 500
+    elif policy != 'fifo' or folder_weights or priorities:
+        return jsonify({
+            'error': 'Scheduling options need scripts/sql/add_job_priority.sql',
+            'policy': policy
+        }), 400
+    
     pending_count = get_pending_jobs_count()
     if pending_count == 0:
         return jsonify({
@@ -1094,17 +1902,19 @@ def batch_start():
         started_at=datetime.utcnow().isoformat(),
         total_jobs=pending_count,
         processed_jobs=0,
-        failed_jobs=0
+        failed_jobs=0,
+        **scheduling
     )
     
     task_name = schedule_next_job(delay_seconds=5)
     
     if task_name:
-        print(f"✅ Batch started! First task scheduled: {task_name}")
+        print(f"✅ Batch started! First task scheduled: {task_name} (policy: {policy})")
         return jsonify({
             'success': True,
             'message': 'Batch processing started',
             'pending_jobs': pending_count,
+            'policy': policy,
             'first_task': task_name,
             'state': new_state
         })
@@ -1146,43 +1956,27 @@ def batch_stop():
 def batch_status():
     """Get current batch processing status"""
     state = get_batch_state()
-    pending_count = get_pending_jobs_count()
-    
-    completed = 0
-    failed = 0
-    processing = 0
     
+    counts, fetched_at = None, 0.0
     if SUPABASE_URL and SUPABASE_KEY:
-        try:
-            resp = requests.get(
-                f"{SUPABASE_URL}/rest/v1/video_ingest_jobs?select=status",
-                headers={
-                    'apikey': SUPABASE_KEY,
-                    'Authorization': f'Bearer {SUPABASE_KEY}'
-                },
-                timeout=10
-            )
-            if resp.status_code == 200:
-                jobs = resp.json()
-                for job in jobs:
-                    status = job.get('status', '')
-                    if status == 'completed':
-                        completed += 1
-                    elif status in ('cloud_failed', 'failed', 'chromakey_failed'):
-                        failed += 1
-                    elif status == 'external_processing':
-                        processing += 1
-        except Exception as e:
-            print(f"Error getting job counts: {e}")
+        counts, fetched_at = status_snapshot.get()
+    counts = counts or {}
     
     return jsonify({
         'batch_active': state.get('batch_active', False),
         'started_at': state.get('started_at'),
+        'scheduling_policy': state.get('scheduling_policy', 'fifo'),
+        'counts_as_of': datetime.utcfromtimestamp(fetched_at).isoformat() if fetched_at else None,
         'counters': {
-            'pending': pending_count,
-            'processing': processing,
-            'completed': completed,
-            'failed': failed,
+            # Stuck jobs are included: the watchdog will put them back in the queue
+            'pending': counts.get('pending', 0) + counts.get('stuck', 0),
+            'processing': counts.get('processing', 0),
+            'completed': counts.get('completed', 0),
+            'failed': counts.get('failed', 0),
+            # Permanently failed / out of attempts: never retried automatically
+            'dead_letter': counts.get('dead_letter', 0),
+            # Part of 'pending', waiting for their retry backoff to pass
+            'backoff': counts.get('backoff', 0),
             'total_in_batch': state.get('total_jobs', 0),
             'processed_in_batch': state.get('processed_jobs', 0),
             'failed_in_batch': state.get('failed_jobs', 0)
@@ -1194,7 +1988,8 @@ def batch_status():
 def batch_watchdog():
     """
     Watchdog endpoint: Clean up stale jobs stuck in transitional states.
-    Call this manually or set up a Cloud Scheduler to call it periodically.
+    Call this manually or set up a Cloud Scheduler to call it periodically
+    (process-next no longer runs it before every job, see WATCHDOG_INTERVAL_SECONDS).
     Stale jobs (>15 min in transitional state) are reset to 'pending'.
     """
     auth = request.headers.get('Authorization', '')
@@ -1224,39 +2019,20 @@ def get_archief_batch_state():
         return {'batch_active': False, 'total_jobs': 0, 'processed_jobs': 0, 'failed_jobs': 0}
     
     try:
-        resp = requests.get(
-            f'{SUPABASE_URL}/rest/v1/video_batch_state?id=eq.{ARCHIEF_BATCH_STATE_ID}',
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}'
-            },
-            timeout=10
-        )
-        if resp.status_code == 200:
-            rows = resp.json()
-            if rows:
-                return rows[0]
-            else:
-                # Create initial row for archief batch
-                init_resp = requests.post(
-                    f'{SUPABASE_URL}/rest/v1/video_batch_state',
-                    json={
-                        'id': ARCHIEF_BATCH_STATE_ID,
-                        'batch_active': False,
-                        'total_jobs': 0,
-                        'processed_jobs': 0,
-                        'failed_jobs': 0
-                    },
-                    headers={
-                        'apikey': SUPABASE_KEY,
-                        'Authorization': f'Bearer {SUPABASE_KEY}',
-                        'Content-Type': 'application/json',
-                        'Prefer': 'return=representation'
-                    },
-                    timeout=10
-                )
-                if init_resp.status_code in [200, 201]:
-                    return init_resp.json()[0]
+        rows = db.select('video_batch_state', {'id': f'eq.{ARCHIEF_BATCH_STATE_ID}'})
+        if rows:
+            return rows[0]
+        else:
+            # Create initial row for archief batch
+            created = db.insert('video_batch_state', {
+                'id': ARCHIEF_BATCH_STATE_ID,
+                'batch_active': False,
+                'total_jobs': 0,
+                'processed_jobs': 0,
+                'failed_jobs': 0
+            })
+            if created:
+                return created[0]
     except Exception as e:
         print(f"[Archief] Error getting batch state: {e}")
     
@@ -1271,40 +2047,20 @@ def set_archief_batch_state(batch_active, **kwargs):
     update_data = {'batch_active': batch_active, **kwargs}
     
     try:
-        resp = requests.patch(
-            f'{SUPABASE_URL}/rest/v1/video_batch_state?id=eq.{ARCHIEF_BATCH_STATE_ID}',
-            json=update_data,
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=representation'
-            },
-            timeout=10
-        )
-        if resp.status_code == 200:
-            rows = resp.json()
-            if rows:
-                print(f"[Archief] Batch state saved: batch_active={batch_active}")
-                return rows[0]
-            else:
-                # Row doesn't exist, create it
-                get_archief_batch_state()  # This will create the row
-                # Try update again
-                resp = requests.patch(
-                    f'{SUPABASE_URL}/rest/v1/video_batch_state?id=eq.{ARCHIEF_BATCH_STATE_ID}',
-                    json=update_data,
-                    headers={
-                        'apikey': SUPABASE_KEY,
-                        'Authorization': f'Bearer {SUPABASE_KEY}',
-                        'Content-Type': 'application/json',
-                        'Prefer': 'return=representation'
-                    },
-                    timeout=10
-                )
-                if resp.status_code == 200 and resp.json():
-                    return resp.json()[0]
-        print(f"[Archief] Error updating batch state: {resp.status_code}")
+        state_filter = {'id': f'eq.{ARCHIEF_BATCH_STATE_ID}'}
+        rows = db.patch('video_batch_state', state_filter, update_data, returning=True)
+        if rows:
+            print(f"[Archief] Batch state saved: batch_active={batch_active}")
+            return rows[0]
+        # Row doesn't exist, create it
+        get_archief_batch_state()  # This will create the row
+        # Try update again
+        rows = db.patch('video_batch_state', state_filter, update_data, returning=True)
+        if rows:
+            return rows[0]
+        print("[Archief] Error updating batch state: row not found")
+    except SupabaseError as e:
+        print(f"[Archief] Error updating batch state: {e.status_code}")
     except Exception as e:
         print(f"[Archief] Batch state save error: {e}")
     
@@ -1476,24 +2232,16 @@ def batch_transcribe_archief_status():
     
     if SUPABASE_URL and SUPABASE_KEY:
         try:
-            resp = requests.get(
-                f"{SUPABASE_URL}/rest/v1/video_ingest_jobs"
-                f"?drive_folder_id=eq.{ARCHIEF_FOLDER_ID}"
-                f"&select=status",
-                headers={
-                    'apikey': SUPABASE_KEY,
-                    'Authorization': f'Bearer {SUPABASE_KEY}'
-                },
-                timeout=10
-            )
-            if resp.status_code == 200:
-                jobs = resp.json()
-                for job in jobs:
-                    status = job.get('status', '')
-                    if status == 'archived_transcribed':
-                        transcribed += 1
-                    elif status == 'archief_failed':
-                        failed += 1
+            jobs = db.select('video_ingest_jobs', {
+                'drive_folder_id': f'eq.{ARCHIEF_FOLDER_ID}',
+                'select': 'status'
+            })
+            for job in jobs:
+                status = job.get('status', '')
+                if status == 'archived_transcribed':
+                    transcribed += 1
+                elif status == 'archief_failed':
+                    failed += 1
         except Exception as e:
             print(f"[Archief] Error getting job counts: {e}")
     
@@ -1622,7 +2370,7 @@ def schedule_next_archief_and_update_state(success):
 @app.route('/batch/process-next', methods=['POST'])
 def batch_process_next():
     """Process the next pending job and schedule the next Cloud Task.
-    Calls watchdog first to recover any stuck jobs before picking next job."""
+    One dispatch recovers stuck jobs, checks the batch state and claims the job(s)."""
     auth = request.headers.get('Authorization', '')
     if not WORKER_SECRET or auth != f'Bearer {WORKER_SECRET}':
         return jsonify({'error': 'Unauthorized'}), 401
@@ -1631,14 +2379,16 @@ def batch_process_next():
     print("BATCH PROCESS-NEXT TRIGGERED")
     print("="*60)
     
-    # Self-healing: First cleanup any stale jobs before processing
-    print("[Self-healing] Running watchdog cleanup before processing...")
-    reset_count = cleanup_stale_jobs()
+    multi_slot = WORKER_SLOTS > 1 or PREFETCH_QUEUE_SIZE > 0
+    
+    # Claim in one round trip (stuck jobs are reset by the scheduled watchdog, or
+    # here at most once per WATCHDOG_INTERVAL_SECONDS)
+    dispatch = dispatch_jobs(max_jobs=WORKER_SLOTS if multi_slot else 1)
+    reset_count = dispatch['recovered']
     if reset_count > 0:
         print(f"[Self-healing] Recovered {reset_count} stuck jobs - they will be retried")
     
-    state = get_batch_state()
-    if not state.get('batch_active'):
+    if not dispatch['batch_active']:
         print("Batch is not active, skipping")
         return jsonify({
             'skipped': True,
@@ -1646,9 +2396,23 @@ def batch_process_next():
             'watchdog_reset_count': reset_count
         })
     
-    job = get_next_pending_job()
+    if multi_slot:
+        results = run_batch_slots(WORKER_SLOTS, claimed=dispatch['jobs'])
+        schedule_next_if_pending()
+        return jsonify({
+            'processed': True,
+            'slots': WORKER_SLOTS,
+            'jobs': results,
+            'succeeded': sum(1 for r in results if r['success']),
+            'failed': sum(1 for r in results if not r['success'])
+        })
     
-    if not job:
+    if not dispatch['jobs']:
+        if dispatch['pending'] > 0:
+            # Jobs without drive_file_id were failed, or another worker claimed the rest
+            print(f"No job claimed ({dispatch['pending']} still pending), scheduling next")
+            schedule_next_if_pending(dispatch)
+            return jsonify({'skipped': True, 'reason': 'No claimable job', 'pending': dispatch['pending']})
         print("No more pending jobs, stopping batch")
         set_batch_state(batch_active=False)
         return jsonify({
@@ -1656,34 +2420,24 @@ def batch_process_next():
             'message': 'All jobs processed, batch stopped'
         })
     
+    job = dispatch['jobs'][0]
     job_id = job['id']
-    drive_file_id = job.get('drive_file_id')
-    
-    if not drive_file_id:
-        print(f"[{job_id}] No drive_file_id, marking as failed")
-        update_status(job_id, 'cloud_failed', error='Missing drive_file_id')
-        schedule_next_and_update_state(success=False)
-        return jsonify({'error': 'Job missing drive_file_id', 'job_id': job_id}), 400
-    
-    if not claim_job(job_id):
-        print(f"[{job_id}] Failed to claim job, scheduling next")
-        schedule_next_and_update_state(success=False)
-        return jsonify({'error': 'Failed to claim job', 'job_id': job_id}), 409
+    drive_file_id = job['drive_file_id']
     
     access_token = get_google_access_token()
     if not access_token:
         print(f"[{job_id}] Failed to get access token")
-        update_status(job_id, 'cloud_failed', error='Failed to get Google access token')
+        fail_job(job_id, 'Failed to get Google access token', job.get('attempt_count'))
         schedule_next_and_update_state(success=False)
         return jsonify({'error': 'Failed to get access token', 'job_id': job_id}), 500
     
     success = False
     try:
-        run_pipeline(job_id, drive_file_id, access_token, callback_url=None)
+        run_pipeline(job_id, drive_file_id, access_token, callback_url=None, record_failure=False)
         success = True
     except Exception as e:
         print(f"[{job_id}] Pipeline error: {e}")
-        update_status(job_id, 'cloud_failed', error=str(e)[:500])
+        fail_job(job_id, str(e)[:500], job.get('attempt_count'))
     
     schedule_next_and_update_state(success=success)
     
@@ -1695,31 +2449,368 @@ def batch_process_next():
 
 
 def schedule_next_and_update_state(success):
-    """Schedule next job and update batch state counters"""
-    state = get_batch_state()
-    
-    if not state.get('batch_active'):
+    """Record the job result and schedule the next job (one dispatch round trip)"""
+    schedule_next_if_pending(dispatch_jobs(max_jobs=0, processed=1, failed=0 if success else 1))
+
+
+def update_batch_counters(success):
+    """Increment processed/failed counters. Returns False if the batch is no longer active."""
+    if not dispatch_jobs(max_jobs=0, processed=1, failed=0 if success else 1)['batch_active']:
+        print("Batch no longer active, not scheduling next")
+        return False
+    return True
+
+
+def schedule_next_if_pending(dispatch=None):
+    """Schedule the next Cloud Task if there is still work, otherwise end the batch.
+    `dispatch` is a dispatch_jobs() result that is fresh enough to decide on."""
+    dispatch = dispatch or dispatch_jobs(max_jobs=0)
+    if not dispatch['batch_active']:
         print("Batch no longer active, not scheduling next")
         return
     
-    processed = state.get('processed_jobs', 0) + 1
-    failed = state.get('failed_jobs', 0) + (0 if success else 1)
-    
-    set_batch_state(
-        batch_active=True,
-        processed_jobs=processed,
-        failed_jobs=failed
-    )
-    
-    pending = get_pending_jobs_count()
+    pending = dispatch['pending']
     if pending > 0:
+        delay = BATCH_INTERVAL_SECONDS
+        if dispatch.get('ready') == 0 and dispatch.get('next_attempt_at'):
+            # Everything left is backing off: wake up when the first retry is due
+            wait_seconds = (datetime.fromisoformat(dispatch['next_attempt_at']) - datetime.now(timezone.utc)).total_seconds()
+            delay = max(delay, int(wait_seconds) + 1)
+            print(f"All {pending} pending jobs are backing off, next retry due in {delay}s")
         print(f"Scheduling next job (still {pending} pending)...")
-        schedule_next_job(delay_seconds=BATCH_INTERVAL_SECONDS)
+        schedule_next_job(delay_seconds=delay)
     else:
         print("No more pending jobs, batch complete!")
         set_batch_state(batch_active=False)
 
 
+class PrefetchCancelled(Exception):
+    """Raised from the download callback when the prefetcher is stopped mid-download"""
+
+
+class DrivePrefetcher:
+    """
+    Prefetch stage for the batch executor: a background thread that claims the next
+    job(s) and downloads them into PREFETCH_DIR while the current jobs are encoding.
+    
+    - Bounded queue: at most `queue_size` jobs are claimed ahead (downloading + ready)
+    - Disk budget: staged bytes never exceed `disk_budget_bytes`; a file that does not
+      fit waits for space, a file larger than the whole budget or of unknown size is
+      handed over without prefetching (the pipeline downloads it itself)
+    - `should_continue()` is checked before every claim so prefetching stops together
+      with the executor (batch stopped / refill budget exhausted)
+    """
+    
+    def __init__(self, queue_size, disk_budget_bytes, staging_dir, should_continue):
+        self.queue_size = queue_size
+        self.disk_budget_bytes = disk_budget_bytes
+        self.staging_dir = staging_dir
+        self.should_continue = should_continue
+        self.ready = queue.Queue()
+        self.slots = threading.Semaphore(queue_size)
+        self.lock = threading.Lock()
+        self.space_freed = threading.Condition(self.lock)
+        self.staged_bytes = 0
+        self.in_flight = 0
+        self.exhausted = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='drive-prefetcher', daemon=True)
+    
+    def start(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.thread.start()
+        print(f"[Prefetch] Started (queue={self.queue_size}, budget={self.disk_budget_bytes / 1024 / 1024:.0f} MB)")
+    
+    def pending(self):
+        """Number of jobs that are downloading or ready to be taken"""
+        with self.lock:
+            return self.in_flight + self.ready.qsize()
+    
+    def get(self, timeout=None):
+        """Take the next prefetched item (blocks while a download is in flight).
+        Returns None if nothing is or will become available."""
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            try:
+                return self.ready.get(timeout=1)
+            except queue.Empty:
+                if self.pending() == 0 or self.stopped.is_set():
+                    return None
+                if deadline and time.time() > deadline:
+                    return None
+    
+    def consumed(self, item):
+        """Mark an item as taken by the executor: frees its queue slot and disk budget"""
+        with self.lock:
+            self.staged_bytes -= item.get('reserved_bytes', 0)
+            self.space_freed.notify_all()
+        self.slots.release()
+    
+    def stop(self):
+        """Stop prefetching, wait for the in-flight download to abort and hand every
+        unused job back: failed prefetches go through fail_job(), the rest to pending"""
+        self.stopped.set()
+        with self.lock:
+            self.space_freed.notify_all()
+        if self.thread.is_alive():
+            # No timeout: the download aborts at its next chunk (_check_stopped), and an
+            # item put on `ready` after the drain below would never be released
+            self.thread.join()
+        while True:
+            try:
+                item = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            job_id = item['job']['id']
+            # Stop extending the lease even if the status write below fails, so the
+            # watchdog can still recover the job by lease expiry
+            lease_keeper.release(job_id)
+            if item.get('path'):
+                shutil.rmtree(os.path.dirname(item['path']), ignore_errors=True)
+            if item.get('error'):
+                print(f"[Prefetch] [{job_id}] Dropping failed prefetch")
+                fail_job(job_id, item['error'], item['job'].get('attempt_count'))
+            else:
+                print(f"[Prefetch] [{job_id}] Releasing unused prefetched job")
+                update_status(job_id, 'pending', error='Released: prefetched but not started before batch task ended')
+            self.consumed(item)
+    
+    def _check_stopped(self, chunk, offset):
+        if self.stopped.is_set():
+            raise PrefetchCancelled()
+    
+    def _reserve(self, size):
+        """
+        Wait until `size` bytes fit in the disk budget. Returns the reserved byte count,
+        0 when the file can never fit (unknown size counts as too large). Raises
+        PrefetchCancelled when stop() is called while waiting.
+        """
+        if size <= 0 or size > self.disk_budget_bytes:
+            return 0
+        with self.lock:
+            while self.staged_bytes + size > self.disk_budget_bytes and not self.stopped.is_set():
+                self.space_freed.wait(timeout=5)
+            if self.stopped.is_set():
+                raise PrefetchCancelled()
+            self.staged_bytes += size
+            return size
+    
+    def _run(self):
+        while not self.stopped.is_set():
+            # Bounded queue: wait for a free prefetch slot
+            if not self.slots.acquire(timeout=1):
+                continue
+            if self.stopped.is_set() or not self.should_continue():
+                self.slots.release()
+                break
+            
+            jobs = claim_next_jobs(1)
+            if not jobs:
+                self.slots.release()
+                self.exhausted = True
+                print("[Prefetch] No more jobs to prefetch")
+                break
+            
+            job = jobs[0]
+            job_id = job['id']
+            with self.lock:
+                self.in_flight += 1
+            item = {'job': job, 'path': None, 'reserved_bytes': 0, 'error': None}
+            try:
+                access_token = get_google_access_token()
+                if not access_token:
+                    raise Exception('Failed to get Google access token')
+                item['access_token'] = access_token
+                
+                size = get_drive_file_size(job['drive_file_id'], access_token)
+                item['reserved_bytes'] = self._reserve(size)
+                if item['reserved_bytes']:
+                    job_dir = os.path.join(self.staging_dir, job_id)
+                    os.makedirs(job_dir, exist_ok=True)
+                    item['path'] = os.path.join(job_dir, 'input.mp4')
+                    print(f"[Prefetch] [{job_id}] Downloading {size / 1024 / 1024:.0f} MB ahead of time")
+                    update_status(job_id, 'cloud_downloading')
+                    download_from_drive_resumable(
+                        drive_file_id=job['drive_file_id'],
+                        access_token=access_token,
+                        output_path=item['path'],
+                        job_id=job_id,
+                        max_retries=5,
+                        max_time=1800,
+                        on_chunk=self._check_stopped
+                    )
+                elif size <= 0:
+                    print(f"[Prefetch] [{job_id}] Unknown file size, pipeline will download it")
+                else:
+                    print(f"[Prefetch] [{job_id}] {size / 1024 / 1024:.0f} MB exceeds disk budget, pipeline will download it")
+                update_status(job_id, 'cloud_prefetched')
+            except PrefetchCancelled:
+                # Not a failure of the job: stop() releases it to pending
+                print(f"[Prefetch] [{job_id}] Download cancelled, prefetcher stopping")
+                if item['path']:
+                    shutil.rmtree(os.path.dirname(item['path']), ignore_errors=True)
+                    item['path'] = None
+            except Exception as e:
+                print(f"[Prefetch] [{job_id}] Prefetch failed: {e}")
+                item['error'] = str(e)[:500]
+                if item['path']:
+                    shutil.rmtree(os.path.dirname(item['path']), ignore_errors=True)
+                    item['path'] = None
+            
+            with self.lock:
+                self.in_flight -= 1
+                self.ready.put(item)
+
+
+def run_pipeline_in_slot(job_id, drive_file_id, access_token, prefetched_path=None):
+    """Process-pool entry point: run one pipeline and report the outcome instead of raising"""
+    try:
+        run_pipeline(job_id, drive_file_id, access_token, callback_url=None, prefetched_path=prefetched_path,
+                     record_failure=False)
+        success, error = True, None
+    except Exception as e:
+        success, error = False, str(e)[:500]
+    # Nothing may stay buffered in this process; report the writer/cache counters upstream
+    progress_writer.flush()
+    metrics = progress_writer.drain_metrics()
+    metrics['embedding_cache'] = embedding_cache.drain_counters()
+    return success, error, metrics
+
+
+def run_batch_slots(slots, prefetch=PREFETCH_QUEUE_SIZE, claimed=None):
+    """
+    Multi-slot executor: keep up to `slots` pipelines running in a process pool.
+    Every pipeline gets its own process and its own TemporaryDirectory, so jobs never
+    share files. As soon as a job finishes its slot is refilled with a freshly claimed
+    job, until the batch is stopped, the queue is empty or SLOT_REFILL_BUDGET_SECONDS
+    has passed. With prefetch > 0 the next jobs are claimed and downloaded by a
+    DrivePrefetcher while the current ones encode. `claimed` jobs (already claimed by
+    the caller's dispatch) are started first.
+    Returns a list of {job_id, success, error} dicts.
+    """
+    deadline = time.time() + SLOT_REFILL_BUDGET_SECONDS
+    results = []
+    running = {}
+    attempts = {}  # job_id -> attempt_count returned by the claim
+    
+    def may_refill():
+        return time.time() <= deadline and get_batch_state().get('batch_active', False)
+    
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = DrivePrefetcher(
+            queue_size=prefetch,
+            disk_budget_bytes=PREFETCH_DISK_BUDGET_MB * 1024 * 1024,
+            staging_dir=PREFETCH_DIR,
+            should_continue=may_refill
+        )
+    
+    print(f"[Slots] Starting multi-slot executor with {slots} slots (prefetch: {prefetch})")
+    
+    def record_failure(job_id, error):
+        print(f"[{job_id}] Pipeline error: {error}")
+        fail_job(job_id, error, attempts.pop(job_id, None))
+        update_batch_counters(success=False)
+        results.append({'job_id': job_id, 'success': False, 'error': error})
+    
+    # 'spawn' instead of fork: the Flask server is multi-threaded and forking it can
+    # deadlock on locks held by other threads (requests pools, stdout)
+    with ProcessPoolExecutor(max_workers=slots, mp_context=multiprocessing.get_context('spawn')) as pool:
+        
+        def submit(job_id, drive_file_id, access_token, prefetched_path=None):
+            try:
+                future = pool.submit(run_pipeline_in_slot, job_id, drive_file_id, access_token, prefetched_path)
+            except BrokenProcessPool:
+                # Pool is unusable: hand the job back so the next task can pick it up
+                print(f"[{job_id}] Process pool broken, releasing job")
+                update_status(job_id, 'pending', error='Released: worker process pool crashed')
+                return
+            running[future] = job_id
+            print(f"[Slots] [{job_id}] Started in slot ({len(running)}/{slots} busy)")
+        
+        def take_prefetched():
+            """Start a prefetched job. Returns False if the prefetcher has nothing (left)."""
+            item = prefetcher.get(timeout=SLOT_REFILL_BUDGET_SECONDS)
+            if not item:
+                return False
+            prefetcher.consumed(item)
+            job_id = item['job']['id']
+            attempts[job_id] = item['job'].get('attempt_count')
+            if item['error']:
+                lease_keeper.release(job_id)
+                record_failure(job_id, item['error'])
+                return True
+            # The watchdog may have reset a job that waited too long: re-claim it first
+            if not claim_job(job_id, from_statuses='cloud_prefetched'):
+                print(f"[Prefetch] [{job_id}] No longer ours, discarding prefetched file")
+                lease_keeper.release(job_id)
+                if item['path']:
+                    shutil.rmtree(os.path.dirname(item['path']), ignore_errors=True)
+                return True
+            submit(job_id, item['job']['drive_file_id'], item['access_token'], item['path'])
+            return True
+        
+        def start_claimed(jobs):
+            for job in jobs:
+                job_id = job['id']
+                attempts[job_id] = job.get('attempt_count')
+                access_token = get_google_access_token()
+                if not access_token:
+                    record_failure(job_id, 'Failed to get Google access token')
+                    continue
+                submit(job_id, job['drive_file_id'], access_token)
+        
+        def fill_slots():
+            while len(running) < slots:
+                if not may_refill():
+                    print("[Slots] Batch stopped or refill budget exhausted, letting running jobs finish")
+                    return
+                
+                if prefetcher and prefetcher.pending() > 0:
+                    take_prefetched()
+                    continue
+                
+                jobs = claim_next_jobs(slots - len(running))
+                if not jobs:
+                    return
+                start_claimed(jobs)
+        
+        start_claimed(claimed or [])
+        fill_slots()
+        if prefetcher:
+            prefetcher.start()
+        
+        try:
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = running.pop(future)
+                    # The slot process wrote the final status; stop extending the lease
+                    lease_keeper.release(job_id)
+                    try:
+                        success, error, slot_metrics = future.result()
+                        progress_writer.add_metrics(slot_metrics)
+                        embedding_cache.add_counters(slot_metrics.get('embedding_cache'))
+                    except BrokenProcessPool as e:
+                        success, error = False, f"Worker process crashed: {e}"
+                    
+                    if success:
+                        attempts.pop(job_id, None)
+                        update_batch_counters(success=True)
+                        results.append({'job_id': job_id, 'success': True, 'error': None})
+                    else:
+                        record_failure(job_id, error)
+                    print(f"[Slots] [{job_id}] Finished ({'ok' if success else 'failed'}), {len(running)}/{slots} busy")
+                
+                fill_slots()
+        finally:
+            if prefetcher:
+                prefetcher.stop()
+    
+    print(f"[Slots] Executor done: {len(results)} jobs processed")
+    return results
+
+
 @app.route('/test-supabase', methods=['POST'])
 def test_supabase():
     """Test endpoint to verify Supabase connection"""
@@ -1740,25 +2831,20 @@ def test_supabase():
         return jsonify(result), 500
     
     try:
-        resp = requests.patch(
-            f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}',
+        resp = db.request(
+            'PATCH', 'video_ingest_jobs',
+            params={'id': f'eq.{job_id}'},
             json={'status': 'cloud_test'},
-            headers={
-                'apikey': SUPABASE_KEY,
-                'Authorization': f'Bearer {SUPABASE_KEY}',
-                'Content-Type': 'application/json',
-                'Prefer': 'return=minimal'
-            },
-            timeout=10
+            prefer='return=minimal',
+            retry=False
         )
         result['status_code'] = resp.status_code
         result['response'] = resp.text[:200] if resp.text else 'empty'
-        
-        if resp.status_code in [200, 204]:
-            result['success'] = True
-        else:
-            result['success'] = False
-            
+        result['success'] = True
+    except SupabaseError as e:
+        result['status_code'] = e.status_code
+        result['response'] = e.text[:200] if e.text else 'empty'
+        result['success'] = False
     except Exception as e:
         result['error'] = str(e)[:200]
         result['success'] = False
@@ -1766,40 +2852,364 @@ def test_supabase():
     return jsonify(result)
 
 
-def run_pipeline(job_id, drive_file_id, access_token, callback_url):
-    """Background worker function - runs the full video pipeline"""
+CHROMAKEY_FILTER = (
+    "[0:v]format=yuva444p,chromakey=0x00FF00:0.29:0.10,"
+    "despill=type=green:mix=0.78:expand=0.06,"
+    "lutyuv=a='if(lt(val,90),0,if(gt(val,140),255,val))'[fg];"
+    "[1:v][fg]scale2ref=iw:ih:flags=lanczos[bg][fgref];"
+    "[bg][fgref]overlay=0:0:shortest=1,format=yuv420p[out]"
+)
+
+
+def select_background(job_id):
+    """Select background based on processed_jobs count (rotate every BACKGROUND_BATCH_SIZE videos)"""
+    batch_state = get_batch_state()
+    processed_jobs = batch_state.get('processed_jobs', 0)
+    bg_index = (processed_jobs // BACKGROUND_BATCH_SIZE) % len(BACKGROUNDS)
+    bg_path = BACKGROUNDS[bg_index]
+    bg_name = os.path.basename(bg_path)
+    print(f"[{job_id}] Using background {bg_index + 1}/{len(BACKGROUNDS)}: {bg_name} (processed: {processed_jobs})")
+    return bg_path, bg_name
+
+
+CHROMAKEY_INPUT_ARGS = [
+    '-color_primaries', 'bt709',
+    '-color_trc', 'bt709',
+    '-colorspace', 'bt709',
+]
+
+CHROMAKEY_X264_ARGS = [
+    '-c:v', 'libx264', 
+    '-preset', 'medium',  # Changed from 'slow' for 3-4x faster encoding
+    '-crf', '14',
+    '-profile:v', 'high',
+    '-level:v', '4.2',
+    '-pix_fmt', 'yuv420p',
+    '-maxrate', '18M',
+    '-bufsize', '36M',
+    '-tune', 'film',
+]
+
+
+def mp3_output_args(audio_file, source='0:a?'):
+    """Extra ffmpeg output: transcription mp3 from the same decode."""
+    return [
+        '-map', source,
+        '-vn', '-acodec', 'libmp3lame', '-q:a', '4',
+        audio_file
+    ]
+
+
+def build_chromakey_cmd(input_spec, bg_path, output_video, audio_file=None):
+    """
+    ffmpeg command for chromakey + background overlay. input_spec is a path or 'pipe:0'.
+    With audio_file the same decode also writes the transcription mp3 as a second output.
+    """
+    cmd = [
+        'ffmpeg', '-y',
+        *CHROMAKEY_INPUT_ARGS,
+        '-i', input_spec,
+        '-loop', '1',
+        '-i', bg_path,
+        '-filter_complex', CHROMAKEY_FILTER,
+        '-map', '[out]', '-map', '0:a?',
+        *CHROMAKEY_X264_ARGS,
+        '-movflags', '+faststart',
+        '-c:a', 'aac', '-b:a', '192k',
+        '-shortest',
+        output_video
+    ]
+    if audio_file:
+        cmd += mp3_output_args(audio_file)
+    return cmd
+
+
+def apply_chromakey_segmented(input_video, bg_path, output_video, segments, audio_file=None):
+    """
+    Segment-parallel chromakey (chromakey_segments.py): split at keyframes, key + encode
+    every part in its own ffmpeg process, then concat the parts (stream copy) and mux the
+    audio from the original file in one pass, so there are no audio gaps at the part boundaries.
+    """
+    work_dir = os.path.join(os.path.dirname(output_video), 'chromakey_segments')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # The CPU allowance is shared between the parts and the other slots of this instance
+        concat_list, parts, threads = render_keyed_segments(
+            input_video, bg_path, work_dir, segments,
+            CHROMAKEY_FILTER, CHROMAKEY_X264_ARGS,
+            input_args=CHROMAKEY_INPUT_ARGS,
+            concurrent_jobs=WORKER_SLOTS
+        )
+        
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat', '-safe', '0', '-i', concat_list,
+            '-i', input_video,
+            '-map', '0:v', '-map', '1:a?',
+            '-c:v', 'copy',
+            '-movflags', '+faststart',
+            '-c:a', 'aac', '-b:a', '192k',
+            '-shortest',
+            output_video
+        ]
+        if audio_file:
+            cmd += mp3_output_args(audio_file, source='1:a?')
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"Segment concat failed: {result.stderr[-500:]}")
+        print(f"Chromakey rendered in {parts} parallel segments ({threads} threads each)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def apply_chromakey(input_video, bg_path, output_video, audio_file=None, segments=None):
+    """
+    Run the chromakey encode on a file on disk. Raises on ffmpeg failure.
+    segments > 1 renders segment-parallel (default: CHROMAKEY_SEGMENTS); if that
+    fails the single full encode is used.
+    """
+    if segments is None:
+        segments = CHROMAKEY_SEGMENTS
+    if segments > 1:
+        try:
+            apply_chromakey_segmented(input_video, bg_path, output_video, segments, audio_file)
+            return
+        except Exception as e:
+            print(f"Segmented chromakey failed, falling back to single encode: {str(e)[:200]}")
+    result = subprocess.run(build_chromakey_cmd(input_video, bg_path, output_video, audio_file), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Chromakey failed: {result.stderr[-500:]}")
+
+
+def mp4_moov_before_mdat(header):
+    """
+    Walk the top-level MP4 boxes in `header`.
+    Returns True if 'moov' comes before 'mdat' (decodable from a pipe), False if 'mdat'
+    comes first (moov at the end, needs a seekable file), None if header is too short.
+    """
+    pos = 0
+    while pos + 8 <= len(header):
+        size = int.from_bytes(header[pos:pos + 4], 'big')
+        box_type = header[pos + 4:pos + 8]
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1:
+            if pos + 16 > len(header):
+                return None
+            size = int.from_bytes(header[pos + 8:pos + 16], 'big')
+        if size < 8:
+            return False
+        pos += size
+    return None
+
+
+class ChromakeyStreamTee:
+    """
+    Streaming chromakey: receives the Drive download chunks (via on_chunk) and pipes
+    them into an ffmpeg chromakey process, so keying starts while bytes still arrive.
+    
+    Streaming is only used for 'faststart' files (moov before mdat); camera files with
+    the moov atom at the end cannot be decoded from a pipe and fall back to the normal
+    encode from the disk copy. Any problem (server restarted the download, ffmpeg
+    error) just disables streaming - finish() then returns False and run_pipeline
+    re-encodes from disk.
+    
+    Chunks are handed to a writer thread through a bounded buffer, so a slow encode
+    never holds up the download (Drive resets idle connections). If the encoder falls
+    more than BUFFER_CHUNKS behind, streaming is disabled instead of blocking.
+    """
+    HEADER_PROBE_LIMIT = 1024 * 1024
+    BUFFER_CHUNKS = 1024  # ~64 MB of 64 KB download chunks
+    
+    def __init__(self, bg_path, output_video, job_id, tmpdir, audio_file=None):
+        self.bg_path = bg_path
+        self.output_video = output_video
+        self.audio_file = audio_file
+        self.job_id = job_id
+        self.stderr_path = os.path.join(tmpdir, 'chromakey_stream.log')
+        self.header = b''
+        self.fed = 0
+        self.proc = None
+        self.active = True
+        self.buffer = None
+        self.writer = None
+        self.write_error = None
+    
+    def _disable(self, reason):
+        print(f"[{self.job_id}] Streaming chromakey disabled: {reason}")
+        self.active = False
+        if self.proc:
+            # Kill first: a writer blocked on the pipe then fails and exits
+            self.proc.kill()
+            self._stop_writer(drain=False)
+            try:
+                self.proc.stdin.close()
+            except Exception:
+                pass
+            self.proc.wait()
+            self.proc = None
+            self.stderr_file.close()
+    
+    def abort(self, reason):
+        """Kill the encode (e.g. the download failed) and release its files"""
+        if self.active:
+            self._disable(reason)
+    
+    def _run_writer(self):
+        while True:
+            data = self.buffer.get()
+            if data is None:
+                return
+            try:
+                self.proc.stdin.write(data)
+            except (BrokenPipeError, OSError, ValueError) as e:
+                self.write_error = e
+                return
+    
+    def _stop_writer(self, drain):
+        """Stop the writer thread; with drain=True after it wrote everything buffered"""
+        if self.writer is None:
+            return
+        if drain:
+            # The writer may exit on a write error while the buffer is full
+            while self.writer.is_alive():
+                try:
+                    self.buffer.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        else:
+            try:
+                self.buffer.put_nowait(None)
+            except queue.Full:
+                pass  # the writer is in a write that fails now that ffmpeg is gone
+        self.writer.join()
+        self.writer = None
+    
+    def _start(self):
+        print(f"[{self.job_id}] Streaming chromakey: moov before mdat, encoding while downloading")
+        update_progress(self.job_id, "Download + chromakey (streaming)...")
+        self.stderr_file = open(self.stderr_path, 'wb')
+        self.proc = subprocess.Popen(
+            build_chromakey_cmd('pipe:0', self.bg_path, self.output_video, self.audio_file),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=self.stderr_file
+        )
+        self.buffer = queue.Queue(maxsize=self.BUFFER_CHUNKS)
+        self.writer = threading.Thread(target=self._run_writer, name=f'chromakey-tee-{self.job_id}', daemon=True)
+        self.writer.start()
+    
+    def _write(self, data):
+        if self.write_error:
+            self._disable(f"ffmpeg stopped reading ({self.write_error})")
+            return
+        try:
+            self.buffer.put_nowait(data)
+        except queue.Full:
+            self._disable("encoder fell behind the download, re-encoding from disk")
+    
+    def feed(self, chunk, offset):
+        if not self.active:
+            return
+        if offset != self.fed:
+            # Download restarted from byte 0 (server ignored Range): stream is no longer contiguous
+            self._disable("download restarted, stream not contiguous")
+            return
+        self.fed += len(chunk)
+        
+        if self.proc is None:
+            self.header += chunk
+            streamable = mp4_moov_before_mdat(self.header)
+            if streamable is None and len(self.header) < self.HEADER_PROBE_LIMIT:
+                return
+            if not streamable:
+                self._disable("moov atom not at start of file")
+                return
+            self._start()
+            data, self.header = self.header, b''
+            self._write(data)
+        else:
+            self._write(chunk)
+    
+    def finish(self):
+        """Close ffmpeg's input and wait for the encode. Returns True if the output is usable."""
+        if not self.active or self.proc is None:
+            return False
+        self._stop_writer(drain=True)
+        if self.write_error:
+            self._disable(f"ffmpeg stopped reading ({self.write_error})")
+            return False
+        try:
+            self.proc.stdin.close()
+        except Exception:
+            pass
+        returncode = self.proc.wait()
+        self.stderr_file.close()
+        if returncode != 0:
+            with open(self.stderr_path, 'rb') as f:
+                tail = f.read()[-500:].decode('utf-8', errors='replace')
+            print(f"[{self.job_id}] Streaming chromakey failed, re-encoding from disk: {tail}")
+            return False
+        return True
+
+
+def run_pipeline(job_id, drive_file_id, access_token, callback_url, prefetched_path=None, record_failure=True):
+    """Background worker function - runs the full video pipeline.
+    If prefetched_path is given the Drive download was already done by the prefetcher.
+    record_failure=False: the caller writes the failure status (batch paths, fail_job),
+    so a failed job is not first marked cloud_failed."""
     try:
         with tempfile.TemporaryDirectory() as tmpdir:
             input_video = f'{tmpdir}/input.mp4'
             output_video = f'{tmpdir}/output.mp4'
             audio_file = f'{tmpdir}/audio.mp3'
             
-            print(f"[{job_id}] Step 1/7: Downloading from Drive (resumable)...")
-            update_status(job_id, 'cloud_downloading')
-            update_progress(job_id, "Starting download...")
+            bg_path = bg_name = None
+            streamed = False
             
-            file_size = download_from_drive_resumable(
-                drive_file_id=drive_file_id,
-                access_token=access_token,
-                output_path=input_video,
-                job_id=job_id,
-                max_retries=5,
-                max_time=1800
-            )
+            if prefetched_path and os.path.exists(prefetched_path):
+                print(f"[{job_id}] Step 1/7: Using prefetched download")
+                shutil.move(prefetched_path, input_video)
+                file_size = os.path.getsize(input_video)
+            else:
+                print(f"[{job_id}] Step 1/7: Downloading from Drive (resumable)...")
+                update_status(job_id, 'cloud_downloading')
+                update_progress(job_id, "Starting download...")
+                
+                stream_tee = None
+                if STREAMING_CHROMAKEY and CHROMAKEY_SEGMENTS <= 1:
+                    # Key + encode while the bytes arrive; the disk copy is still written
+                    # for the duration probe and as fallback input
+                    bg_path, bg_name = select_background(job_id)
+                    stream_tee = ChromakeyStreamTee(bg_path, output_video, job_id, tmpdir, audio_file)
+                
+                try:
+                    file_size = download_from_drive_resumable(
+                        drive_file_id=drive_file_id,
+                        access_token=access_token,
+                        output_path=input_video,
+                        job_id=job_id,
+                        max_retries=5,
+                        max_time=1800,
+                        on_chunk=stream_tee.feed if stream_tee else None
+                    )
+                except BaseException:
+                    # Don't leave the streaming encode running on a half-downloaded input
+                    if stream_tee:
+                        stream_tee.abort("download failed")
+                    raise
+                
+                if stream_tee:
+                    streamed = stream_tee.finish()
             
             update_progress(job_id, f"Download complete: {file_size/1024/1024:.0f} MB")
             
             # Check video duration - skip videos < 30 seconds
             MINIMUM_DURATION_SECONDS = 30
-            duration_cmd = [
-                'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                '-of', 'default=nokey=1:noprint_wrappers=1', input_video
-            ]
-            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-            try:
-                video_duration = float(duration_result.stdout.strip())
-            except (ValueError, TypeError):
-                video_duration = 0
+            video_duration = probe_duration(input_video)
             
             print(f"[{job_id}] Video duration: {video_duration:.1f} seconds")
             
@@ -1808,17 +3218,10 @@ def run_pipeline(job_id, drive_file_id, access_token, callback_url):
                 update_status(job_id, 'skipped_too_short')
                 update_progress(job_id, f"Skipped: video too short ({video_duration:.1f}s)")
                 # Update duration in database before returning
-                requests.patch(
-                    f'{SUPABASE_URL}/rest/v1/video_ingest_jobs?id=eq.{job_id}',
-                    json={'duration_seconds': int(video_duration)},
-                    headers={
-                        'apikey': SUPABASE_KEY,
-                        'Authorization': f'Bearer {SUPABASE_KEY}',
-                        'Content-Type': 'application/json',
-                        'Prefer': 'return=minimal'
-                    },
-                    timeout=10
-                )
+                try:
+                    db.patch('video_ingest_jobs', {'id': f'eq.{job_id}'}, {'duration_seconds': int(video_duration)})
+                except SupabaseError as e:
+                    print(f"[{job_id}] Failed to store duration: {e}")
                 return
             
             probe_cmd = [
@@ -1832,81 +3235,54 @@ def run_pipeline(job_id, drive_file_id, access_token, callback_url):
             print(f"[{job_id}] INPUT VIDEO METADATA: {color_info}")
             update_progress(job_id, f"Input: {color_info}")
             
-            print(f"[{job_id}] Step 2/7: Applying chromakey...")
-            update_status(job_id, 'cloud_chromakey')
-            update_progress(job_id, "Chromakey processing...")
-            
-            # Select background based on processed_jobs count (rotate every BACKGROUND_BATCH_SIZE videos)
-            batch_state = get_batch_state()
-            processed_jobs = batch_state.get('processed_jobs', 0)
-            bg_index = (processed_jobs // BACKGROUND_BATCH_SIZE) % len(BACKGROUNDS)
-            bg_path = BACKGROUNDS[bg_index]
-            bg_name = os.path.basename(bg_path)
-            print(f"[{job_id}] Using background {bg_index + 1}/{len(BACKGROUNDS)}: {bg_name} (processed: {processed_jobs})")
-            
-            filter_complex = (
-                "[0:v]format=yuva444p,chromakey=0x00FF00:0.29:0.10,"
-                "despill=type=green:mix=0.78:expand=0.06,"
-                "lutyuv=a='if(lt(val,90),0,if(gt(val,140),255,val))'[fg];"
-                "[1:v][fg]scale2ref=iw:ih:flags=lanczos[bg][fgref];"
-                "[bg][fgref]overlay=0:0:shortest=1,format=yuv420p[out]"
-            )
-            
-            cmd = [
-                'ffmpeg', '-y',
-                '-color_primaries', 'bt709',
-                '-color_trc', 'bt709',
-                '-colorspace', 'bt709',
-                '-i', input_video,
-                '-loop', '1',
-                '-i', bg_path,
-                '-filter_complex', filter_complex,
-                '-map', '[out]', '-map', '0:a?',
-                '-c:v', 'libx264', 
-                '-preset', 'medium',  # Changed from 'slow' for 3-4x faster encoding
-                '-crf', '14',
-                '-profile:v', 'high',
-                '-level:v', '4.2',
-                '-pix_fmt', 'yuv420p',
-                '-maxrate', '18M',
-                '-bufsize', '36M',
-                '-tune', 'film',
-                '-movflags', '+faststart',
-                '-c:a', 'aac', '-b:a', '192k',
-                '-shortest',
-                output_video
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"Chromakey failed: {result.stderr[-500:]}")
+            if streamed:
+                print(f"[{job_id}] Step 2/7: Chromakey already done while downloading (streaming)")
+            else:
+                print(f"[{job_id}] Step 2/7: Applying chromakey...")
+                update_status(job_id, 'cloud_chromakey')
+                update_progress(job_id, "Chromakey processing...")
+                
+                if not bg_path:
+                    bg_path, bg_name = select_background(job_id)
+                apply_chromakey(input_video, bg_path, output_video, audio_file)
             
             output_size = os.path.getsize(output_video) / 1024 / 1024
             print(f"[{job_id}] Chromakey done: {output_size:.1f} MB")
             
-            print(f"[{job_id}] Step 3/7: Extracting audio...")
-            update_status(job_id, 'cloud_audio')
-            
-            subprocess.run([
-                'ffmpeg', '-y', '-i', input_video,
-                '-vn', '-acodec', 'libmp3lame', '-q:a', '4',
-                audio_file
-            ], check=True, capture_output=True)
+            if os.path.exists(audio_file) and os.path.getsize(audio_file) > 0:
+                # Written by the chromakey pass (same decode, second output)
+                print(f"[{job_id}] Step 3/7: Audio already extracted during chromakey")
+            else:
+                print(f"[{job_id}] Step 3/7: Extracting audio...")
+                update_status(job_id, 'cloud_audio')
+                
+                subprocess.run([
+                    'ffmpeg', '-y', '-i', input_video,
+                    '-vn', '-acodec', 'libmp3lame', '-q:a', '4',
+                    audio_file
+                ], check=True, capture_output=True)
             
             print(f"[{job_id}] Step 4/7: Transcribing with ElevenLabs...")
             update_status(job_id, 'cloud_transcribing')
-            transcript = transcribe_audio(audio_file)
+            transcription = transcribe_audio(audio_file, with_words=True)
+            transcript = transcription['text']
             
             print(f"[{job_id}] Step 5/7: Generating embeddings...")
             update_status(job_id, 'cloud_embedding')
-            embedding = generate_embedding(transcript)
+            chunks = []
+            if RAG_CHUNKING:
+                embedding, chunks = embed_transcript(transcript, transcription['words'])
+                if chunks:
+                    print(f"[{job_id}] Embedded {len(chunks)} transcript chunks (pooled document vector)")
+            else:
+                embedding = generate_embedding(transcript)
             
             rag_doc_id = None
             ai_techniek_id = None
             ai_confidence = None
             if embedding:
                 print(f"[{job_id}] Saving to RAG corpus...")
-                rag_doc_id = save_to_rag(job_id, transcript, embedding)
+                rag_doc_id = save_to_rag(job_id, transcript, embedding, chunks=chunks)
                 
                 # AI Technique Matching: find best matching technique based on transcript
                 print(f"[{job_id}] Step 5b/7: AI Technique Matching...")
@@ -1984,17 +3360,8 @@ def run_pipeline(job_id, drive_file_id, access_token, callback_url):
             
             update_status(job_id, 'completed', **update_data)
             
-            # Increment processed_jobs counter for background rotation
-            try:
-                current_state = get_batch_state()
-                new_processed = current_state.get('processed_jobs', 0) + 1
-                set_batch_state(
-                    batch_active=current_state.get('batch_active', False),
-                    processed_jobs=new_processed
-                )
-                print(f"[{job_id}] Background rotation counter: {new_processed}")
-            except Exception as e:
-                print(f"[{job_id}] Warning: failed to update processed_jobs counter: {e}")
+            # processed_jobs (background rotation) is incremented by the caller's dispatch
+            # (dispatch_jobs processed_delta): atomic across slots and never touches batch_active
             
             print(f"\n[{job_id}] ✅ COMPLETE!")
             print(f"  - Playback ID: {mux_playback_id}")
@@ -2018,7 +3385,8 @@ def run_pipeline(job_id, drive_file_id, access_token, callback_url):
         error_msg = str(e)
         print(f"\n[{job_id}] ❌ ERROR: {error_msg}")
         
-        update_status(job_id, 'cloud_failed', error=error_msg)
+        if record_failure:
+            update_status(job_id, 'cloud_failed', error=error_msg)
         
         if callback_url:
             try:
@@ -6,19 +6,32 @@ This script matches existing video transcripts to EPIC sales techniques
 WITHOUT re-running the entire video processing pipeline.
 
 It uses the existing embeddings from rag_documents (doc_type='hugo_training')
-and matches them against the 49 technique embeddings using cosine similarity.
+and matches them against the 49 technique embeddings with the shared matcher
+(cloud-run/technique_matching.py, same results as the Cloud Run worker).
+
+Bulk mode:
+- video titles are resolved through a filename index built once (no linear scan
+  over all hugo_training documents per video)
+- all video embeddings are matched in one batched matrix product
+- results are written in batches via the bulk_set_ai_suggestions() RPC
+  (scripts/sql/bulk_set_ai_suggestions.sql), falling back to one update per
+  video when the function is not installed
 
 Usage:
-    python3 scripts/backfill_ai_techniek_matching.py [--dry-run] [--limit N]
+    python3 scripts/backfill_ai_techniek_matching.py [--dry-run] [--limit N] [--threshold 0.30] [--top-k 3] [--batch-size 500]
 """
 
 import os
 import sys
 import json
+import bisect
 import argparse
-import numpy as np
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-run'))
+from technique_matching import MIN_CONFIDENCE, TechniqueMatrix
+
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
 
@@ -28,45 +41,16 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-CONFIDENCE_THRESHOLD = 0.30
-
-
-def cosine_similarity(vec_a, vec_b):
-    """Calculate cosine similarity between two vectors."""
-    vec_a = np.array(vec_a)
-    vec_b = np.array(vec_b)
-    
-    if vec_a.shape != vec_b.shape:
-        return 0.0
-    
-    dot = np.dot(vec_a, vec_b)
-    norm_a = np.linalg.norm(vec_a)
-    norm_b = np.linalg.norm(vec_b)
-    
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    
-    return dot / (norm_a * norm_b)
-
+MEDIA_EXTENSIONS = ('.m4a', '.mp4', '.mp3', '.mov', '.wav')
 
 def get_technique_embeddings():
-    """Fetch all technique embeddings from rag_documents."""
+    """Fetch all technique embeddings from rag_documents as a TechniqueMatrix."""
     print("Fetching technique embeddings...")
     result = supabase.table('rag_documents').select(
-        'id, source_id, embedding'
+        'id, techniek_id, source_id, title, embedding'
     ).eq('doc_type', 'techniek').execute()
     
-    techniques = []
-    for row in result.data:
-        if row.get('embedding'):
-            embedding = row['embedding']
-            if isinstance(embedding, str):
-                embedding = json.loads(embedding)
-            techniques.append({
-                'techniek_id': row['source_id'],
-                'embedding': embedding
-            })
-    
+    techniques = TechniqueMatrix(result.data)
     print(f"Found {len(techniques)} technique embeddings")
     return techniques
 
@@ -96,20 +80,42 @@ def get_hugo_training_embeddings():
     return embeddings
 
 
-def match_technique(video_embedding, technique_embeddings):
-    """Find the best matching technique for a video embedding."""
-    best_match = None
-    best_score = 0.0
-    
-    for tech in technique_embeddings:
-        score = cosine_similarity(video_embedding, tech['embedding'])
-        if score > best_score:
-            best_score = score
-            best_match = tech['techniek_id']
-    
-    if best_score >= CONFIDENCE_THRESHOLD:
-        return best_match, best_score
-    return None, best_score
+def normalize_filename(name):
+    """'MVI_0606.MP4' / 'mvi_0606.m4a' / 'MVI_0606' → 'mvi_0606'."""
+    name = (name or '').strip().lower()
+    for ext in MEDIA_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+class FilenameIndex:
+    """
+    Lookup of hugo_training embeddings by video title, built once.
+    Exact source_id first, then the normalized name (case/extension-insensitive),
+    then the first source_id that starts with the normalized name (binary search
+    over the sorted names instead of a substring scan over every document).
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.by_name = {}
+        for key in sorted(embeddings):
+            self.by_name.setdefault(normalize_filename(key), key)
+        self.sorted_names = sorted(self.by_name)
+
+    def lookup(self, title):
+        if title in self.embeddings:
+            return self.embeddings[title]
+        base_name = normalize_filename(title)
+        if not base_name:
+            return None
+        key = self.by_name.get(base_name)
+        if key is None:
+            pos = bisect.bisect_left(self.sorted_names, base_name)
+            if pos < len(self.sorted_names) and self.sorted_names[pos].startswith(base_name):
+                key = self.by_name[self.sorted_names[pos]]
+        return self.embeddings[key] if key else None
 
 
 def get_completed_videos_without_ai_suggestion(limit=None):
@@ -140,10 +146,41 @@ def update_video_ai_suggestion(video_id, techniek_id, confidence, rag_document_i
     supabase.table('video_ingest_jobs').update(update_data).eq('id', video_id).execute()
 
 
+def write_ai_suggestions(updates, batch_size=500):
+    """
+    Write [{'id', 'ai_suggested_techniek_id', 'ai_confidence', 'rag_document_id'}, ...]
+    in batches through the bulk_set_ai_suggestions() RPC. Falls back to one update
+    per video if the function is not installed. Returns the number of updated rows.
+    """
+    written = 0
+    for start in range(0, len(updates), batch_size):
+        batch = updates[start:start + batch_size]
+        try:
+            result = supabase.rpc('bulk_set_ai_suggestions', {'updates': batch}).execute()
+            written += result.data or 0
+            print(f"  Wrote batch {start // batch_size + 1}: {len(batch)} videos")
+        except Exception as e:
+            print(f"  ⚠️  bulk_set_ai_suggestions RPC failed ({e}); run scripts/sql/bulk_set_ai_suggestions.sql")
+            print("  Falling back to one update per video...")
+            for update in updates[start:]:
+                update_video_ai_suggestion(
+                    update['id'],
+                    update['ai_suggested_techniek_id'],
+                    update['ai_confidence'],
+                    update['rag_document_id']
+                )
+                written += 1
+            break
+    return written
+
+
 def main():
     parser = argparse.ArgumentParser(description='Backfill AI technique matching')
     parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making changes')
     parser.add_argument('--limit', type=int, help='Limit number of videos to process')
+    parser.add_argument('--threshold', type=float, default=MIN_CONFIDENCE, help=f'Minimum confidence (default {MIN_CONFIDENCE})')
+    parser.add_argument('--top-k', type=int, default=3, help='Number of candidates to show per video')
+    parser.add_argument('--batch-size', type=int, default=500, help='Videos per bulk update (default 500)')
     args = parser.parse_args()
     
     print("=" * 60)
@@ -154,7 +191,7 @@ def main():
         print(">>> DRY RUN MODE - No changes will be made <<<\n")
     
     technique_embeddings = get_technique_embeddings()
-    if not technique_embeddings:
+    if not len(technique_embeddings):
         print("ERROR: No technique embeddings found. Run generate_techniek_embeddings.py first.")
         sys.exit(1)
     
@@ -172,44 +209,54 @@ def main():
     no_match = 0
     no_embedding = 0
     
+    # Resolve the embedding per video first, then match them all in one batch
+    filename_index = FilenameIndex(hugo_embeddings)
+    to_match = []
     for i, video in enumerate(videos, 1):
         title = video.get('video_title') or video.get('drive_file_name') or 'Unknown'
-        print(f"\n[{i}/{len(videos)}] Processing: {title[:50]}...")
         
-        audio_key = f"{title}.m4a"
-        video_key = f"{title}.MP4"
-        
-        embedding_data = hugo_embeddings.get(audio_key) or hugo_embeddings.get(video_key) or hugo_embeddings.get(title)
-        
-        if not embedding_data:
-            base_name = title.replace('.MP4', '').replace('.m4a', '')
-            for key in hugo_embeddings:
-                if base_name in key:
-                    embedding_data = hugo_embeddings[key]
-                    break
+        embedding_data = filename_index.lookup(title)
         
         if not embedding_data:
+            print(f"\n[{i}/{len(videos)}] {title[:50]}")
             print(f"  ⚠️  No embedding found for '{title}' - skipping")
             no_embedding += 1
             continue
         
-        techniek_id, confidence = match_technique(embedding_data['embedding'], technique_embeddings)
+        to_match.append((i, video, title, embedding_data))
+    
+    results = technique_embeddings.match_many(
+        [item[3]['embedding'] for item in to_match],
+        top_k=args.top_k,
+        threshold=args.threshold
+    )
+    
+    updates = []
+    for (i, video, title, embedding_data), match in zip(to_match, results):
+        print(f"\n[{i}/{len(videos)}] Processing: {title[:50]}...")
+        candidates = ', '.join(f"{t['techniek_id']} {t['score']:.1%}" for t in match['top'])
+        confidence = match['score']
         
-        if techniek_id:
-            print(f"  ✅ Match: {techniek_id} ({confidence:.1%} confidence)")
+        if match['best']:
+            techniek_id = match['best']['techniek_id']
+            print(f"  ✅ Match: {techniek_id} ({confidence:.1%} confidence, margin {match['margin']:.1%}) [{candidates}]")
             matched += 1
             
-            if not args.dry_run:
-                update_video_ai_suggestion(
-                    video['id'], 
-                    techniek_id, 
-                    confidence,
-                    embedding_data['rag_id'] if not video.get('rag_document_id') else None
-                )
+            updates.append({
+                'id': video['id'],
+                'ai_suggested_techniek_id': techniek_id,
+                'ai_confidence': round(confidence, 4),
+                'rag_document_id': embedding_data['rag_id'] if not video.get('rag_document_id') else None
+            })
         else:
-            print(f"  ❌ No match (best score: {confidence:.1%} < {CONFIDENCE_THRESHOLD:.0%} threshold)")
+            print(f"  ❌ No match (best score: {confidence:.1%} < {args.threshold:.0%} threshold) [{candidates}]")
             no_match += 1
     
+    if updates and not args.dry_run:
+        print(f"\nWriting {len(updates)} AI suggestions...")
+        written = write_ai_suggestions(updates, batch_size=args.batch_size)
+        print(f"Updated {written} videos")
+    
     print("\n" + "=" * 60)
     print("SUMMARY")
     print("=" * 60)
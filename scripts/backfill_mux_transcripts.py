@@ -27,6 +27,10 @@ from openai import OpenAI
 from supabase import create_client
 import requests
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from embedding_cache import get_default_cache
+
 EMBEDDING_MODEL = "text-embedding-3-small"
 
 supabase = None
@@ -135,12 +139,15 @@ def transcribe_audio(audio_path):
 
 
 def generate_embedding(text):
-    """Generate embedding using OpenAI."""
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text,
-    )
-    return response.data[0].embedding
+    """Generate embedding using OpenAI (cached on local disk)."""
+    def create():
+        response = openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text,
+        )
+        return response.data[0].embedding
+    
+    return get_default_cache().get_or_create(EMBEDDING_MODEL, text, create)
 
 
 def insert_rag_document(source_id, content, embedding):
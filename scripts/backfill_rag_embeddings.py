@@ -17,11 +17,14 @@ Environment variables required:
 
 import os
 import sys
-import time
 import argparse
 from openai import OpenAI
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-run'))
+from embedding_batcher import EmbeddingBatcher
+
 EMBEDDING_MODEL = "text-embedding-3-small"
 
 supabase = None
@@ -74,24 +77,21 @@ def get_videos_needing_embeddings(limit=None):
     return videos
 
 
-def generate_embedding(text):
+def generate_embeddings(texts):
     """
-    Generate embedding for text using OpenAI.
+    Generate embeddings for all texts in batched, parallel OpenAI requests
+    (cached on local disk).
     
     Args:
-        text: Text to embed
+        texts: Texts to embed
         
     Returns:
-        list: Embedding vector
+        tuple: (embeddings in input order, None where failed; {index: error})
     """
-    try:
-        response = openai_client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=text,
-        )
-        return response.data[0].embedding
-    except Exception as e:
-        raise RuntimeError(f"Failed to generate embedding: {str(e)}")
+    batcher = EmbeddingBatcher(openai_client, model=EMBEDDING_MODEL)
+    embeddings = batcher.embed(texts)
+    print(f"Generated {len(texts)} embeddings in {batcher.stats()['requests']} requests")
+    return embeddings, batcher.errors
 
 
 def insert_rag_document(video_id, source_id, content, embedding):
@@ -169,6 +169,11 @@ def main():
     processed = 0
     errors = 0
     
+    print("Generating embeddings...")
+    embeddings, embedding_errors = generate_embeddings(
+        [(video.get('transcript') or '').strip() for video in videos]
+    )
+    
     for i, video in enumerate(videos, 1):
         video_id = video['id']
         source_id = video.get('video_title') or video.get('drive_file_name') or 'Unknown'
@@ -181,8 +186,9 @@ def main():
             continue
         
         try:
-            print("generating embedding...", end=" ", flush=True)
-            embedding = generate_embedding(transcript)
+            embedding = embeddings[i - 1]
+            if embedding is None:
+                raise RuntimeError(f"Failed to generate embedding: {embedding_errors.get(i - 1, 'unknown error')}")
             
             if args.dry_run:
                 print(f"✓ (dry-run, would insert)")
@@ -197,8 +203,6 @@ def main():
                 print("✓")
                 processed += 1
             
-            time.sleep(0.1)
-            
         except Exception as e:
             print(f"✗ ERROR: {str(e)[:60]}")
             errors += 1
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark: segment-parallel chromakey vs. segment count.
+
+Rendert dezelfde video met apply_chromakey() uit process_videos.py voor elk
+opgegeven aantal segmenten en toont de wall-clock tijd, realtime factor en
+speedup t.o.v. de eerste waarde (normaal 1 = single encode).
+
+Gebruik:
+    python scripts/benchmark_chromakey_segments.py input.mp4
+    python scripts/benchmark_chromakey_segments.py input.mp4 --segments 1,2,4,8 --repeat 2
+    python scripts/benchmark_chromakey_segments.py input.mp4 --background assets/bg_winter_avond_1080p.jpg
+    python scripts/benchmark_chromakey_segments.py input.mp4 --keep /tmp/bench   # outputs bewaren
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+# Add scripts dir to path for imports
+sys.path.insert(0, str(Path(__file__).parent))
+
+from process_videos import WINTER_BACKGROUNDS, apply_chromakey, get_video_duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark segment-parallel chromakey")
+    parser.add_argument("input", help="Input video (green screen)")
+    parser.add_argument("--segments", default="1,2,4,8", help="Komma-gescheiden segment aantallen (default: 1,2,4,8)")
+    parser.add_argument("--repeat", type=int, default=1, help="Aantal runs per segment aantal (beste tijd telt)")
+    parser.add_argument("--background", help="Achtergrond afbeelding (default: eerste winter achtergrond)")
+    parser.add_argument("--keep", help="Map om de gerenderde outputs te bewaren (voor visuele controle)")
+    args = parser.parse_args()
+
+    input_path = Path(args.input)
+    if not input_path.exists():
+        print(f"FOUT: {input_path} niet gevonden")
+        sys.exit(1)
+
+    background_path = Path(args.background) if args.background else Path(__file__).parent.parent / "assets" / WINTER_BACKGROUNDS[0]
+    if not background_path.exists():
+        print(f"FOUT: achtergrond {background_path} niet gevonden")
+        sys.exit(1)
+
+    segment_counts = [int(n) for n in args.segments.split(",") if n.strip()]
+    duration = get_video_duration(input_path)
+
+    print("=" * 60)
+    print("Chromakey segment benchmark")
+    print("=" * 60)
+    print(f"Input:      {input_path.name} ({duration:.1f}s)")
+    print(f"Achtergrond: {background_path.name}")
+    print(f"CPU cores:  {os.cpu_count()}")
+    print(f"Segmenten:  {segment_counts} (x{args.repeat})")
+    print()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_dir = Path(args.keep) if args.keep else Path(tmpdir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        for segments in segment_counts:
+            output_path = out_dir / f"chromakey_{segments}seg.mp4"
+            best = None
+            for _ in range(args.repeat):
+                start = time.time()
+                ok = apply_chromakey(input_path, output_path, background_path=background_path,
+                                     video_duration=duration, segments=segments)
+                elapsed = time.time() - start
+                if not ok:
+                    print(f"  FOUT bij {segments} segmenten, overgeslagen")
+                    best = None
+                    break
+                best = elapsed if best is None else min(best, elapsed)
+            if best is not None:
+                out_duration = get_video_duration(output_path)
+                results.append((segments, best, out_duration))
+
+    if not results:
+        print("Geen geslaagde runs")
+        sys.exit(1)
+
+    baseline = results[0][1]
+    print()
+    print(f"{'Segmenten':>10} {'Tijd (s)':>10} {'x realtime':>11} {'Speedup':>8} {'Output duur':>12}")
+    for segments, elapsed, out_duration in results:
+        realtime = duration / elapsed if elapsed > 0 else 0
+        print(f"{segments:>10} {elapsed:>10.1f} {realtime:>11.2f} {baseline / elapsed:>7.2f}x {out_duration:>11.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark: lokale RAG search (cloud-run/rag_search.py) vs. pgvector.
+
+Neemt een steekproef van documenten uit de export als query's (hun eigen embedding,
+dus geen OpenAI calls) en vergelijkt per query:
+- latency van RagIndex.search() vs. de match_rag_documents RPC in Supabase
+- recall@k: overlap van de lokale top-k met de pgvector top-k
+
+Gebruik:
+    python scripts/benchmark_rag_search.py --corpus exports/rag_corpus_with_embeddings.jsonl
+    python scripts/benchmark_rag_search.py --corpus export.json --queries 100 --top-k 10
+    python scripts/benchmark_rag_search.py --corpus export.json --local-only   # zonder database
+
+Environment variables (niet nodig met --local-only):
+    - SUPABASE_URL
+    - SUPABASE_SERVICE_ROLE_KEY
+"""
+
+import os
+import sys
+import argparse
+import random
+import statistics
+import time
+from pathlib import Path
+
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from rag_search import RagIndex
+from supabase_rest import SupabaseREST
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lokale RAG search vs. pgvector")
+    parser.add_argument("--corpus", required=True, help="Export met embeddings (.jsonl + .npy sidecar, JSON of JSONL)")
+    parser.add_argument("--queries", type=int, default=50, help="Aantal query's (default 50)")
+    parser.add_argument("--top-k", type=int, default=5, help="k voor latency en recall@k (default 5)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed voor de steekproef")
+    parser.add_argument("--local-only", action="store_true", help="Alleen lokale latency meten")
+    args = parser.parse_args()
+
+    start = time.time()
+    index = RagIndex.load(args.corpus)
+    load_seconds = time.time() - start
+    if not len(index):
+        print(f"FOUT: geen documenten met embeddings in {args.corpus}")
+        sys.exit(1)
+
+    rng = random.Random(args.seed)
+    sample = rng.sample(range(len(index)), min(args.queries, len(index)))
+    queries = [index.matrix[i].tolist() for i in sample]
+
+    db = None
+    if not args.local_only:
+        db = SupabaseREST(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY"), timeout=30)
+        if not db.enabled:
+            print("FOUT: SUPABASE_URL en SUPABASE_SERVICE_ROLE_KEY vereist (of gebruik --local-only)")
+            sys.exit(1)
+
+    print("=" * 60)
+    print("RAG search benchmark")
+    print("=" * 60)
+    print(f"Corpus:   {len(index)} documenten x {index.dimensions} dims (geladen in {load_seconds:.2f}s)")
+    print(f"Query's:  {len(queries)}, top-{args.top_k}")
+    print()
+
+    local_ms = []
+    remote_ms = []
+    recalls = []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, top_k=args.top_k)
+        local_ms.append((time.perf_counter() - start) * 1000)
+
+        if db is None:
+            continue
+        start = time.perf_counter()
+        rows = db.rpc('match_rag_documents', {
+            'query_embedding': query,
+            'match_threshold': -1,
+            'match_count': args.top_k
+        }) or []
+        remote_ms.append((time.perf_counter() - start) * 1000)
+
+        expected = {row['id'] for row in rows}
+        if expected:
+            recalls.append(len(expected & {hit['id'] for hit in hits}) / len(expected))
+
+    # Batched queries: one matrix product for the whole sample
+    start = time.perf_counter()
+    index.search_many(queries, top_k=args.top_k)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    print(f"{'':<22} {'p50 (ms)':>10} {'p95 (ms)':>10} {'mean (ms)':>10}")
+    print(f"{'Lokaal':<22} {percentile(local_ms, 50):>10.3f} {percentile(local_ms, 95):>10.3f} {statistics.mean(local_ms):>10.3f}")
+    if remote_ms:
+        print(f"{'pgvector (RPC)':<22} {percentile(remote_ms, 50):>10.1f} {percentile(remote_ms, 95):>10.1f} {statistics.mean(remote_ms):>10.1f}")
+    print(f"{'Lokaal batch / query':<22} {'':>10} {'':>10} {batch_ms / len(queries):>10.3f}")
+
+    if remote_ms:
+        print()
+        print(f"Speedup (p50):   {percentile(remote_ms, 50) / max(percentile(local_ms, 50), 1e-6):.0f}x")
+    if recalls:
+        print(f"Recall@{args.top_k}:        {statistics.mean(recalls):.3f} (min {min(recalls):.2f}, {len(recalls)} query's)")
+
+
+if __name__ == "__main__":
+    main()
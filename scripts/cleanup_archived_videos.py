@@ -14,11 +14,16 @@ Usage:
 import argparse
 import os
 import sys
+from pathlib import Path
 
 import mux_python
 from mux_python.rest import ApiException
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from supabase_rest import SupabaseREST
+
 ARCHIEF_FOLDER_ID = "1E49dwl2hq_nhoe52bmK0DRn5ZhFdRGyq"
 
 
@@ -38,6 +43,7 @@ def init_clients():
         sys.exit(1)
     
     supabase = create_client(supabase_url, supabase_key)
+    supabase_rest = SupabaseREST(supabase_url, supabase_key)
     
     mux_config = mux_python.Configuration()
     mux_config.username = mux_token_id
@@ -46,25 +52,32 @@ def init_clients():
     mux_assets_api = mux_python.AssetsApi(mux_client)
     
     print("✓ Clients geïnitialiseerd")
-    return supabase, mux_assets_api
+    return supabase, supabase_rest, mux_assets_api
 
 
-def get_archived_videos(supabase, folder_id=None):
-    """Get all archived videos that need cleanup."""
-    query = supabase.table("video_ingest_jobs").select(
-        "id, drive_file_name, mux_asset_id, mux_playback_id, rag_document_id, transcript"
-    )
+def get_archived_videos(supabase_rest, folder_id=None):
+    """
+    Get all archived videos that need cleanup (paged by id).
     
+    Transcripts are not downloaded: has_transcript comes from an id-only scan
+    of the same videos with a non-empty transcript.
+    """
     if folder_id:
-        query = query.eq("drive_folder_id", folder_id)
+        params = {"drive_folder_id": f"eq.{folder_id}"}
     else:
-        try:
-            query = query.eq("is_archived", True)
-        except:
-            query = query.eq("drive_folder_id", ARCHIEF_FOLDER_ID)
+        params = {"is_archived": "eq.true"}
+    
+    with_transcript = {
+        r["id"] for r in supabase_rest.iter_rows("video_ingest_jobs", {**params, "select": "id", "transcript": "neq."})
+    }
     
-    result = query.execute()
-    return result.data or []
+    videos = []
+    for video in supabase_rest.iter_rows("video_ingest_jobs", {
+        **params, "select": "id, drive_file_name, mux_asset_id, mux_playback_id, rag_document_id"
+    }):
+        video["has_transcript"] = video["id"] in with_transcript
+        videos.append(video)
+    return videos
 
 
 def delete_mux_asset(mux_api, asset_id: str, dry_run: bool) -> bool:
@@ -130,12 +143,12 @@ def cleanup_archived_videos(dry_run: bool = True, folder_id: str = None):
     else:
         print("\n🔴 LIVE MODUS - Wijzigingen worden uitgevoerd!\n")
     
-    supabase, mux_api = init_clients()
+    supabase, supabase_rest, mux_api = init_clients()
     
     folder_id = folder_id or ARCHIEF_FOLDER_ID
     print(f"📁 Folder ID: {folder_id}")
     
-    videos = get_archived_videos(supabase, folder_id)
+    videos = get_archived_videos(supabase_rest, folder_id)
     print(f"\n📋 Gevonden: {len(videos)} gearchiveerde video's\n")
     
     if not videos:
@@ -156,7 +169,7 @@ def cleanup_archived_videos(dry_run: bool = True, folder_id: str = None):
         file_name = video.get("drive_file_name", "onbekend")
         mux_asset_id = video.get("mux_asset_id")
         rag_document_id = video.get("rag_document_id")
-        has_transcript = bool(video.get("transcript"))
+        has_transcript = video["has_transcript"]
         
         print(f"\n[{i}/{len(videos)}] {file_name}")
         print(f"  Job ID: {job_id}")
@@ -171,9 +171,13 @@ def trigger_cloud_build(access_token):
     with tempfile.TemporaryDirectory() as tmpdir:
         import shutil
         
-        # Write files
+        # Write files (worker.py + shared modules it imports, e.g. supabase_rest.py)
         with open(os.path.join(tmpdir, 'worker.py'), 'w') as f:
             f.write(worker_content)
+        for module in sorted(os.listdir(cloud_run_dir)):
+            if module.endswith('.py') and module != 'worker.py':
+                shutil.copy(os.path.join(cloud_run_dir, module), tmpdir)
+                print(f"✓ Module gekopieerd: {module}")
         with open(os.path.join(tmpdir, 'Dockerfile'), 'w') as f:
             f.write(dockerfile_content)
         
@@ -7,11 +7,35 @@ that can be imported into another Replit for AI chat functionality.
 
 Usage:
     python3 scripts/export_rag_corpus.py [--with-embeddings] [--output FILE]
+    python3 scripts/export_rag_corpus.py --with-embeddings --embedding-dtype float16
+    python3 scripts/export_rag_corpus.py --with-embeddings --inline-embeddings
 
 Output includes:
     - All video transcripts
     - Metadata (title, source, word count, technique ID)
-    - Optionally embeddings (for direct pgvector import)
+    - Optionally embeddings (for direct pgvector import, or local search with
+      scripts/search_rag_corpus.py)
+
+With --with-embeddings the vectors are written as a binary sidecar instead of
+JSON text: <name>.jsonl holds a header line (the sidecar's shape and dtype,
+checked on load) and then one document per line with its 'row' in <name>.npy
+(L2-normalized float32, or float16 at half the size). Loaders memory-map the
+.npy (cloud-run/rag_search.py RagIndex.load), so no float literals are parsed. --inline-embeddings keeps the old single JSON file.
+
+Incremental export (--incremental):
+    python3 scripts/export_rag_corpus.py --with-embeddings --incremental
+
+rag_documents is read with keyset pagination (pages of --page-size rows:
+SupabaseREST.iter_pages ordered by id, or by updated_at, id for incremental runs)
+so PostgREST's max-rows cap never truncates the export. The last (updated_at, id)
+seen is stored next to the output in <name>.watermark.json; an incremental run
+fetches only rows changed after the watermark minus --overlap-seconds (updated_at
+is stamped before the writer's batches commit, so a late commit can carry an older
+timestamp), drops documents whose id no longer exists (one id-only scan) and
+merges the result into the existing export files. Without a watermark, or when
+the embedding format changed, it falls back to a full export. Incremental runs
+write to a fixed file name (exports/rag_corpus[_with_embeddings].json[l]).
+Rows without updated_at are only picked up by a full export.
 
 Environment variables required:
     - SUPABASE_URL
@@ -22,11 +46,22 @@ import os
 import sys
 import json
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from supabase import create_client
+
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from supabase_rest import SupabaseREST
 
 OUTPUT_DIR = Path("exports")
+PAGE_SIZE = 1000  # PostgREST max-rows default
+READ_TIMEOUT = 60  # a page of 1000 rows with embeddings is several MB
+# updated_at is stamped by the writer before its batches commit, so a row can become
+# visible after an export with a timestamp below that export's watermark. Incremental
+# runs re-read this many seconds before the watermark (the merge by id is idempotent).
+WATERMARK_OVERLAP_SECONDS = int(os.environ.get('RAG_EXPORT_OVERLAP_SECONDS', '900'))
+
+DOCUMENT_FIELDS = 'id,doc_type,source_id,title,content,techniek_id,fase,word_count,created_at,updated_at'
 
 
 def init_supabase():
@@ -37,42 +72,128 @@ def init_supabase():
     if not url or not key:
         raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set")
     
-    return create_client(url, key)
+    return SupabaseREST(url, key)
+
+
+def _timestamp(value):
+    """updated_at string → aware datetime (for comparing PostgREST timestamps)."""
+    if not value:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def fetch_changed_pages(db, select_fields, since, page_size=PAGE_SIZE):
+    """
+    Yield pages of rag_documents changed after since=(updated_at, id) (id None: at or
+    after updated_at), ordered by (updated_at, id). Keyset pagination on two columns,
+    which SupabaseREST.iter_pages (one key column) does not cover; full scans use iter_pages.
+    """
+    updated_at, doc_id = since
+    while True:
+        params = {'select': select_fields, 'order': 'updated_at.asc,id.asc', 'limit': page_size}
+        if doc_id is None:
+            params['updated_at'] = f'gte.{updated_at}'
+        else:
+            params['or'] = f'(updated_at.gt."{updated_at}",and(updated_at.eq."{updated_at}",id.gt.{doc_id}))'
+        page = db.select('rag_documents', params, timeout=READ_TIMEOUT)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        updated_at, doc_id = page[-1]['updated_at'], page[-1]['id']
 
 
-def export_rag_corpus(supabase, with_embeddings=False):
+def export_rag_corpus(db, with_embeddings=False, page_size=PAGE_SIZE, since=None):
     """
-    Export all RAG documents from Supabase.
+    Export RAG documents from Supabase (all, or changed after since).
     
     Returns list of documents with content and optional embeddings.
     """
     print("Fetching RAG documents from Supabase...")
     
-    if with_embeddings:
-        select_fields = 'id, doc_type, source_id, title, content, embedding, word_count, created_at'
+    select_fields = DOCUMENT_FIELDS + (',embedding' if with_embeddings else '')
+    if since is None:
+        pages = db.iter_pages('rag_documents', {'select': select_fields}, page_size, timeout=READ_TIMEOUT)
     else:
-        select_fields = 'id, doc_type, source_id, title, content, word_count, created_at'
+        pages = fetch_changed_pages(db, select_fields, since, page_size)
     
-    result = supabase.table('rag_documents').select(select_fields).execute()
+    documents = []
+    for page in pages:
+        documents.extend(page)
+        print(f"  {len(documents)} documents fetched...")
     
-    documents = result.data
-    print(f"Found {len(documents)} RAG documents")
+    print(f"Found {len(documents)} {'changed ' if since else ''}RAG documents")
     
     return documents
 
 
-def get_video_metadata(supabase):
+def fetch_document_ids(db, page_size=PAGE_SIZE):
+    """All current rag_documents ids (id-only keyset scan, for deletion detection)."""
+    return {row['id'] for row in db.iter_rows('rag_documents', {'select': 'id'}, page_size)}
+
+
+def watermark_path(output_file):
+    return output_file.with_suffix('.watermark.json')
+
+
+def load_watermark(output_file, export_format):
+    """Stored watermark for output_file, or None when missing / written in another format."""
+    path = watermark_path(output_file)
+    if not output_file.exists() or not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        watermark = json.load(f)
+    if watermark.get('format') != export_format:
+        print(f"Watermark format {watermark.get('format')} != {export_format} - full export")
+        return None
+    return watermark
+
+
+def save_watermark(output_file, export_format, documents):
+    """Store the highest (updated_at, id) of the exported documents."""
+    latest = max(
+        (d for d in documents if d.get('updated_at')),
+        key=lambda d: (_timestamp(d['updated_at']), d['id']),
+        default=None
+    )
+    with open(watermark_path(output_file), 'w', encoding='utf-8') as f:
+        json.dump({
+            'format': export_format,
+            'updated_at': latest['updated_at'] if latest else None,
+            'id': latest['id'] if latest else None,
+            'exported_at': datetime.now(timezone.utc).isoformat(),
+            'total_documents': len(documents),
+        }, f, indent=2)
+
+
+def load_existing_export(output_file, sidecar):
+    """Documents (with 'embedding' where present) from a previous export file."""
+    if sidecar:
+        import numpy as np
+        from rag_search import read_sidecar_rows
+        documents, matrix = read_sidecar_rows(output_file)
+        for doc in documents:
+            row = doc.pop('row', None)
+            doc['embedding'] = matrix[row].astype(np.float32).tolist() if row is not None else None
+        return documents
+    
+    with open(output_file, 'r', encoding='utf-8') as f:
+        return json.load(f)['documents']
+
+
+def get_video_metadata(db, page_size=PAGE_SIZE):
     """
     Get video metadata to enrich exports with technique info.
     """
     print("Fetching video metadata...")
     
-    result = supabase.table('video_ingest_jobs').select(
-        'video_title, drive_file_name, fase, techniek_id, ai_suggested_techniek_id, duration_seconds, rag_document_id'
-    ).not_.is_('rag_document_id', 'null').execute()
+    rows = db.iter_rows('video_ingest_jobs', {
+        'select': 'id,video_title,drive_file_name,fase,techniek_id,ai_suggested_techniek_id,duration_seconds,rag_document_id',
+        'rag_document_id': 'not.is.null',
+    }, page_size)
     
     metadata = {}
-    for v in result.data:
+    for v in rows:
         source = v.get('video_title') or v.get('drive_file_name')
         metadata[source] = {
             'fase': v.get('fase'),
@@ -88,28 +209,78 @@ def main():
     parser = argparse.ArgumentParser(description='Export RAG corpus for AI chat integration')
     parser.add_argument('--with-embeddings', action='store_true', help='Include embeddings in export')
     parser.add_argument('--output', type=str, help='Output file path')
+    parser.add_argument('--embedding-dtype', choices=['float32', 'float16'], default='float32',
+                        help='Sidecar precision (default float32)')
+    parser.add_argument('--inline-embeddings', action='store_true',
+                        help='Write embeddings as JSON text in the export file (no .npy sidecar)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only fetch rows changed since the stored watermark and merge into the existing export')
+    parser.add_argument('--overlap-seconds', type=int, default=WATERMARK_OVERLAP_SECONDS,
+                        help=f'Incremental runs re-read rows this far before the watermark (default {WATERMARK_OVERLAP_SECONDS})')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help=f'Rows per request (default {PAGE_SIZE})')
     args = parser.parse_args()
     
+    sidecar = args.with_embeddings and not args.inline_embeddings
+    if not args.with_embeddings:
+        export_format = 'plain'
+    elif sidecar:
+        export_format = f'sidecar_{args.embedding_dtype}'
+    else:
+        export_format = 'inline'
+    
     print("=" * 70)
     print("RAG Corpus Export")
     print("=" * 70)
     
     try:
-        supabase = init_supabase()
+        db = init_supabase()
         print("✓ Supabase connected")
     except ValueError as e:
         print(f"ERROR: {e}")
         sys.exit(1)
     
-    documents = export_rag_corpus(supabase, with_embeddings=args.with_embeddings)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    
+    suffix = '_with_embeddings' if args.with_embeddings else ''
+    if args.output:
+        output_file = Path(args.output)
+    elif args.incremental:
+        output_file = OUTPUT_DIR / f"rag_corpus{suffix}.json"
+    else:
+        output_file = OUTPUT_DIR / f"rag_corpus{suffix}_{timestamp}.json"
+    if sidecar:
+        output_file = output_file.with_suffix('.jsonl')
+    
+    watermark = load_watermark(output_file, export_format) if args.incremental else None
+    since = None
+    if watermark and watermark.get('updated_at'):
+        since_at = _timestamp(watermark['updated_at']) - timedelta(seconds=args.overlap_seconds)
+        since = (since_at.isoformat(), None)
+    
+    documents = export_rag_corpus(db, with_embeddings=args.with_embeddings, page_size=args.page_size, since=since)
+    
+    if watermark:
+        # Merge: existing export minus deleted ids, changed/new rows replace by id
+        current_ids = fetch_document_ids(db, args.page_size)
+        existing = load_existing_export(output_file, sidecar)
+        merged = {d['id']: d for d in existing if d['id'] in current_ids}
+        deleted = len(existing) - len(merged)
+        added = sum(1 for d in documents if d['id'] not in merged)
+        for doc in documents:
+            merged[doc['id']] = doc
+        print(f"Incremental: {len(documents) - added} changed or re-read, {added} new, {deleted} deleted")
+        documents = list(merged.values())
     
     if not documents:
         print("No RAG documents found!")
         return
     
-    video_metadata = get_video_metadata(supabase)
+    video_metadata = get_video_metadata(db, args.page_size)
     
     enriched_docs = []
+    embeddings = []
     for doc in documents:
         source_id = doc.get('source_id', '')
         
@@ -119,36 +290,38 @@ def main():
             'source_id': source_id,
             'title': doc['title'],
             'content': doc['content'],
+            'techniek_id': doc.get('techniek_id'),
+            'fase': doc.get('fase'),
             'word_count': doc.get('word_count', len(doc['content'].split())),
             'created_at': doc.get('created_at'),
+            'updated_at': doc.get('updated_at'),
         }
         
         if source_id in video_metadata:
             entry['metadata'] = video_metadata[source_id]
         
-        if args.with_embeddings and 'embedding' in doc:
+        if sidecar:
+            embeddings.append(doc.get('embedding'))
+        elif args.with_embeddings and 'embedding' in doc:
             entry['embedding'] = doc['embedding']
         
         enriched_docs.append(entry)
     
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    if args.output:
-        output_file = Path(args.output)
+    sidecar_file = None
+    if sidecar:
+        from rag_search import write_sidecar
+        sidecar_file = Path(write_sidecar(output_file, enriched_docs, embeddings, dtype=args.embedding_dtype))
     else:
-        suffix = '_with_embeddings' if args.with_embeddings else ''
-        output_file = OUTPUT_DIR / f"rag_corpus{suffix}_{timestamp}.json"
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'export_timestamp': datetime.now().isoformat(),
+                'total_documents': len(enriched_docs),
+                'total_words': sum(d['word_count'] for d in enriched_docs),
+                'includes_embeddings': args.with_embeddings,
+                'documents': enriched_docs
+            }, f, ensure_ascii=False, indent=2)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump({
-            'export_timestamp': datetime.now().isoformat(),
-            'total_documents': len(enriched_docs),
-            'total_words': sum(d['word_count'] for d in enriched_docs),
-            'includes_embeddings': args.with_embeddings,
-            'documents': enriched_docs
-        }, f, ensure_ascii=False, indent=2)
+    save_watermark(output_file, export_format, enriched_docs)
     
     print("\n" + "=" * 70)
     print("EXPORT COMPLETE")
@@ -158,6 +331,8 @@ def main():
     print(f"Total words: {sum(d['word_count'] for d in enriched_docs):,}")
     print(f"Embeddings:  {'Yes' if args.with_embeddings else 'No'}")
     print(f"\nFile size:   {output_file.stat().st_size / 1024:.1f} KB")
+    if sidecar_file:
+        print(f"Sidecar:     {sidecar_file} ({sidecar_file.stat().st_size / 1024:.1f} KB, {args.embedding_dtype})")
     
     by_type = {}
     for d in enriched_docs:
@@ -15,11 +15,9 @@ import json
 from datetime import datetime
 from pathlib import Path
 
-try:
-    from supabase import create_client
-except ImportError:
-    os.system("pip install supabase")
-    from supabase import create_client
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from supabase_rest import SupabaseREST
 
 TECHNIEKEN_FILE = Path("src/data/technieken_index.json")
 OUTPUT_FILE = Path("src/data/video-mapping.json")
@@ -33,7 +31,7 @@ def init_supabase():
     if not url or not key:
         raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set")
     
-    return create_client(url, key)
+    return SupabaseREST(url, key)
 
 
 def load_technieken():
@@ -71,7 +69,7 @@ def main():
     print("=" * 70)
     
     try:
-        supabase = init_supabase()
+        supabase_rest = init_supabase()
         print("✓ Supabase connected")
     except ValueError as e:
         print(f"ERROR: {e}")
@@ -81,12 +79,18 @@ def main():
     print(f"✓ Loaded {len(technieken)} techniques from SSOT")
     
     print("\nFetching videos from video_ingest_jobs...")
-    result = supabase.table("video_ingest_jobs").select(
-        "id, video_title, drive_file_name, fase, techniek_id, ai_suggested_techniek_id, "
-        "duration_seconds, status, transcript, mux_asset_id, mux_playback_id, ai_confidence, is_hidden, ai_attractive_title"
-    ).is_("deleted_at", "null").order("drive_file_name").execute()
-    
-    videos = result.data
+    # Paged by id; transcripts are not downloaded, only which videos have one
+    with_transcript = {
+        r["id"] for r in supabase_rest.iter_rows("video_ingest_jobs", {
+            "select": "id", "deleted_at": "is.null", "transcript": "neq."
+        })
+    }
+    videos = list(supabase_rest.iter_rows("video_ingest_jobs", {
+        "select": "id, video_title, drive_file_name, fase, techniek_id, ai_suggested_techniek_id, "
+                  "duration_seconds, status, mux_asset_id, mux_playback_id, ai_confidence, is_hidden, ai_attractive_title",
+        "deleted_at": "is.null"
+    }))
+    videos.sort(key=lambda v: (v.get("drive_file_name") is None, v.get("drive_file_name") or ""))
     print(f"Found {len(videos)} videos in database")
     
     video_mapping = {
@@ -135,7 +139,7 @@ def main():
             "techniek_source": "manual" if techniek_id else ("ai" if ai_techniek else "none"),
             "duration_seconds": v.get("duration_seconds"),
             "status": v.get("status"),
-            "has_transcript": bool(v.get("transcript")),
+            "has_transcript": v["id"] in with_transcript,
             "ai_confidence": v.get("ai_confidence"),
             "is_hidden": v.get("is_hidden", False),
             "has_mux": bool(v.get("mux_asset_id")),
@@ -155,7 +159,7 @@ def main():
         
         if v.get("mux_asset_id"):
             video_mapping["status_summary"]["with_mux"] += 1
-        if v.get("transcript_status") == "completed":
+        if video_entry["has_transcript"]:
             video_mapping["status_summary"]["with_transcript"] += 1
     
     with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
@@ -8,23 +8,30 @@ Usage:
 
 import json
 import os
-import time
+import sys
 from pathlib import Path
 
 from openai import OpenAI
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from embedding_batcher import EmbeddingBatcher
+from rag_writer import upsert_rag_documents
+from supabase_rest import SupabaseREST
+
 CORPUS_PATH = Path("data/rag/epic_rag_corpus.json")
 EMBEDDING_MODEL = "text-embedding-3-small"
-BATCH_SIZE = 50
+BATCH_SIZE = 200  # documents per upsert request
 
 supabase = None
+supabase_rest = None
 openai_client = None
 
 
 def init_clients():
     """Initialize Supabase and OpenAI clients."""
-    global supabase, openai_client
+    global supabase, supabase_rest, openai_client
     
     supabase_url = os.environ.get("SUPABASE_URL") or os.environ.get("VITE_SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
@@ -36,6 +43,7 @@ def init_clients():
         raise ValueError("OPENAI_API_KEY vereist")
     
     supabase = create_client(supabase_url, supabase_key)
+    supabase_rest = SupabaseREST(supabase_url, supabase_key)
     openai_client = OpenAI(api_key=openai_key)
     
     print("Clients geinitialiseerd")
@@ -52,58 +60,52 @@ def load_corpus():
     return data
 
 
-def generate_embedding(text: str) -> list[float]:
-    """Generate embedding for a single text using OpenAI."""
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text,
-    )
-    return response.data[0].embedding
+def generate_embeddings(texts: list[str]) -> tuple[list, dict]:
+    """Generate embeddings for all texts in batched, parallel OpenAI requests (cached on local disk)."""
+    batcher = EmbeddingBatcher(openai_client, model=EMBEDDING_MODEL)
+    embeddings = batcher.embed(texts)
+    stats = batcher.stats()
+    print(f"Embeddings: {len(texts)} teksten in {stats['requests']} requests ({len(batcher.errors)} mislukt)")
+    return embeddings, batcher.errors
 
 
 def process_documents(documents: list[dict]):
-    """Process all documents: generate embeddings and upsert to Supabase."""
+    """Process all documents: generate embeddings and bulk upsert to Supabase (on source_id)."""
     total = len(documents)
     processed = 0
     errors = 0
     
+    embeddings, embedding_errors = generate_embeddings([doc["content"] for doc in documents])
+    
+    records = []
     for i, doc in enumerate(documents):
+        embedding = embeddings[i]
+        if embedding is None:
+            errors += 1
+            print(f"[{i+1}/{total}] {doc['title'][:50]}... FOUT: geen embedding ({embedding_errors.get(i, 'lege content')})", flush=True)
+            continue
+        
+        records.append({
+            "doc_type": doc["type"],
+            "source_id": doc.get("source") or doc.get("id"),
+            "title": doc["title"],
+            "content": doc["content"],
+            "techniek_id": doc.get("techniek"),
+            "fase": doc.get("fase"),
+            "categorie": doc.get("categorie"),
+            "embedding": embedding,
+            "word_count": doc.get("word_count"),
+        })
+    
+    for start in range(0, len(records), BATCH_SIZE):
+        batch = records[start:start + BATCH_SIZE]
         try:
-            print(f"[{i+1}/{total}] {doc['title'][:50]}...", end=" ", flush=True)
-            
-            embedding = generate_embedding(doc["content"])
-            
-            source_id = doc.get("source") or doc.get("id")
-            
-            record = {
-                "doc_type": doc["type"],
-                "source_id": source_id,
-                "title": doc["title"],
-                "content": doc["content"],
-                "techniek_id": doc.get("techniek"),
-                "fase": doc.get("fase"),
-                "categorie": doc.get("categorie"),
-                "embedding": embedding,
-                "word_count": doc.get("word_count"),
-            }
-            
-            existing = supabase.table("rag_documents").select("id").eq("source_id", source_id).execute()
-            
-            if existing.data:
-                supabase.table("rag_documents").update(record).eq("id", existing.data[0]["id"]).execute()
-                print("(updated)", flush=True)
-            else:
-                supabase.table("rag_documents").insert(record).execute()
-                print("(inserted)", flush=True)
-            
-            processed += 1
-            
-            if (i + 1) % 10 == 0:
-                time.sleep(0.5)
-                
+            upsert_rag_documents(supabase_rest, batch, batch_size=BATCH_SIZE)
+            processed += len(batch)
+            print(f"[{start + len(batch)}/{len(records)}] opgeslagen", flush=True)
         except Exception as e:
-            errors += 1
-            print(f"FOUT: {e}", flush=True)
+            errors += len(batch)
+            print(f"FOUT bij batch {start // BATCH_SIZE + 1}: {e}", flush=True)
     
     return processed, errors
 
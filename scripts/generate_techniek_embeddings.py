@@ -9,22 +9,30 @@ Usage:
 
 import json
 import os
-import time
+import sys
+from datetime import datetime, timezone
 from pathlib import Path
 
 from openai import OpenAI
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from embedding_batcher import EmbeddingBatcher
+from rag_writer import upsert_rag_documents
+from supabase_rest import SupabaseREST
+
 TECHNIEKEN_PATH = Path("src/data/technieken_index.json")
 EMBEDDING_MODEL = "text-embedding-3-small"
 
 supabase = None
+supabase_rest = None
 openai_client = None
 
 
 def init_clients():
     """Initialize Supabase and OpenAI clients."""
-    global supabase, openai_client
+    global supabase, supabase_rest, openai_client
     
     supabase_url = os.environ.get("SUPABASE_URL") or os.environ.get("VITE_SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
@@ -36,6 +44,7 @@ def init_clients():
         raise ValueError("OPENAI_API_KEY vereist")
     
     supabase = create_client(supabase_url, supabase_key)
+    supabase_rest = SupabaseREST(supabase_url, supabase_key)
     openai_client = OpenAI(api_key=openai_key)
     
     print("✓ Clients geïnitialiseerd")
@@ -83,17 +92,16 @@ def create_technique_text(technique: dict) -> str:
     return "\n".join(parts)
 
 
-def generate_embedding(text: str) -> list[float]:
-    """Generate embedding for text using OpenAI."""
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text,
-    )
-    return response.data[0].embedding
+def generate_embeddings(texts: list[str]) -> tuple[list, dict]:
+    """Generate embeddings for all texts in batched, parallel OpenAI requests (cached on local disk)."""
+    batcher = EmbeddingBatcher(openai_client, model=EMBEDDING_MODEL)
+    embeddings = batcher.embed(texts)
+    print(f"Embeddings: {len(texts)} teksten in {batcher.stats()['requests']} requests")
+    return embeddings, batcher.errors
 
 
-def store_techniek_embedding(technique: dict, embedding: list[float], text: str):
-    """Store or update technique embedding in rag_documents table with doc_type='techniek'."""
+def techniek_record(technique: dict, embedding: list[float], text: str) -> dict:
+    """rag_documents row (doc_type='techniek') for a technique embedding."""
     nummer = technique.get("nummer")
     naam = technique.get("naam")
     fase = technique.get("fase")
@@ -109,16 +117,11 @@ def store_techniek_embedding(technique: dict, embedding: list[float], text: str)
         "fase": fase,
         "embedding": embedding,
         "word_count": len(text.split()),
+        # Bumps the version the Cloud Run worker's technique cache revalidates against
+        "updated_at": datetime.now(timezone.utc).isoformat(),
     }
     
-    existing = supabase.table("rag_documents").select("id").eq("source_id", source_id).execute()
-    
-    if existing.data:
-        supabase.table("rag_documents").update(record).eq("id", existing.data[0]["id"]).execute()
-        return "updated"
-    else:
-        supabase.table("rag_documents").insert(record).execute()
-        return "inserted"
+    return record
 
 
 def main():
@@ -137,30 +140,32 @@ def main():
     techniques = load_techniques()
     print(f"Gevonden: {len(techniques)} technieken (excl. fases)")
     
+    texts = [create_technique_text(technique) for technique in techniques]
+    embeddings, embedding_errors = generate_embeddings(texts)
+    
     print("\n" + "-" * 60)
     processed = 0
     errors = 0
     
+    records = []
     for i, technique in enumerate(techniques):
         nummer = technique.get("nummer", "?")
         naam = technique.get("naam", "Onbekend")[:40]
         
-        try:
-            print(f"[{i+1}/{len(techniques)}] {nummer} - {naam}...", end=" ", flush=True)
-            
-            text = create_technique_text(technique)
-            embedding = generate_embedding(text)
-            action = store_techniek_embedding(technique, embedding, text)
-            
-            print(f"({action})")
-            processed += 1
-            
-            if (i + 1) % 10 == 0:
-                time.sleep(0.3)
-                
-        except Exception as e:
+        if embeddings[i] is None:
             errors += 1
-            print(f"FOUT: {e}")
+            print(f"[{i+1}/{len(techniques)}] {nummer} - {naam}... FOUT: geen embedding ({embedding_errors.get(i, 'lege tekst')})")
+            continue
+        records.append(techniek_record(technique, embeddings[i], texts[i]))
+    
+    # One bulk upsert on source_id ('techniek_<nummer>') for all techniques
+    try:
+        upsert_rag_documents(supabase_rest, records)
+        processed = len(records)
+        print(f"{processed} technieken opgeslagen")
+    except Exception as e:
+        errors += len(records)
+        print(f"FOUT bij opslaan: {e}")
     
     print("\n" + "=" * 60)
     print(f"Klaar! Verwerkt: {processed}, Fouten: {errors}")
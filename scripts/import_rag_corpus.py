@@ -2,126 +2,160 @@
 """
 Import RAG corpus from CSV and generate embeddings using OpenAI.
 Stores the data in the rag_documents table with pgvector embeddings.
+
+Streaming import:
+- the CSV is read lazily in chunks of CHUNK_SIZE rows
+- a background thread embeds the next chunk while the current one is written
+- rows are loaded with COPY ... FROM STDIN into a temporary staging table
+- the staging table replaces the contents of rag_documents in one transaction,
+  so readers see the old corpus until the commit (never an empty table) and a
+  failed import leaves rag_documents untouched
+
+Usage:
+    python scripts/import_rag_corpus.py [csv_path] [--chunk-size 500]
 """
 
 import os
+import sys
 import csv
-import time
+import io
+import uuid
+import queue
+import argparse
+import threading
 import psycopg2
 from openai import OpenAI
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-run'))
+from embedding_batcher import EmbeddingBatcher
+
 DATABASE_URL = os.environ.get("DATABASE_URL")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+DEFAULT_CSV_PATH = "attached_assets/rag_corpus_export_(1)_1769049659932.csv"
 EMBEDDING_MODEL = "text-embedding-3-small"
 EMBEDDING_DIMENSIONS = 1536
-BATCH_SIZE = 20
+CHUNK_SIZE = 500  # CSV rows per embedding + COPY round
+PIPELINE_DEPTH = 2  # embedded chunks waiting for the database at most
+
+STAGING_TABLE = "rag_documents_import"
+COLUMNS = ["id", "doc_type", "source_id", "title", "content", "techniek_id", "fase", "categorie", "embedding", "word_count"]
 
-def get_embedding(text: str) -> list[float]:
-    """Generate embedding for a single text using OpenAI."""
-    text = text.replace("\n", " ").strip()
-    if not text:
-        return [0.0] * EMBEDDING_DIMENSIONS
-    
-    response = client.embeddings.create(
-        input=text,
-        model=EMBEDDING_MODEL
-    )
-    return response.data[0].embedding
 
-def get_embeddings_batch(texts: list[str]) -> list[list[float]]:
-    """Generate embeddings for a batch of texts."""
-    cleaned = [t.replace("\n", " ").strip() if t else "" for t in texts]
-    non_empty = [(i, t) for i, t in enumerate(cleaned) if t]
+def get_embeddings(batcher: EmbeddingBatcher, texts: list[str]) -> list[list[float]]:
+    """
+    Generate embeddings for all texts: token-packed batches, parallel requests,
+    failed batches split and retried, cached on local disk. Empty texts get a zero vector.
+    """
+    embeddings = batcher.embed([t.replace("\n", " ").strip() if t else "" for t in texts])
     
-    if not non_empty:
-        return [[0.0] * EMBEDDING_DIMENSIONS] * len(texts)
+    if batcher.errors:
+        for index, error in list(batcher.errors.items())[:5]:
+            print(f"  Failed: row {index + 1}: {error}")
+        raise RuntimeError(f"{len(batcher.errors)} embeddings failed")
     
-    response = client.embeddings.create(
-        input=[t for _, t in non_empty],
-        model=EMBEDDING_MODEL
+    return [e if e is not None else [0.0] * EMBEDDING_DIMENSIONS for e in embeddings]
+
+
+def read_chunks(csv_path: str, chunk_size: int):
+    """Yield lists of CSV rows without loading the whole file."""
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def embed_chunks(csv_path: str, chunk_size: int, out: queue.Queue):
+    """Producer thread: embed chunk after chunk; puts (rows, embeddings), then None (or the error)."""
+    batcher = EmbeddingBatcher(client, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+    try:
+        for rows in read_chunks(csv_path, chunk_size):
+            texts = [f"{row.get('title', '')} {row.get('content', '')}".strip() for row in rows]
+            out.put((rows, get_embeddings(batcher, texts)))
+        stats = batcher.stats()
+        print(f"Embeddings: {stats['requests']} requests ({stats['splits']} splits, {stats['retries']} retries)")
+        out.put(None)
+    except Exception as e:
+        out.put(e)
+
+
+def copy_chunk(cur, rows: list[dict], embeddings: list[list[float]]):
+    """COPY one chunk into the staging table (CSV format, vectors in pgvector text form)."""
+    buffer = io.StringIO()
+    # Quote every field: COPY CSV reads an unquoted empty field as NULL, "" as an empty
+    # string (which is what the old INSERT importer stored)
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    for row, embedding in zip(rows, embeddings):
+        content = row.get('content', '')
+        techniek_id = row.get('techniek_id', '')
+        fase = techniek_id.split('.')[0] if techniek_id and '.' in techniek_id else techniek_id
+        writer.writerow([
+            row.get('id') or str(uuid.uuid4()),
+            row.get('doc_type', 'unknown'),
+            row.get('source_id', ''),
+            row.get('title', ''),
+            content,
+            techniek_id,
+            fase,
+            '',
+            '[' + ','.join(repr(float(x)) for x in embedding) + ']',
+            len(content.split()) if content else 0,
+        ])
+    buffer.seek(0)
+    cur.copy_expert(
+        f"COPY {STAGING_TABLE} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        buffer
     )
-    
-    result = [[0.0] * EMBEDDING_DIMENSIONS] * len(texts)
-    for idx, (original_idx, _) in enumerate(non_empty):
-        result[original_idx] = response.data[idx].embedding
-    
-    return result
+
 
 def main():
-    csv_path = "attached_assets/rag_corpus_export_(1)_1769049659932.csv"
+    parser = argparse.ArgumentParser(description="Import RAG corpus CSV into rag_documents")
+    parser.add_argument("csv_path", nargs="?", default=DEFAULT_CSV_PATH, help="CSV export to import")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Rows per embedding/COPY round (default {CHUNK_SIZE})")
+    args = parser.parse_args()
     
     print(f"Connecting to database...")
     conn = psycopg2.connect(DATABASE_URL)
     cur = conn.cursor()
     
-    cur.execute("DELETE FROM rag_documents")
-    conn.commit()
-    print("Cleared existing rag_documents")
-    
-    print(f"Reading CSV from {csv_path}...")
-    rows = []
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rows.append(row)
+    # Session-local staging table with the same columns/defaults as rag_documents
+    cur.execute(f"CREATE TEMP TABLE {STAGING_TABLE} (LIKE rag_documents INCLUDING DEFAULTS) ON COMMIT DROP")
     
-    print(f"Found {len(rows)} rows to process")
+    print(f"Streaming CSV from {args.csv_path}...")
+    chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+    producer = threading.Thread(target=embed_chunks, args=(args.csv_path, args.chunk_size, chunks), daemon=True)
+    producer.start()
     
     total_processed = 0
-    total_batches = (len(rows) + BATCH_SIZE - 1) // BATCH_SIZE
-    
-    for batch_num in range(total_batches):
-        start_idx = batch_num * BATCH_SIZE
-        end_idx = min(start_idx + BATCH_SIZE, len(rows))
-        batch = rows[start_idx:end_idx]
-        
-        texts_to_embed = []
-        for row in batch:
-            text = f"{row.get('title', '')} {row.get('content', '')}".strip()
-            texts_to_embed.append(text)
-        
-        print(f"Generating embeddings for batch {batch_num + 1}/{total_batches} ({len(batch)} items)...")
-        
-        try:
-            embeddings = get_embeddings_batch(texts_to_embed)
-        except Exception as e:
-            print(f"Error generating embeddings: {e}")
-            time.sleep(5)
-            embeddings = get_embeddings_batch(texts_to_embed)
-        
-        for i, row in enumerate(batch):
-            embedding = embeddings[i]
-            content = row.get('content', '')
-            word_count = len(content.split()) if content else 0
-            
-            techniek_id = row.get('techniek_id', '')
-            fase = techniek_id.split('.')[0] if techniek_id and '.' in techniek_id else techniek_id
-            
-            cur.execute("""
-                INSERT INTO rag_documents 
-                (id, doc_type, source_id, title, content, techniek_id, fase, categorie, embedding, word_count)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                row.get('id'),
-                row.get('doc_type', 'unknown'),
-                row.get('source_id', ''),
-                row.get('title', ''),
-                content,
-                techniek_id,
-                fase,
-                '',
-                embedding,
-                word_count
-            ))
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            rows, embeddings = item
+            copy_chunk(cur, rows, embeddings)
+            total_processed += len(rows)
+            print(f"  Staged {total_processed} documents")
         
+        # Swap in atomically: readers keep seeing the old corpus until COMMIT
+        print("Replacing rag_documents with the staged corpus...")
+        cur.execute("DELETE FROM rag_documents")
+        cur.execute(f"INSERT INTO rag_documents ({', '.join(COLUMNS)}) SELECT {', '.join(COLUMNS)} FROM {STAGING_TABLE}")
         conn.commit()
-        total_processed += len(batch)
-        print(f"  Inserted {total_processed}/{len(rows)} documents")
-        
-        time.sleep(0.5)
+    except Exception:
+        conn.rollback()
+        print("Import failed - rag_documents left unchanged")
+        raise
     
     cur.execute("SELECT COUNT(*) FROM rag_documents")
     final_count = cur.fetchone()[0]
@@ -11,7 +11,7 @@ This script processes pending videos from Google Drive:
 6. Stores in Supabase for RAG
 
 Usage:
-    python scripts/process_videos.py [--job-id JOB_ID]
+    python scripts/process_videos.py [--job-id JOB_ID] [--segments N]
 """
 
 import argparse
@@ -22,6 +22,7 @@ import os
 import random
 import shutil
 import subprocess
+import sys
 import tempfile
 import time
 from datetime import datetime, timezone
@@ -32,6 +33,16 @@ import requests
 from openai import OpenAI
 from supabase import create_client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import get_default_cache
+from rag_writer import upsert_rag_documents
+from supabase_rest import SupabaseREST
+from technique_matching import MIN_CONFIDENCE, TechniqueMatrix
+from transcript_chunking import chunk_transcript, pool_embeddings
+from chromakey_segments import render_keyed_segments
+
 
 def cleanup_temp_files():
     """Clean up old temp directories to prevent disk quota issues."""
@@ -52,6 +63,10 @@ def cleanup_temp_files():
 
 EMBEDDING_MODEL = "text-embedding-3-small"
 
+# RAG_CHUNKING=1: transcripts worden in overlappende chunks ge-embed (rag_document_chunks)
+# met een gepoolde vector op het parent document; 0 = één embedding van de volledige tekst
+RAG_CHUNKING = os.environ.get("RAG_CHUNKING", "1") == "1"
+
 # Winter office backgrounds - rotate every hour of cumulative video time
 # TEST: Using avond (dark background) exclusively for testing transparency issues
 WINTER_BACKGROUNDS = [
@@ -64,11 +79,22 @@ WINTER_BACKGROUNDS = [
 # Minimum words for a video to be considered content (not just filler)
 MIN_CONTENT_WORDS = 50
 
+# Audio normalisatie: highpass + noise reduction, daarna EBU R128 loudnorm
+AUDIO_FILTER_BASE = "highpass=f=80,afftdn=nf=-25"
+LOUDNORM_TARGET = "loudnorm=I=-16:LRA=11:TP=-1.5"
+
+# Segment-parallel chromakey (0/1 = single encode), override with --segments
+CHROMAKEY_SEGMENTS = int(os.environ.get("CHROMAKEY_SEGMENTS", "0"))
+
+# Technique embedding matrix, loaded once per run (see get_technique_matrix)
+_technique_matrix = None
+
 # Track cumulative video duration for background selection (loaded from DB)
 _cumulative_duration_seconds = 0
 _duration_loaded = False
 
 supabase = None
+supabase_rest = None
 openai_client = None
 mux_token_id = None
 mux_token_secret = None
@@ -78,27 +104,25 @@ def load_cumulative_duration():
     """Load cumulative processed duration from Supabase (persisted across runs)."""
     global _cumulative_duration_seconds, _duration_loaded
     
-    if _duration_loaded or supabase is None:
+    if _duration_loaded or supabase_rest is None:
         return
     
     try:
-        # Try to load duration_seconds if column exists
-        result = supabase.table("video_ingest_jobs").select("duration_seconds").eq("status", "completed").execute()
-        
-        if result.data:
-            total = sum(r.get("duration_seconds") or 0 for r in result.data)
-            _cumulative_duration_seconds = float(total)
-        else:
-            _cumulative_duration_seconds = 0
+        # Try to load duration_seconds if column exists (paged, summed as it streams)
+        total = 0.0
+        count = 0
+        for r in supabase_rest.iter_rows("video_ingest_jobs", {"select": "duration_seconds", "status": "eq.completed"}):
+            total += r.get("duration_seconds") or 0
+            count += 1
+        _cumulative_duration_seconds = float(total)
         
         _duration_loaded = True
         hours = _cumulative_duration_seconds / 3600
-        print(f"  Cumulatieve duur geladen: {hours:.2f} uur ({len(result.data or [])} video's)")
+        print(f"  Cumulatieve duur geladen: {hours:.2f} uur ({count} video's)")
     except Exception as e:
         # Column might not exist - fall back to counting completed jobs (estimate ~3 min each)
         try:
-            result = supabase.table("video_ingest_jobs").select("id").eq("status", "completed").execute()
-            completed_count = len(result.data or [])
+            completed_count = supabase_rest.count("video_ingest_jobs", {"status": "eq.completed"})
             _cumulative_duration_seconds = completed_count * 180.0  # ~3 min per video
             hours = _cumulative_duration_seconds / 3600
             print(f"  Duur geschat: {hours:.1f} uur ({completed_count} video's x 3 min)")
@@ -174,6 +198,38 @@ def get_video_duration(video_path: Path) -> float:
     return 0.0
 
 
+def has_audio_stream(video_path: Path) -> bool:
+    """Check with ffprobe whether the file has at least one audio stream."""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "quiet",
+                "-select_streams", "a",
+                "-show_entries", "stream=index",
+                "-of", "csv=p=0",
+                str(video_path)
+            ],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        return result.returncode == 0 and bool(result.stdout.strip())
+    except:
+        return False
+
+
+def parse_loudnorm_json(stderr: str) -> dict | None:
+    """Parse the loudnorm print_format=json block (printed last on ffmpeg stderr)."""
+    json_start = stderr.rfind("{\n")
+    json_end = stderr.rfind("\n}") + 2
+    if json_start < 0 or json_end <= json_start:
+        return None
+    try:
+        return json.loads(stderr[json_start:json_end])
+    except json.JSONDecodeError:
+        return None
+
+
 def get_mux_asset_id_from_upload(upload_id: str, max_wait: int = 30) -> str | None:
     """Wait for and retrieve asset_id from a Mux upload."""
     if not mux_token_id or not mux_token_secret or not upload_id:
@@ -242,7 +298,7 @@ def delete_mux_asset(asset_id: str = None, upload_id: str = None) -> bool:
 
 def init_clients():
     """Initialize Supabase, OpenAI, and Mux clients."""
-    global supabase, openai_client, mux_token_id, mux_token_secret
+    global supabase, supabase_rest, openai_client, mux_token_id, mux_token_secret
     
     supabase_url = os.environ.get("SUPABASE_URL") or os.environ.get("VITE_SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
@@ -254,6 +310,7 @@ def init_clients():
         raise ValueError("OPENAI_API_KEY vereist")
     
     supabase = create_client(supabase_url, supabase_key)
+    supabase_rest = SupabaseREST(supabase_url, supabase_key)
     openai_client = OpenAI(api_key=openai_key)
     
     mux_token_id = os.environ.get("MUX_TOKEN_ID")
@@ -522,7 +579,34 @@ def apply_rvm_matting(input_path: Path, output_path: Path, background_path: Path
         return False
 
 
-def apply_chromakey(input_path: Path, output_path: Path, background_path: Path | None = None, video_duration: float = 0) -> bool:
+CHROMAKEY_FILTER = (
+    "[0:v]format=yuv444p,chromakey=0x00FF00:0.29:0.10[fg];"
+    "[1:v][fg]scale2ref=iw:ih:flags=lanczos[bg][fgref];"
+    "[bg][fgref]overlay=0:0:shortest=1,format=yuv420p[out]"
+)
+
+CHROMAKEY_X264_ARGS = [
+    "-c:v", "libx264",
+    "-preset", "slow",
+    "-crf", "14",
+    "-profile:v", "high",
+    "-level:v", "4.2",
+    "-pix_fmt", "yuv420p",
+    "-maxrate", "18M",
+    "-bufsize", "36M",
+    "-tune", "film",
+]
+
+
+def apply_chromakey(
+    input_path: Path,
+    output_path: Path,
+    background_path: Path | None = None,
+    video_duration: float = 0,
+    audio_path: Path | None = None,
+    loudness: dict | None = None,
+    segments: int = 0
+) -> bool:
     """
     FALLBACK: Apply chromakey (green screen removal) using ffmpeg.
     Used when RVM is unavailable or fails.
@@ -530,11 +614,21 @@ def apply_chromakey(input_path: Path, output_path: Path, background_path: Path |
     Uses winter office backgrounds that rotate every hour of cumulative video time.
     Professional pipeline with near-lossless quality (CRF=10).
     
+    With audio_path the same ffmpeg run (one decode) also writes the transcription
+    audio and measures loudness (loudnorm pass 1); the measurements are put in the
+    `loudness` dict so normalize_video_audio() can skip its analysis pass.
+    
+    With segments > 1 the video is keyed in parallel segments (chromakey_segments.py,
+    at most one per available CPU); on failure the single full encode is used.
+    
     Args:
         input_path: Path to input video
         output_path: Path to output video
         background_path: Optional specific background path
         video_duration: Duration of video in seconds (for background selection)
+        audio_path: Optional path for the transcription audio (.m4a)
+        loudness: Optional dict that receives the loudnorm measurements
+        segments: Number of parallel segments (0/1 = single encode)
     """
     print(f"  Chromakey fallback...", end=" ", flush=True)
     
@@ -551,6 +645,10 @@ def apply_chromakey(input_path: Path, output_path: Path, background_path: Path |
     
     print(f"({background_path.name})...", end=" ", flush=True)
     
+    # Without an audio stream there is nothing to split: video-only encode
+    multi_output = audio_path is not None and has_audio_stream(input_path)
+    segment_dir = None
+    
     try:
         # Simple chromakey for studio green (skip HDR conversion - most cameras use SDR):
         # - format=yuv444p for chromakey compatibility, then convert back to yuv420p for Mux
@@ -558,87 +656,93 @@ def apply_chromakey(input_path: Path, output_path: Path, background_path: Path |
         # - blend 0.10: smooth edge feathering (TESTED & WORKING)
         # CRITICAL: Use scale2ref to match background to SOURCE video dimensions
         # HIGH QUALITY: CRF 14, profile high, VBV caps for Mux compatibility
-        filter_complex = (
-            "[0:v]format=yuv444p,chromakey=0x00FF00:0.29:0.10[fg];"
-            "[1:v][fg]scale2ref=iw:ih:flags=lanczos[bg][fgref];"
-            "[bg][fgref]overlay=0:0:shortest=1,format=yuv420p[out]"
-        )
+        concat_list = None
+        if segments > 1:
+            segment_dir = Path(tempfile.mkdtemp(prefix="video_segments_"))
+            try:
+                concat_list, parts, _ = render_keyed_segments(
+                    input_path, background_path, str(segment_dir), segments,
+                    CHROMAKEY_FILTER, CHROMAKEY_X264_ARGS, timeout=1800
+                )
+                print(f"{parts} segmenten...", end=" ", flush=True)
+            except (RuntimeError, subprocess.TimeoutExpired) as e:
+                print(f"segmenten mislukt ({str(e)[:80]}), volledige encode...", end=" ", flush=True)
+        
+        if concat_list:
+            # Keyed parts are concatenated as-is; audio comes from the original (input 1)
+            inputs = ["-f", "concat", "-safe", "0", "-i", str(concat_list), "-i", str(input_path)]
+            filter_complex = ""
+            video_map = "0:v"
+            video_args = ["-c:v", "copy"]
+            audio_in = "1:a"
+        else:
+            inputs = ["-i", str(input_path), "-loop", "1", "-i", str(background_path)]
+            filter_complex = CHROMAKEY_FILTER
+            video_map = "[out]"
+            video_args = CHROMAKEY_X264_ARGS
+            audio_in = "0:a"
+        audio_map = f"{audio_in}?"
+        
+        if multi_output:
+            # One decode, three audio consumers: mezzanine track, transcription
+            # audio and the loudnorm analysis (to the null muxer). The transcription
+            # audio gets a single-pass loudnorm (the measurements only exist after this
+            # run), so quiet or hot recordings still reach ElevenLabs at target level;
+            # loudnorm upsamples internally, aresample brings it back to 48 kHz
+            audio_filter = (
+                f"[{audio_in}]asplit=3[a_mez][a_tx][a_meas];"
+                f"[a_tx]{AUDIO_FILTER_BASE},{LOUDNORM_TARGET},aresample=48000[a_txf];"
+                f"[a_meas]{AUDIO_FILTER_BASE},{LOUDNORM_TARGET}:print_format=json[a_null]"
+            )
+            filter_complex = f"{filter_complex};{audio_filter}" if filter_complex else audio_filter
+            audio_map = "[a_mez]"
+        
+        cmd = ["ffmpeg", *inputs]
+        if filter_complex:
+            cmd += ["-filter_complex", filter_complex]
+        cmd += [
+            "-map", video_map,
+            "-map", audio_map,
+            *video_args,
+            "-movflags", "+faststart",
+            "-c:a", "aac",
+            "-b:a", "192k",
+            "-shortest",
+            "-y",
+            str(output_path)
+        ]
         
-        result = subprocess.run(
-            [
-                "ffmpeg",
-                "-i", str(input_path),
-                "-loop", "1",
-                "-i", str(background_path),
-                "-filter_complex", filter_complex,
-                "-map", "[out]",
-                "-map", "0:a?",
-                "-c:v", "libx264",
-                "-preset", "slow",
-                "-crf", "14",
-                "-profile:v", "high",
-                "-level:v", "4.2",
-                "-pix_fmt", "yuv420p",
-                "-maxrate", "18M",
-                "-bufsize", "36M",
-                "-tune", "film",
-                "-movflags", "+faststart",
+        if multi_output:
+            cmd += [
+                "-map", "[a_txf]",
                 "-c:a", "aac",
-                "-b:a", "192k",
-                "-shortest",
+                "-b:a", "128k",
                 "-y",
-                str(output_path)
-            ],
-            capture_output=True,
-            text=True,
-            timeout=1800
-        )
+                str(audio_path),
+                "-map", "[a_null]",
+                "-f", "null", "-"
+            ]
+        
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
         
         if result.returncode != 0:
-            # Fallback: simpler chromakey filter without HDR conversion (for SDR sources)
-            print("fallback (SDR)...", end=" ")
-            filter_complex_fallback = (
-                "[0:v]format=yuv444p,chromakey=0x00FF00:0.29:0.10[fg];"
-                "[1:v][fg]scale2ref=iw:ih:flags=lanczos[bg][fgref];"
-                "[bg][fgref]overlay=0:0:shortest=1,format=yuv420p[out]"
-            )
-            result = subprocess.run(
-                [
-                    "ffmpeg",
-                    "-i", str(input_path),
-                    "-loop", "1",
-                    "-i", str(background_path),
-                    "-filter_complex", filter_complex_fallback,
-                    "-map", "[out]",
-                    "-map", "0:a?",
-                    "-c:v", "libx264",
-                    "-preset", "slow",
-                    "-crf", "14",
-                    "-profile:v", "high",
-                    "-level:v", "4.2",
-                    "-pix_fmt", "yuv420p",
-                    "-maxrate", "18M",
-                    "-bufsize", "36M",
-                    "-tune", "film",
-                    "-movflags", "+faststart",
-                    "-c:a", "aac",
-                    "-b:a", "192k",
-                    "-shortest",
-                    "-y",
-                    str(output_path)
-                ],
-                capture_output=True,
-                text=True,
-                timeout=1800
-            )
+            # Retry once with the same command (transient ffmpeg/disk errors)
+            print("retry...", end=" ")
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
             if result.returncode != 0:
                 error_lines = [l for l in result.stderr.split('\n') if 'error' in l.lower() or 'Error' in l]
                 error_msg = '\n'.join(error_lines[-3:]) if error_lines else result.stderr[-300:]
                 print(f"FOUT: {error_msg}")
                 return False
         
+        if multi_output and loudness is not None:
+            measured = parse_loudnorm_json(result.stderr)
+            if measured:
+                loudness.update(measured)
+        
         size_mb = output_path.stat().st_size / (1024 * 1024)
-        print(f"✓ ({size_mb:.1f} MB, near-lossless)")
+        extra = ", + audio" if multi_output else ""
+        print(f"✓ ({size_mb:.1f} MB, near-lossless{extra})")
         return True
         
     except subprocess.TimeoutExpired:
@@ -650,6 +754,9 @@ def apply_chromakey(input_path: Path, output_path: Path, background_path: Path |
     except Exception as e:
         print(f"FOUT: {str(e)[:100]}")
         return False
+    finally:
+        if segment_dir:
+            shutil.rmtree(segment_dir, ignore_errors=True)
 
 
 def extract_audio(video_path: Path, audio_path: Path) -> bool:
@@ -687,43 +794,42 @@ def extract_audio(video_path: Path, audio_path: Path) -> bool:
         return False
 
 
-def normalize_video_audio(video_path: Path, output_path: Path) -> bool:
+def normalize_video_audio(video_path: Path, output_path: Path, measured: dict | None = None) -> bool:
     """
     2-pass audio normalisatie: highpass + noise reduction + EBU R128 loudnorm.
     Video stream wordt ongewijzigd gekopieerd (-c:v copy), alleen audio wordt verwerkt.
+    Met `measured` (loudnorm metingen, bv. uit apply_chromakey) wordt pass 1 overgeslagen.
     """
-    import json as _json
-    print(f"  Audio normalisatie (2-pass EBU R128)...", end=" ", flush=True)
-
-    FILTER_BASE = "highpass=f=80,afftdn=nf=-25"
-    LOUDNORM_TARGET = "loudnorm=I=-16:LRA=11:TP=-1.5"
+    if measured:
+        print(f"  Audio normalisatie (EBU R128, metingen uit chromakey)...", end=" ", flush=True)
+    else:
+        print(f"  Audio normalisatie (2-pass EBU R128)...", end=" ", flush=True)
 
     try:
-        # Pass 1: Analyse — meet werkelijke loudness
-        pass1 = subprocess.run(
-            [
-                "ffmpeg", "-i", str(video_path),
-                "-af", f"{FILTER_BASE},{LOUDNORM_TARGET}:print_format=json",
-                "-f", "null", "-"
-            ],
-            capture_output=True,
-            text=True,
-            timeout=600
-        )
+        if not measured:
+            # Pass 1: Analyse — meet werkelijke loudness (-vn: video niet decoderen)
+            pass1 = subprocess.run(
+                [
+                    "ffmpeg", "-i", str(video_path),
+                    "-vn",
+                    "-af", f"{AUDIO_FILTER_BASE},{LOUDNORM_TARGET}:print_format=json",
+                    "-f", "null", "-"
+                ],
+                capture_output=True,
+                text=True,
+                timeout=600
+            )
 
-        if pass1.returncode != 0:
-            print(f"FOUT pass 1: {pass1.stderr[:200]}")
-            return False
+            if pass1.returncode != 0:
+                print(f"FOUT pass 1: {pass1.stderr[:200]}")
+                return False
 
-        # Parse loudnorm JSON from stderr (ffmpeg prints it after [Parsed_loudnorm...])
-        stderr = pass1.stderr
-        json_start = stderr.rfind("{\n")
-        json_end = stderr.rfind("\n}") + 2
-        if json_start < 0 or json_end <= json_start:
-            print("FOUT: kan loudnorm metingen niet parsen")
-            return False
+            # Parse loudnorm JSON from stderr (ffmpeg prints it after [Parsed_loudnorm...])
+            measured = parse_loudnorm_json(pass1.stderr)
+            if not measured:
+                print("FOUT: kan loudnorm metingen niet parsen")
+                return False
 
-        measured = _json.loads(stderr[json_start:json_end])
         measured_I = measured.get("input_i", "-24.0")
         measured_LRA = measured.get("input_lra", "7.0")
         measured_TP = measured.get("input_tp", "-2.0")
@@ -742,7 +848,7 @@ def normalize_video_audio(video_path: Path, output_path: Path) -> bool:
         pass2 = subprocess.run(
             [
                 "ffmpeg", "-i", str(video_path),
-                "-af", f"{FILTER_BASE},{loudnorm_pass2}",
+                "-af", f"{AUDIO_FILTER_BASE},{loudnorm_pass2}",
                 "-c:v", "copy",
                 "-c:a", "aac", "-b:a", "192k",
                 "-y", str(output_path)
@@ -766,9 +872,6 @@ def normalize_video_audio(video_path: Path, output_path: Path) -> bool:
     except FileNotFoundError:
         print("FOUT: ffmpeg niet gevonden")
         return False
-    except (_json.JSONDecodeError, KeyError) as e:
-        print(f"FOUT: loudnorm parse error: {e}")
-        return False
 
 
 def wait_for_mux_playback_id(asset_id: str, max_wait: int = 120) -> str | None:
@@ -934,56 +1037,70 @@ def transcribe_with_elevenlabs(audio_path: Path) -> dict | None:
 
 
 def generate_embedding(text: str) -> list[float]:
-    """Generate embedding for text using OpenAI."""
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text,
-    )
-    return response.data[0].embedding
+    """Generate embedding for text using OpenAI (cached on local disk)."""
+    def create():
+        response = openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text,
+        )
+        return response.data[0].embedding
+    
+    return get_default_cache().get_or_create(EMBEDDING_MODEL, text, create)
 
 
-def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
-    """Calculate cosine similarity between two vectors."""
-    import math
-    dot_product = sum(a * b for a, b in zip(vec1, vec2))
-    norm1 = math.sqrt(sum(a * a for a in vec1))
-    norm2 = math.sqrt(sum(b * b for b in vec2))
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-    return dot_product / (norm1 * norm2)
+def embed_transcript(transcript: str, words: list | None = None) -> tuple[list[float] | None, list[dict]]:
+    """
+    Split transcript into overlapping token-bounded chunks (sentence / word-timestamp
+    aligned) and embed them in one batched call.
+    Returns (pooled document embedding, chunks with 'embedding').
+    """
+    chunks = chunk_transcript(transcript, words)
+    if not chunks:
+        return None, []
+    batcher = EmbeddingBatcher(openai_client, model=EMBEDDING_MODEL)
+    embeddings = batcher.embed([chunk["content"] for chunk in chunks])
+    if batcher.errors:
+        raise RuntimeError(f"{len(batcher.errors)} chunk embeddings mislukt: {next(iter(batcher.errors.values()))}")
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk["embedding"] = embedding
+    return pool_embeddings(embeddings, [chunk["token_count"] for chunk in chunks]), chunks
+
+
+def store_rag_chunks(rag_id: str, chunks: list[dict]):
+    """Replace the chunk rows of a RAG document: upsert on (document_id, chunk_index), drop the surplus."""
+    supabase.table("rag_document_chunks").upsert([
+        {**chunk, "document_id": rag_id} for chunk in chunks
+    ], on_conflict="document_id,chunk_index").execute()
+    supabase.table("rag_document_chunks").delete().eq("document_id", rag_id).gte("chunk_index", len(chunks)).execute()
+
+
+def get_technique_matrix() -> TechniqueMatrix:
+    """Technique embeddings as a normalized matrix, loaded once per run."""
+    global _technique_matrix
+    if _technique_matrix is None:
+        techniek_docs = supabase.table("rag_documents").select(
+            "id, techniek_id, source_id, title, embedding"
+        ).eq("doc_type", "techniek").execute()
+        _technique_matrix = TechniqueMatrix(techniek_docs.data or [])
+    return _technique_matrix
 
 
 def match_best_technique(transcript_embedding: list[float]) -> tuple[str | None, float]:
     """
-    Match transcript embedding to best technique using cosine similarity.
-    Returns (techniek_nummer, confidence_score) or (None, 0.0) if no match.
+    Match transcript embedding to best technique (shared matcher, cloud-run/technique_matching.py).
+    Returns (techniek_nummer, confidence_score), or (None, score) below the 30% threshold.
     """
     try:
-        techniek_docs = supabase.table("rag_documents").select(
-            "techniek_id, embedding"
-        ).eq("doc_type", "techniek").execute()
+        techniques = get_technique_matrix()
         
-        if not techniek_docs.data:
+        if not len(techniques):
             print("  (geen techniek embeddings gevonden)")
             return None, 0.0
         
-        best_match = None
-        best_score = 0.0
-        
-        for doc in techniek_docs.data:
-            techniek_id = doc.get("techniek_id")
-            techniek_embedding = doc.get("embedding")
-            
-            if not techniek_id or not techniek_embedding:
-                continue
-            
-            score = cosine_similarity(transcript_embedding, techniek_embedding)
-            
-            if score > best_score:
-                best_score = score
-                best_match = techniek_id
-        
-        return best_match, best_score
+        match = techniques.match(transcript_embedding, threshold=MIN_CONFIDENCE)
+        if not match["best"]:
+            return None, match["score"]
+        return match["best"]["techniek_id"], match["score"]
         
     except Exception as e:
         print(f"  (techniek matching fout: {str(e)[:50]})")
@@ -1011,7 +1128,11 @@ def store_in_rag(job: dict, transcript_data: dict | str) -> tuple[str | None, st
     
     print(f"  RAG embedding genereren...", end=" ", flush=True)
     
-    embedding = generate_embedding(transcript)
+    chunks = []
+    if RAG_CHUNKING:
+        embedding, chunks = embed_transcript(transcript, word_timestamps)
+    else:
+        embedding = generate_embedding(transcript)
     
     source_id = f"video_{job['id']}"
     title = job.get("video_title") or job.get("drive_file_name", "Onbekende video")
@@ -1035,22 +1156,22 @@ def store_in_rag(job: dict, transcript_data: dict | str) -> tuple[str | None, st
         ]
         record["word_timestamps"] = timestamps_clean
     
-    existing = supabase.table("rag_documents").select("id").eq("source_id", source_id).execute()
+    # One upsert on source_id instead of select + update/insert
+    rag_id = upsert_rag_documents(supabase_rest, [record])[0]
+    print(f"✓ (opgeslagen)", end=" ")
     
-    if existing.data:
-        supabase.table("rag_documents").update(record).eq("id", existing.data[0]["id"]).execute()
-        rag_id = existing.data[0]["id"]
-        print(f"✓ (bijgewerkt)", end=" ")
-    else:
-        result = supabase.table("rag_documents").insert(record).execute()
-        rag_id = result.data[0]["id"] if result.data else None
-        print(f"✓ (nieuw)", end=" ")
+    if rag_id and chunks:
+        try:
+            store_rag_chunks(rag_id, chunks)
+            print(f"({len(chunks)} chunks)", end=" ")
+        except Exception as e:
+            print(f"(chunks niet opgeslagen: {str(e)[:80]})", end=" ")
     
     ai_techniek_id, ai_confidence = match_best_technique(embedding)
     if ai_techniek_id:
         print(f"→ AI match: {ai_techniek_id} ({ai_confidence:.0%})")
     else:
-        print()
+        print(f"→ geen AI match ({ai_confidence:.0%} < {MIN_CONFIDENCE:.0%})")
     
     return rag_id, ai_techniek_id, ai_confidence
 
@@ -1136,13 +1257,21 @@ def process_single_job(job: dict, access_token: str):
         
         replicate_available = os.environ.get("REPLICATE_API_TOKEN")
         matting_success = False
+        loudness = {}
         
         if replicate_available:
             matting_success = apply_rvm_matting(video_raw_path, video_processed_path)
         
         if not matting_success:
             print("  RVM niet beschikbaar of mislukt, probeer chromakey fallback...")
-            matting_success = apply_chromakey(video_raw_path, video_processed_path, video_duration=video_duration)
+            # Same decode also writes the transcription audio + loudness measurements
+            matting_success = apply_chromakey(
+                video_raw_path, video_processed_path,
+                video_duration=video_duration,
+                audio_path=audio_path,
+                loudness=loudness,
+                segments=CHROMAKEY_SEGMENTS
+            )
         
         if matting_success:
             video_path = video_processed_path
@@ -1155,16 +1284,19 @@ def process_single_job(job: dict, access_token: str):
         # Audio normalisatie: noise reduction + EBU R128 loudness matching
         update_job_status(job_id, "normalizing_audio")
         normalized_path = tmpdir / f"video_normalized_{job_id}.mp4"
-        if normalize_video_audio(video_path, normalized_path):
+        if normalize_video_audio(video_path, normalized_path, measured=loudness or None):
             video_path.unlink()
             normalized_path.rename(video_path)
         else:
             print("  ⚠ Audio normalisatie mislukt, ga door met originele audio")
 
-        update_job_status(job_id, "extracting_audio")
-        if not extract_audio(video_path, audio_path):
-            update_job_status(job_id, "failed", "Audio extractie mislukt")
-            return False
+        if audio_path.exists() and audio_path.stat().st_size > 0:
+            print("  Audio extractie: al gedaan tijdens chromakey ✓")
+        else:
+            update_job_status(job_id, "extracting_audio")
+            if not extract_audio(video_path, audio_path):
+                update_job_status(job_id, "failed", "Audio extractie mislukt")
+                return False
 
         update_job_status(job_id, "uploading_mux")
         mux_result = upload_to_mux(video_path, video_title)
@@ -1353,8 +1485,14 @@ def process_single_by_id(job_id: str):
 def main():
     parser = argparse.ArgumentParser(description="Process video ingest jobs")
     parser.add_argument("--job-id", help="Process a specific job by ID")
+    parser.add_argument("--segments", type=int, default=None,
+                        help="Chromakey in N parallel segments (default: CHROMAKEY_SEGMENTS env, 0 = uit)")
     args = parser.parse_args()
     
+    if args.segments is not None:
+        global CHROMAKEY_SEGMENTS
+        CHROMAKEY_SEGMENTS = args.segments
+    
     if args.job_id:
         process_single_by_id(args.job_id)
     else:
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Local RAG search over an exported corpus (no pgvector / database needed).
+
+Laadt de embeddings van een export (scripts/export_rag_corpus.py --with-embeddings)
+in een numpy matrix en zoekt de top-k documenten op cosine similarity, met optionele
+filters op doc_type, fase en techniek. De query wordt ge-embed met OpenAI (via de
+lokale embedding cache, dus herhaalde queries kosten niets).
+
+Gebruik:
+    python scripts/search_rag_corpus.py "hoe reageer ik op een prijsbezwaar" --corpus exports/rag_corpus_with_embeddings.jsonl
+    python scripts/search_rag_corpus.py "openingsvraag" --corpus export.json --top-k 10 --doc-type hugo_training --fase 2
+    python scripts/search_rag_corpus.py "afsluiten" --corpus export.json --techniek 4.1 --json
+"""
+
+import os
+import sys
+import json
+import argparse
+import time
+from pathlib import Path
+
+from openai import OpenAI
+
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from embedding_cache import get_default_cache
+from rag_search import RagIndex
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def embed_query(text: str) -> list[float]:
+    """Embedding for the query text (cached on local disk)."""
+    openai_key = os.environ.get("OPENAI_API_KEY") or os.environ.get("Openai_API")
+    if not openai_key:
+        raise ValueError("OPENAI_API_KEY vereist")
+
+    def create():
+        response = OpenAI(api_key=openai_key).embeddings.create(model=EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+
+    return get_default_cache().get_or_create(EMBEDDING_MODEL, text, create)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokale RAG search over een geëxporteerd corpus")
+    parser.add_argument("query", help="Zoekvraag")
+    parser.add_argument("--corpus", required=True, help="Export met embeddings (.jsonl + .npy sidecar, JSON of JSONL)")
+    parser.add_argument("--top-k", type=int, default=5, help="Aantal resultaten (default 5)")
+    parser.add_argument("--threshold", type=float, help="Minimale similarity")
+    parser.add_argument("--doc-type", action="append", help="Filter op doc_type (herhaalbaar)")
+    parser.add_argument("--fase", action="append", help="Filter op fase (herhaalbaar)")
+    parser.add_argument("--techniek", action="append", help="Filter op techniek_id (herhaalbaar)")
+    parser.add_argument("--json", action="store_true", help="Resultaten als JSON")
+    args = parser.parse_args()
+
+    start = time.time()
+    index = RagIndex.load(args.corpus)
+    load_ms = (time.time() - start) * 1000
+    if not len(index):
+        print(f"FOUT: geen documenten met embeddings in {args.corpus}")
+        sys.exit(1)
+
+    try:
+        query_embedding = embed_query(args.query)
+    except ValueError as e:
+        print(f"FOUT: {e}")
+        sys.exit(1)
+
+    start = time.time()
+    hits = index.search(
+        query_embedding,
+        top_k=args.top_k,
+        threshold=args.threshold,
+        doc_type=args.doc_type,
+        fase=args.fase,
+        techniek_id=args.techniek
+    )
+    search_ms = (time.time() - start) * 1000
+
+    if args.json:
+        print(json.dumps(hits, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Corpus: {len(index)} documenten ({index.dimensions} dims), geladen in {load_ms:.0f} ms")
+    print(f"Zoektijd: {search_ms:.2f} ms")
+    print()
+    for rank, hit in enumerate(hits, 1):
+        techniek = f" [{hit['techniek_id']}]" if hit.get('techniek_id') else ""
+        print(f"{rank:>2}. {hit['score']:.3f}  {hit.get('doc_type')}  {hit.get('title')}{techniek}")
+        content = (hit.get('content') or '').replace("\n", " ")
+        print(f"      {content[:160]}{'...' if len(content) > 160 else ''}")
+    if not hits:
+        print("Geen resultaten")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+-- Single-round-trip job dispatch for the Cloud Run worker
+-- Run this in Supabase SQL Editor (after add_job_leases.sql, add_job_retry_backoff.sql
+-- and add_job_priority.sql)
+--
+-- Every /batch/process-next task used to run watchdog (GET + PATCH per stale job),
+-- batch state, next-job lookup, claim, counter update and two pending counts as
+-- separate REST calls. dispatch_jobs() does all of it in one transaction:
+--   1. jobs in a transitional state whose lease expired (or, without a lease, not
+--      updated since stale_before) go back to pending with a retry backoff, or to
+--      dead_letter once they used up max_attempts
+--      (stale_before NULL = skip; the watchdog normally runs on its own schedule)
+--   2. processed_delta / failed_delta are added to the batch counters (finished jobs)
+--   3. if the batch is active, up to max_jobs jobs are claimed in the order of the
+--      batch's scheduling_policy (highest priority first, then fifo / sjf / fair;
+--      see add_job_priority.sql) with FOR UPDATE SKIP LOCKED, so concurrent
+--      dispatchers never get the same job, and with a lease for
+--      lease_owner; jobs whose next_attempt_at lies in the future are skipped, jobs
+--      without a drive_file_id or out of attempts are moved to dead_letter instead
+--   4. the number of jobs still waiting (and of those, ready now) is returned, plus
+--      the earliest next_attempt_at so the worker can schedule its next task for it
+-- The worker falls back to the old REST sequence while this function is missing.
+
+-- 1. Index for the "next pending job" lookup (oldest first)
+CREATE INDEX IF NOT EXISTS idx_video_ingest_jobs_dispatch
+  ON video_ingest_jobs(created_at)
+  WHERE status IN ('pending', 'failed', 'chromakey_failed');
+
+-- Index for the watchdog (transitional status + updated_at cutoff)
+CREATE INDEX IF NOT EXISTS idx_video_ingest_jobs_status_updated_at
+  ON video_ingest_jobs(status, updated_at);
+
+-- 2. Dispatch function (the versions without leases / retry backoff had other signatures)
+DROP FUNCTION IF EXISTS dispatch_jobs(INTEGER, TEXT, TEXT[], TIMESTAMPTZ, INTEGER, INTEGER);
+DROP FUNCTION IF EXISTS dispatch_jobs(INTEGER, TEXT, TEXT[], TIMESTAMPTZ, INTEGER, INTEGER, TEXT, INTEGER);
+
+CREATE OR REPLACE FUNCTION dispatch_jobs(
+  max_jobs INTEGER,
+  archief_folder_id TEXT,
+  transitional_states TEXT[],
+  stale_before TIMESTAMPTZ,
+  processed_delta INTEGER DEFAULT 0,
+  failed_delta INTEGER DEFAULT 0,
+  lease_owner TEXT DEFAULT NULL,
+  lease_seconds INTEGER DEFAULT 90,
+  max_attempts INTEGER DEFAULT 5,
+  retry_base_seconds INTEGER DEFAULT 300,
+  retry_max_seconds INTEGER DEFAULT 21600
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  recovered JSONB;
+  active BOOLEAN;
+  policy TEXT;
+  weights JSONB;
+  batch_started TIMESTAMPTZ;
+  claimed JSONB := '[]'::jsonb;
+  dead_lettered JSONB := '[]'::jsonb;
+  pending_count BIGINT;
+  ready_count BIGINT;
+  next_retry_at TIMESTAMPTZ;
+BEGIN
+  -- Watchdog: reset stale jobs (a lost worker counts as a transient failure of the attempt)
+  recovered := '[]'::jsonb;
+  IF stale_before IS NOT NULL THEN
+    WITH reset AS (
+      UPDATE video_ingest_jobs
+      SET status = CASE WHEN attempt_count >= max_attempts THEN 'dead_letter' ELSE 'pending' END,
+          error_message = format('[Watchdog Reset] Job was stuck in %L state since %s. Auto-reset at %s', status, updated_at, now()),
+          failure_kind = 'transient',
+          next_attempt_at = CASE
+            WHEN attempt_count >= max_attempts THEN NULL
+            ELSE now() + make_interval(secs => LEAST(retry_max_seconds, retry_base_seconds * power(2, GREATEST(attempt_count - 1, 0))))
+          END,
+          updated_at = now(),
+          lease_owner = NULL,
+          lease_expires_at = NULL
+      WHERE status = ANY(transitional_states)
+        AND (lease_expires_at < now() OR (lease_expires_at IS NULL AND updated_at < stale_before))
+        AND drive_folder_id <> archief_folder_id
+      RETURNING id, drive_file_name, status
+    )
+    SELECT COALESCE(jsonb_agg(jsonb_build_object('id', id, 'drive_file_name', drive_file_name, 'status', status)), '[]'::jsonb)
+    INTO recovered
+    FROM reset;
+  END IF;
+
+  -- Batch state (row lock serializes counter updates of concurrent slots)
+  SELECT COALESCE(batch_active, FALSE), scheduling_policy, folder_weights, started_at::timestamptz
+  INTO active, policy, weights, batch_started
+  FROM video_batch_state
+  WHERE id = 1
+  FOR UPDATE;
+  active := COALESCE(active, FALSE);
+  policy := COALESCE(policy, 'fifo');
+  weights := COALESCE(weights, '{}'::jsonb);
+
+  IF active AND (processed_delta <> 0 OR failed_delta <> 0) THEN
+    UPDATE video_batch_state
+    SET processed_jobs = COALESCE(processed_jobs, 0) + processed_delta,
+        failed_jobs = COALESCE(failed_jobs, 0) + failed_delta,
+        updated_at = now()
+    WHERE id = 1;
+  END IF;
+
+  -- Claim the next waiting jobs whose backoff has passed, in scheduling order
+  IF active AND max_jobs > 0 THEN
+    WITH served AS (
+      -- Jobs per folder claimed in this batch (only 'fair' needs them)
+      SELECT drive_folder_id, COUNT(*) AS claims
+      FROM video_ingest_jobs
+      WHERE policy = 'fair' AND claimed_at >= batch_started
+      GROUP BY drive_folder_id
+    ), ranked AS (
+      -- Window functions cannot be combined with FOR UPDATE: rank first, lock below
+      SELECT j.id, j.priority, j.created_at,
+             job_cost(j) AS cost,
+             (COALESCE(s.claims, 0) + ROW_NUMBER() OVER (PARTITION BY j.drive_folder_id ORDER BY j.priority DESC, j.created_at))
+               / GREATEST(COALESCE((weights ->> j.drive_folder_id)::numeric, 1), 0.001) AS fair_rank
+      FROM video_ingest_jobs j
+      LEFT JOIN served s ON s.drive_folder_id = j.drive_folder_id
+      WHERE j.status IN ('pending', 'failed', 'chromakey_failed')
+        AND j.drive_folder_id <> archief_folder_id
+        AND (j.next_attempt_at IS NULL OR j.next_attempt_at <= now())
+    ), candidates AS (
+      SELECT j.id,
+             CASE
+               WHEN j.drive_file_id IS NULL THEN 'Missing drive_file_id'
+               WHEN j.attempt_count >= max_attempts THEN format('Gave up after %s attempts: %s', j.attempt_count, j.error_message)
+             END AS rejected
+      FROM video_ingest_jobs j
+      JOIN ranked r ON r.id = j.id
+      -- Re-checked on the locked row version (another dispatcher may just have claimed it)
+      WHERE j.status IN ('pending', 'failed', 'chromakey_failed')
+      ORDER BY r.priority DESC,
+               CASE policy WHEN 'sjf' THEN r.cost WHEN 'fair' THEN r.fair_rank END ASC NULLS LAST,
+               r.created_at
+      LIMIT max_jobs
+      FOR UPDATE OF j SKIP LOCKED
+    ), updated AS (
+      UPDATE video_ingest_jobs j
+      SET status = CASE WHEN c.rejected IS NULL THEN 'external_processing' ELSE 'dead_letter' END,
+          error_message = COALESCE(c.rejected, 'Claimed at ' || now()),
+          failure_kind = CASE WHEN j.drive_file_id IS NULL THEN 'permanent' ELSE j.failure_kind END,
+          attempt_count = j.attempt_count + CASE WHEN c.rejected IS NULL THEN 1 ELSE 0 END,
+          next_attempt_at = NULL,
+          claimed_at = CASE WHEN c.rejected IS NULL THEN now() ELSE j.claimed_at END,
+          updated_at = now(),
+          lease_owner = CASE WHEN c.rejected IS NULL THEN dispatch_jobs.lease_owner END,
+          lease_expires_at = CASE
+            WHEN c.rejected IS NOT NULL OR dispatch_jobs.lease_owner IS NULL THEN NULL
+            ELSE now() + make_interval(secs => lease_seconds)
+          END
+      FROM candidates c
+      WHERE j.id = c.id
+      RETURNING j.id, j.drive_file_id, j.drive_file_name, j.status, j.created_at, j.attempt_count, j.priority, c.rejected
+    )
+    SELECT
+      COALESCE(jsonb_agg(to_jsonb(u) - 'rejected' ORDER BY u.priority DESC, u.created_at) FILTER (WHERE u.rejected IS NULL), '[]'::jsonb),
+      COALESCE(jsonb_agg(jsonb_build_object('id', u.id, 'reason', u.rejected)) FILTER (WHERE u.rejected IS NOT NULL), '[]'::jsonb)
+    INTO claimed, dead_lettered
+    FROM updated u;
+  END IF;
+
+  -- Jobs still waiting (recovered and backing-off jobs included)
+  SELECT
+    COUNT(*),
+    COUNT(*) FILTER (WHERE next_attempt_at IS NULL OR next_attempt_at <= now()),
+    MIN(next_attempt_at) FILTER (WHERE next_attempt_at > now())
+  INTO pending_count, ready_count, next_retry_at
+  FROM video_ingest_jobs
+  WHERE status IN ('pending', 'failed', 'chromakey_failed')
+    AND drive_folder_id <> archief_folder_id;
+
+  RETURN jsonb_build_object(
+    'batch_active', active,
+    'policy', policy,
+    'recovered', recovered,
+    'jobs', claimed,
+    'dead_lettered', dead_lettered,
+    'pending', pending_count,
+    'ready', ready_count,
+    'next_attempt_at', next_retry_at
+  );
+END;
+$$;
+
+-- 3. Only the worker (service role) calls it
+REVOKE ALL ON FUNCTION dispatch_jobs(INTEGER, TEXT, TEXT[], TIMESTAMPTZ, INTEGER, INTEGER, TEXT, INTEGER, INTEGER, INTEGER, INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION dispatch_jobs(INTEGER, TEXT, TEXT[], TIMESTAMPTZ, INTEGER, INTEGER, TEXT, INTEGER, INTEGER, INTEGER, INTEGER) TO service_role;
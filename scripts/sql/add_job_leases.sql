@@ -0,0 +1,18 @@
+-- Heartbeat-based job leases for the Cloud Run worker
+-- Run this in Supabase SQL Editor, then re-run add_dispatch_jobs.sql and
+-- add_job_status_counts.sql (both use the new columns)
+--
+-- A claimed job gets lease_owner (worker instance) and lease_expires_at. The worker
+-- extends the lease every JOB_LEASE_SECONDS / 3 while it holds the job, so a slow
+-- encode is never mistaken for a dead worker, and a dead worker's jobs are
+-- recovered as soon as the lease runs out. Jobs without a lease (claimed by an
+-- older worker or via /process) still use the updated_at threshold.
+
+-- 1. Lease columns
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+-- 2. Index for the watchdog's expiry check
+CREATE INDEX IF NOT EXISTS idx_video_ingest_jobs_lease_expires_at
+  ON video_ingest_jobs(lease_expires_at)
+  WHERE lease_expires_at IS NOT NULL;
@@ -0,0 +1,45 @@
+-- Priority and cost-aware scheduling for the Cloud Run batch queue
+-- Run this in Supabase SQL Editor, then re-run add_dispatch_jobs.sql (it orders by
+-- the new columns)
+--
+-- Jobs used to be dispatched strictly by created_at. Now every batch has a policy
+-- (POST /batch/start {"policy": ...}, stored in video_batch_state):
+--   fifo  - oldest first
+--   sjf   - shortest job first, by job_cost() (estimated seconds of video)
+--   fair  - weighted round robin over drive_folder_id: the folder with the fewest
+--           jobs claimed in this batch (relative to its weight) goes next
+-- Within every policy a higher priority is always claimed first, so a video the team
+-- is waiting on can be fast-tracked with {"priorities": {"<job id>": 10}}.
+
+-- 1. Job columns
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0;
+-- Set on every claim; 'fair' counts the jobs per folder claimed since the batch started
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+-- 2. Batch policy
+ALTER TABLE video_batch_state ADD COLUMN IF NOT EXISTS scheduling_policy TEXT NOT NULL DEFAULT 'fifo';
+ALTER TABLE video_batch_state ADD COLUMN IF NOT EXISTS folder_weights JSONB NOT NULL DEFAULT '{}'::jsonb;
+
+-- 3. Estimated processing cost in seconds of video: the probed duration when a
+-- previous attempt stored it, else the Drive file size at ~1.5 MB per second of
+-- 1080p footage; NULL when neither is known (sorted last by sjf).
+-- Taking the row type also makes it a computed column for PostgREST (order=job_cost.asc)
+CREATE OR REPLACE FUNCTION job_cost(job video_ingest_jobs)
+RETURNS NUMERIC
+LANGUAGE sql
+IMMUTABLE
+AS $$
+  SELECT COALESCE(
+    job.duration_seconds::numeric,
+    NULLIF(job.drive_file_size::text, '')::numeric / 1500000
+  );
+$$;
+
+-- 4. Indexes for the priority lookup and the per-folder claim counts
+CREATE INDEX IF NOT EXISTS idx_video_ingest_jobs_dispatch_priority
+  ON video_ingest_jobs(priority DESC, created_at)
+  WHERE status IN ('pending', 'failed', 'chromakey_failed');
+
+CREATE INDEX IF NOT EXISTS idx_video_ingest_jobs_claimed_at
+  ON video_ingest_jobs(claimed_at)
+  WHERE claimed_at IS NOT NULL;
@@ -0,0 +1,28 @@
+-- Retry backoff and dead-letter status for the Cloud Run batch queue
+-- Run this in Supabase SQL Editor, then re-run add_dispatch_jobs.sql and
+-- add_job_status_counts.sql (both use the new columns)
+--
+-- Failed jobs used to be picked up again by the very next task, so a video that
+-- always fails (corrupt file, no access) kept one slot busy forever. Now:
+--   - every claim increments attempt_count
+--   - a transient failure puts the job back as 'failed' with next_attempt_at =
+--     now + JOB_RETRY_BASE_SECONDS * 2^(attempt_count - 1), capped at
+--     JOB_RETRY_MAX_SECONDS; dispatch skips it until then
+--   - a permanent failure (failure_kind) or the JOB_MAX_ATTEMPTS-th failure moves
+--     the job to 'dead_letter', which is never claimed again
+
+-- 1. Retry columns
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS attempt_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ;
+ALTER TABLE video_ingest_jobs ADD COLUMN IF NOT EXISTS failure_kind TEXT;
+
+-- 2. Overview of quarantined jobs
+SELECT id, drive_file_name, attempt_count, failure_kind, error_message
+FROM video_ingest_jobs
+WHERE status = 'dead_letter'
+ORDER BY updated_at DESC;
+
+-- Optional: give quarantined jobs a fresh set of attempts (e.g. after fixing Drive sharing)
+-- UPDATE video_ingest_jobs
+-- SET status = 'pending', attempt_count = 0, next_attempt_at = NULL, failure_kind = NULL
+-- WHERE status = 'dead_letter';
@@ -0,0 +1,45 @@
+-- Grouped job counts for the worker's /batch/status endpoint
+-- Run this in Supabase SQL Editor (after add_job_leases.sql and add_job_retry_backoff.sql)
+--
+-- /batch/status used to download the status of every video_ingest_jobs row and
+-- count in Python, plus two separate count queries for pending/stuck jobs. This
+-- function returns all counters from one scan; the worker caches the result for
+-- BATCH_STATUS_TTL_SECONDS and falls back to parallel HEAD counts when the
+-- function does not exist yet.
+
+-- 1. Counter function
+CREATE OR REPLACE FUNCTION job_status_counts(
+  archief_folder_id TEXT,
+  transitional_states TEXT[],
+  stale_before TIMESTAMPTZ
+)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT jsonb_build_object(
+    'completed', COUNT(*) FILTER (WHERE status = 'completed'),
+    'failed', COUNT(*) FILTER (WHERE status IN ('cloud_failed', 'failed', 'chromakey_failed')),
+    'dead_letter', COUNT(*) FILTER (WHERE status = 'dead_letter'),
+    'processing', COUNT(*) FILTER (WHERE status = 'external_processing'),
+    'pending', COUNT(*) FILTER (
+      WHERE status IN ('pending', 'failed', 'chromakey_failed')
+        AND drive_folder_id <> archief_folder_id
+    ),
+    'backoff', COUNT(*) FILTER (
+      WHERE status IN ('pending', 'failed', 'chromakey_failed')
+        AND drive_folder_id <> archief_folder_id
+        AND next_attempt_at > now()
+    ),
+    'stuck', COUNT(*) FILTER (
+      WHERE status = ANY(transitional_states)
+        AND (lease_expires_at < now() OR (lease_expires_at IS NULL AND updated_at < stale_before))
+        AND drive_folder_id <> archief_folder_id
+    )
+  )
+  FROM video_ingest_jobs;
+$$;
+
+-- 2. Only the worker (service role) calls it
+REVOKE ALL ON FUNCTION job_status_counts(TEXT, TEXT[], TIMESTAMPTZ) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION job_status_counts(TEXT, TEXT[], TIMESTAMPTZ) TO service_role;
@@ -0,0 +1,68 @@
+-- Chunked transcript embeddings
+-- Run this in Supabase SQL Editor
+--
+-- Long transcripts (webinars, long sessions) are split into overlapping, token-bounded
+-- chunks by cloud-run/transcript_chunking.py. Every chunk gets its own embedding row
+-- here, linked to the parent rag_documents row. The parent keeps one pooled vector
+-- (mean of the chunk embeddings) for document-level matching.
+
+-- 1. Chunk table
+CREATE TABLE IF NOT EXISTS rag_document_chunks (
+  id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+  document_id UUID NOT NULL REFERENCES rag_documents(id) ON DELETE CASCADE,
+  chunk_index INTEGER NOT NULL,
+  content TEXT NOT NULL,
+  token_count INTEGER,
+  start_seconds DOUBLE PRECISION,
+  end_seconds DOUBLE PRECISION,
+  embedding vector(1536),
+  created_at TIMESTAMPTZ DEFAULT now(),
+  UNIQUE(document_id, chunk_index)
+);
+
+-- 2. Indexes
+CREATE INDEX IF NOT EXISTS idx_rag_document_chunks_document_id ON rag_document_chunks(document_id);
+CREATE INDEX IF NOT EXISTS idx_rag_document_chunks_embedding ON rag_document_chunks
+  USING hnsw (embedding vector_cosine_ops);
+
+-- 3. Enable RLS
+ALTER TABLE rag_document_chunks ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Allow read access for authenticated users" ON rag_document_chunks;
+CREATE POLICY "Allow read access for authenticated users" ON rag_document_chunks
+  FOR SELECT TO authenticated USING (true);
+
+DROP POLICY IF EXISTS "Allow service role full access" ON rag_document_chunks;
+CREATE POLICY "Allow service role full access" ON rag_document_chunks
+  FOR ALL TO service_role USING (true) WITH CHECK (true);
+
+-- 4. Chunk-level similarity search (best chunks + their parent document)
+CREATE OR REPLACE FUNCTION match_rag_document_chunks(
+  query_embedding vector(1536),
+  match_threshold FLOAT DEFAULT 0.3,
+  match_count INT DEFAULT 5
+)
+RETURNS TABLE (
+  chunk_id UUID,
+  document_id UUID,
+  chunk_index INTEGER,
+  content TEXT,
+  start_seconds DOUBLE PRECISION,
+  end_seconds DOUBLE PRECISION,
+  doc_type TEXT,
+  title TEXT,
+  techniek_id TEXT,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    c.id, c.document_id, c.chunk_index, c.content, c.start_seconds, c.end_seconds,
+    d.doc_type, d.title, d.techniek_id,
+    1 - (c.embedding <=> query_embedding) AS similarity
+  FROM rag_document_chunks c
+  JOIN rag_documents d ON d.id = c.document_id
+  WHERE 1 - (c.embedding <=> query_embedding) > match_threshold
+  ORDER BY c.embedding <=> query_embedding
+  LIMIT match_count;
+$$;
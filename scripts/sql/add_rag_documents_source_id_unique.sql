@@ -0,0 +1,36 @@
+-- Unique source_id on rag_documents
+-- Run this in Supabase SQL Editor
+--
+-- cloud-run/rag_writer.py upserts documents in bulk with on_conflict=source_id
+-- (one request per batch instead of select + insert/update per document).
+-- That needs a unique index on source_id; NULL source_ids stay allowed.
+
+-- 1. Give rows that were keyed differently a source_id
+-- Cloud Run worker rows were looked up by metadata->>job_id
+UPDATE rag_documents
+SET source_id = 'video_' || (metadata->>'job_id')
+WHERE source_id IS NULL AND metadata->>'job_id' IS NOT NULL;
+
+-- sync_ssot_to_rag.py inserted techniek rows without source_id
+UPDATE rag_documents
+SET source_id = 'techniek_' || techniek_id
+WHERE source_id IS NULL AND doc_type = 'techniek' AND techniek_id IS NOT NULL;
+
+-- 2. Check for duplicates (must return no rows before step 3)
+SELECT source_id, COUNT(*) AS copies, array_agg(id ORDER BY updated_at DESC NULLS LAST) AS ids
+FROM rag_documents
+WHERE source_id IS NOT NULL
+GROUP BY source_id
+HAVING COUNT(*) > 1;
+
+-- Optional: keep only the most recently updated row per source_id
+-- DELETE FROM rag_documents d
+-- USING (
+--   SELECT id, ROW_NUMBER() OVER (PARTITION BY source_id ORDER BY updated_at DESC NULLS LAST, id) AS rn
+--   FROM rag_documents
+--   WHERE source_id IS NOT NULL
+-- ) ranked
+-- WHERE d.id = ranked.id AND ranked.rn > 1;
+
+-- 3. Unique index used by the upserts
+CREATE UNIQUE INDEX IF NOT EXISTS idx_rag_documents_source_id_unique ON rag_documents(source_id);
@@ -0,0 +1,41 @@
+-- Bulk AI technique suggestions
+-- Run this in Supabase SQL Editor
+--
+-- Used by scripts/backfill_ai_techniek_matching.py: writes the AI suggestions for a
+-- whole batch of videos in one UPDATE instead of one PATCH per video.
+--
+-- updates: JSON array of
+--   {"id": <video uuid>, "ai_suggested_techniek_id": "2.1", "ai_confidence": 0.4123,
+--    "rag_document_id": <uuid or null>}
+-- rag_document_id is only filled in when the video has none yet.
+-- Returns the number of updated rows.
+
+CREATE OR REPLACE FUNCTION bulk_set_ai_suggestions(updates JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  updated_count INTEGER;
+BEGIN
+  UPDATE video_ingest_jobs AS j
+  SET ai_suggested_techniek_id = u.ai_suggested_techniek_id,
+      ai_confidence = u.ai_confidence,
+      rag_document_id = COALESCE(j.rag_document_id, u.rag_document_id),
+      updated_at = now()
+  FROM jsonb_to_recordset(updates) AS u(
+    id UUID,
+    ai_suggested_techniek_id TEXT,
+    ai_confidence DOUBLE PRECISION,
+    rag_document_id UUID
+  )
+  WHERE j.id = u.id;
+
+  GET DIAGNOSTICS updated_count = ROW_COUNT;
+  RETURN updated_count;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION bulk_set_ai_suggestions(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION bulk_set_ai_suggestions(JSONB) TO service_role;
@@ -29,6 +29,11 @@ from datetime import datetime
 
 # Add parent dir to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-run'))
+from embedding_batcher import EmbeddingBatcher
+from rag_writer import delete_rag_documents, upsert_rag_documents
+from supabase_rest import SupabaseREST
 
 try:
     from supabase import create_client
@@ -41,6 +46,7 @@ except ImportError:
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+EMBEDDING_MODEL = "text-embedding-3-small"
 
 def load_ssot():
     """Load technieken from SSOT json file."""
@@ -83,18 +89,18 @@ def content_hash(content: str) -> str:
     """Generate hash of content for change detection."""
     return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
 
-def generate_embedding(text: str) -> list:
-    """Generate OpenAI embedding for text."""
+def generate_embeddings(texts: list) -> list:
+    """Generate OpenAI embeddings for all texts in batched requests (cached on local disk)."""
     if not OPENAI_API_KEY:
         print("  WARNING: No OPENAI_API_KEY, skipping embedding generation")
-        return None
+        return [None] * len(texts)
     
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    response = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    )
-    return response.data[0].embedding
+    batcher = EmbeddingBatcher(openai.OpenAI(api_key=OPENAI_API_KEY), model=EMBEDDING_MODEL)
+    embeddings = batcher.embed(texts)
+    print(f"Embeddings: {len(texts)} texts in {batcher.stats()['requests']} requests")
+    for index, error in batcher.errors.items():
+        print(f"  WARNING: embedding failed for text {index + 1}: {error}")
+    return embeddings
 
 def sync_technieken(dry_run=False, force_all=False):
     """Main sync function."""
@@ -216,55 +222,46 @@ def sync_technieken(dry_run=False, force_all=False):
     print("EXECUTING CHANGES")
     print("=" * 60)
     
-    # Insert new
-    for item in to_insert:
-        print(f"Inserting {item['nummer']}...")
-        embedding = generate_embedding(item['content'])
-        
-        insert_data = {
+    # All new/changed content is embedded up front in batched requests
+    embeddings = generate_embeddings([item['content'] for item in to_insert + to_update])
+    for item, embedding in zip(to_insert + to_update, embeddings):
+        item['embedding'] = embedding
+    
+    rest = SupabaseREST(SUPABASE_URL, SUPABASE_KEY)
+    
+    # Insert new + update existing: one bulk upsert on source_id ('techniek_<nummer>')
+    rows = []
+    for item in to_insert + to_update:
+        row = {
+            'source_id': f"techniek_{item['nummer']}",
             'title': item['title'],
             'content': item['content'],
             'doc_type': 'techniek',
             'techniek_id': item['nummer'],
-            'source_type': 'ssot_sync',
-            'created_at': datetime.utcnow().isoformat(),
         }
-        if embedding:
-            insert_data['embedding'] = embedding
-        
-        try:
-            client.table('rag_documents').insert(insert_data).execute()
-            print(f"  Inserted {item['nummer']}")
-        except Exception as e:
-            print(f"  ERROR inserting {item['nummer']}: {e}")
+        if 'id' not in item:
+            row['source_type'] = 'ssot_sync'
+            row['created_at'] = datetime.utcnow().isoformat()
+        if item['embedding']:
+            row['embedding'] = item['embedding']
+        rows.append(row)
     
-    # Update existing
-    for item in to_update:
-        print(f"Updating {item['nummer']}...")
-        embedding = generate_embedding(item['content'])
-        
-        update_data = {
-            'title': item['title'],
-            'content': item['content'],
-            'updated_at': datetime.utcnow().isoformat(),
-        }
-        if embedding:
-            update_data['embedding'] = embedding
-        
+    if rows:
+        print(f"Upserting {len(to_insert)} new + {len(to_update)} updated technieken...")
         try:
-            client.table('rag_documents').update(update_data).eq('id', item['id']).execute()
-            print(f"  Updated {item['nummer']}")
+            upsert_rag_documents(rest, rows)
+            print(f"  Upserted {len(rows)} technieken")
         except Exception as e:
-            print(f"  ERROR updating {item['nummer']}: {e}")
+            print(f"  ERROR upserting technieken: {e}")
     
     # Delete orphaned
-    for item in to_delete:
-        print(f"Deleting orphaned {item['nummer']}...")
+    if to_delete:
+        print(f"Deleting {len(to_delete)} orphaned technieken...")
         try:
-            client.table('rag_documents').delete().eq('id', item['id']).execute()
-            print(f"  Deleted {item['nummer']}")
+            delete_rag_documents(rest, [item['id'] for item in to_delete])
+            print(f"  Deleted {', '.join(item['nummer'] for item in to_delete)}")
         except Exception as e:
-            print(f"  ERROR deleting {item['nummer']}: {e}")
+            print(f"  ERROR deleting orphaned technieken: {e}")
     
     print()
     print("=" * 60)
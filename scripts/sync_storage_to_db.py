@@ -8,7 +8,9 @@ Usage:
 """
 
 import os
+import sys
 from datetime import datetime
+from pathlib import Path
 
 try:
     from supabase import create_client, Client
@@ -17,6 +19,10 @@ except ImportError:
     os.system("pip install supabase")
     from supabase import create_client, Client
 
+# Shared modules live next to the Cloud Run worker
+sys.path.insert(0, str(Path(__file__).parent.parent / "cloud-run"))
+from supabase_rest import SupabaseREST
+
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or os.environ.get("SUPABASE_ANON_KEY")
 
@@ -24,11 +30,13 @@ BUCKET_NAME = "roleplay-uploads"
 ADMIN_USER_ID = None  # Will be fetched from first admin user
 
 supabase: Client = None
+supabase_rest: SupabaseREST = None
 
 
 def init_client():
-    global supabase
+    global supabase, supabase_rest
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    supabase_rest = SupabaseREST(SUPABASE_URL, SUPABASE_KEY)
     print(f"Connected to Supabase: {SUPABASE_URL[:40]}...")
 
 
@@ -88,8 +96,7 @@ def list_storage_files(folder: str = "") -> list:
 
 def get_existing_paths() -> set:
     """Get all storage paths already in the database."""
-    result = supabase.table("roleplay_uploads").select("storage_path").execute()
-    return {r["storage_path"] for r in result.data}
+    return {r["storage_path"] for r in supabase_rest.iter_rows("roleplay_uploads", {"select": "storage_path"})}
 
 
 def create_upload_record(file: dict, user_id: str) -> bool:
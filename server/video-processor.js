@@ -815,7 +815,7 @@ async function getBatchStatus() {
   }
 }
 
-async function startBatchQueue(intervalMinutes = 15) {
+async function startBatchQueue(intervalMinutes = 15, scheduling = {}) {
   const CLOUD_RUN_URL = process.env.CLOUD_RUN_WORKER_URL;
   const WORKER_SECRET = process.env.CLOUD_RUN_WORKER_SECRET;
   
@@ -834,7 +834,7 @@ async function startBatchQueue(intervalMinutes = 15) {
         'Content-Type': 'application/json',
         'Authorization': `Bearer ${WORKER_SECRET}` 
       },
-      body: JSON.stringify({ interval_minutes: intervalMinutes })
+      body: JSON.stringify({ interval_minutes: intervalMinutes, ...scheduling })
     });
     
     const data = await resp.json();
@@ -2893,7 +2893,7 @@ Format: ["id1", "id2", "id3", ...]`;
             status = 'external_processing';
           } else if ([
             'downloading', 'processing', 'extracting_audio', 'transcribing', 'embedding', 'uploading_mux',
-            'cloud_downloading', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'
+            'cloud_downloading', 'cloud_prefetched', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'
           ].includes(job.status)) {
             status = 'processing';
           } else if ((job.status === 'completed' || job.status === 'processed') && job.mux_playback_id) {
@@ -4998,7 +4998,9 @@ Format: ["id1", "id2", "id3", ...]`;
       try {
         const data = JSON.parse(body || '{}');
         const intervalMinutes = data.intervalMinutes || 15;
-        const result = await startBatchQueue(intervalMinutes);
+        // Optional scheduling options, passed through to the Cloud Run worker
+        const { policy, folder_weights, priorities } = data;
+        const result = await startBatchQueue(intervalMinutes, { policy, folder_weights, priorities });
         res.writeHead(result.success ? 200 : 400, { 'Content-Type': 'application/json' });
         res.end(JSON.stringify(result));
       } catch (err) {
@@ -192,7 +192,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
     if (filterValue === 'all') return true;
     
     // Cloud Run statuses
-    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'];
+    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_prefetched', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'];
     
     switch (filterValue) {
       case 'ready':
@@ -208,7 +208,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
       case 'disk_quota':
         return videoStatus === 'disk_quota';
       case 'error':
-        return ['failed', 'chromakey_failed', 'cloud_failed', 'error'].includes(videoStatus);
+        return ['failed', 'chromakey_failed', 'cloud_failed', 'dead_letter', 'error'].includes(videoStatus);
       default:
         return videoStatus === filterValue;
     }
@@ -224,6 +224,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
       'cloud_queued': [],
       'downloading': [],
       'cloud_downloading': [],
+      'cloud_prefetched': [],
       'matting': ['drive'],
       'cloud_chromakey': ['drive'],
       'extracting_audio': ['drive', 'greenscreen'],
@@ -241,7 +242,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
     };
     
     // Cloud Run statuses for cloudrun filter
-    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing', 'cloud_failed'];
+    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_prefetched', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing', 'cloud_failed'];
     
     // For cloudrun stage, check if currently processing on Cloud Run
     if (kpiStage === 'cloudrun') {
@@ -258,6 +259,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
     const currentStageMapping: Record<string, string> = {
       'downloading': 'drive',
       'cloud_downloading': 'drive',
+      'cloud_prefetched': 'drive',
       'matting': 'greenscreen',
       'cloud_chromakey': 'greenscreen',
       'extracting_audio': 'audio',
@@ -276,7 +278,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
     }
     
     // Check for failed videos by stage
-    if (rawStatus === 'failed' || rawStatus === 'cloud_failed' || rawStatus === 'chromakey_failed') {
+    if (rawStatus === 'failed' || rawStatus === 'cloud_failed' || rawStatus === 'chromakey_failed' || rawStatus === 'dead_letter') {
       const errorMsg = ((video as any).error_message || '').toLowerCase();
       if (kpiStage === 'drive' && (errorMsg.includes('download') || errorMsg.includes('drive') || errorMsg.includes('disk quota') || errorMsg.includes('errno 122'))) return true;
       if (kpiStage === 'greenscreen' && (errorMsg.includes('greenscreen') || errorMsg.includes('matting') || errorMsg.includes('chromakey'))) return true;
@@ -655,6 +657,8 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
       // Drive stage
       'downloading': { currentStage: 'drive', doneStages: [] },
       'cloud_downloading': { currentStage: 'drive', doneStages: [] },
+      // Claimed by the prefetcher, waiting for a free encode slot
+      'cloud_prefetched': { currentStage: 'drive', doneStages: [] },
       
       // Greenscreen stage
       'matting': { currentStage: 'greenscreen', doneStages: ['drive'] },
@@ -685,7 +689,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
       'external_processing': { currentStage: 'greenscreen', doneStages: ['drive'] },
     };
     
-    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'];
+    const cloudRunStatuses = ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_prefetched', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'mux_processing'];
     
     for (const video of pipelineVideos) {
       const rawStatus = (video as any).raw_status || video.status;
@@ -744,7 +748,7 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
         stats.drive.done++;
         stats.greenscreen.failed++;
         if (errorMessage) stats.greenscreen.errorMessages.push(errorMessage);
-      } else if (rawStatus === 'cloud_failed') {
+      } else if (rawStatus === 'cloud_failed' || rawStatus === 'dead_letter') {
         stats.cloudrun.failed++;
         if (errorMessage) stats.cloudrun.errorMessages.push(errorMessage);
       } else if (rawStatus === 'failed') {
@@ -1493,13 +1497,13 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
       
       // Map stage to statuses to reset
       const stageToStatuses: Record<string, string[]> = {
-        'drive': ['downloading', 'cloud_downloading', 'failed'],
+        'drive': ['downloading', 'cloud_downloading', 'cloud_prefetched', 'failed'],
         'greenscreen': ['matting', 'cloud_chromakey', 'chromakey_failed'],
         'audio': ['extracting_audio', 'cloud_audio'],
         'transcript': ['transcribing', 'cloud_transcribing'],
         'rag': ['embedding', 'cloud_embedding'],
         'mux': ['uploading_mux', 'cloud_uploading', 'mux_processing'],
-        'cloudrun': ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'cloud_failed'],
+        'cloudrun': ['external_processing', 'cloud_queued', 'cloud_downloading', 'cloud_prefetched', 'cloud_chromakey', 'cloud_audio', 'cloud_transcribing', 'cloud_embedding', 'cloud_uploading', 'cloud_failed'],
       };
       
       const statusesToReset = stageToStatuses[stageKey] || [];
@@ -2276,7 +2280,8 @@ export function AdminVideoManagement({ navigate, isSuperAdmin = false }: AdminVi
                           case 'transcribing': case 'cloud_transcribing': return 'Transcriberen';
                           case 'pending': case 'cloud_queued': return 'Wachtend';
                           case 'error': case 'failed': case 'cloud_failed': case 'chromakey_failed': return 'Fout';
-                          case 'external_processing': case 'cloud_downloading': case 'cloud_chromakey': case 'cloud_audio': case 'cloud_embedding': case 'cloud_uploading': case 'mux_processing': return 'Cloud verwerking';
+                          case 'dead_letter': return 'Opgegeven';
+                          case 'external_processing': case 'cloud_downloading': case 'cloud_prefetched': case 'cloud_chromakey': case 'cloud_audio': case 'cloud_embedding': case 'cloud_uploading': case 'mux_processing': return 'Cloud verwerking';
                           case 'disk_quota': return 'Te groot';
                           case 'filtered': return 'Concept';
                           default: return status;